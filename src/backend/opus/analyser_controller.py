@@ -20,7 +20,7 @@ import commands
 import sys
 import re
 
-from . import config_util, ipc
+from . import config_util, ipc, storage
 from .exception import SnapshotException
 
 
@@ -52,6 +52,14 @@ class AnalyserController(object):
         self.neo4j_params = config_util.safe_read_config(self.config,
                                                          "NEO4J_PARAMS")
 
+        # Only the Neo4J storage interface runs inside a JVM
+        analyser_type = config_util.safe_read_config(self.config, "MODULES",
+                                                     "Analyser")
+        analyser_cfg = config_util.safe_read_config(self.config, "ANALYSER",
+                                                    analyser_type)
+        self.uses_jvm = (analyser_cfg.get('storage_type') ==
+                         storage.DBInterface.__name__)
+
     def _handle_command(self, msg):
         cmd = msg.cont
         if cmd['cmd'] == 'status':
@@ -65,6 +73,10 @@ class AnalyserController(object):
                 ret['outbound_rate'] = self.analyser.outbound.rate
             except AttributeError:
                 pass
+            try:
+                ret['caches'] = self.analyser.db_iface.cache_man.stats()
+            except AttributeError:
+                pass
             return ret
         elif cmd['cmd'] == "exec_qry_method":
             return self.query(cmd)
@@ -104,7 +116,8 @@ class AnalyserController(object):
 
     def _run_fetcher(self):
         '''Runs the fetcher process loop'''
-        import jpype
+        if self.uses_jvm:
+            import jpype
         from . import analysis
         from . import query
 
@@ -119,9 +132,10 @@ class AnalyserController(object):
         self.analyser = config_util.load_module(self.config, "Analyser",
                                                 analysis.Analyser,
                                                 neo4j_cfg)
+        self.analyser.register_release_hook(self.pf_queue.release)
 
         def _query(self, msg):
-            if not jpype.isThreadAttachedToJVM():
+            if self.uses_jvm and not jpype.isThreadAttachedToJVM():
                 jpype.attachThreadToJVM()
 
             return query.ClientQueryControl.exec_method(
@@ -169,31 +183,8 @@ class AnalyserController(object):
         if __debug__:
             logging.debug("RSS: %d", proc_mem_info.rss)
 
-        # If the JVM's current heap size is greater than 90%
-        # of the maximum value of heap size, restart analyser
-        (status, output) = commands.getstatusoutput(
-            'jstat -gccapacity %d' % (fetch_proc.pid))
-        if status != 0:
-            logging.error("%d: %s", status, output)
-        else:
-            # on my machine, there is a "Picked up _JAVA_OPTIONS=..." line
-            # So the line with numbers is not necessarily the second line.
-            fields = re.search("^\\s*([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)", output, re.MULTILINE).groups()
-            jstat_max_jvm = float(fields[1]) + float(fields[7])
-            heap_size = float(fields[3]) + float(fields[4])
-            heap_size += float(fields[5]) + float(fields[9])
-            if __debug__:
-                logging.debug("JVM current heap size: %f MB, "
-                              "Max heap size: %f MB",
-                              (heap_size / 1024),
-                              (jstat_max_jvm / 1024))
-
-            if(heap_size >=
-               (self.memory_params['jvm_usage_threshold'] * jstat_max_jvm)):
-                logging.error("Warning!! JVM heap size above threshold, "
-                              "current_heap: %f MB, max_heap: %f MB",
-                              (heap_size / 1024), (jstat_max_jvm / 1024))
-                return True
+        if self.uses_jvm and self._check_jvm_heap(fetch_proc):
+            return True
 
         # If the resident set size has increased beyond the maximum
         # RSS threshold, restart the analyser
@@ -223,6 +214,35 @@ class AnalyserController(object):
             return True
         return False
 
+    def _check_jvm_heap(self, fetch_proc):
+        '''Checks the JVM heap size of the fetcher with jstat'''
+        # If the JVM's current heap size is greater than 90%
+        # of the maximum value of heap size, restart analyser
+        (status, output) = commands.getstatusoutput(
+            'jstat -gccapacity %d' % (fetch_proc.pid))
+        if status != 0:
+            logging.error("%d: %s", status, output)
+        else:
+            # on my machine, there is a "Picked up _JAVA_OPTIONS=..." line
+            # So the line with numbers is not necessarily the second line.
+            fields = re.search("^\\s*([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)\\s+([\\d.]+)", output, re.MULTILINE).groups()
+            jstat_max_jvm = float(fields[1]) + float(fields[7])
+            heap_size = float(fields[3]) + float(fields[4])
+            heap_size += float(fields[5]) + float(fields[9])
+            if __debug__:
+                logging.debug("JVM current heap size: %f MB, "
+                              "Max heap size: %f MB",
+                              (heap_size / 1024),
+                              (jstat_max_jvm / 1024))
+
+            if(heap_size >=
+               (self.memory_params['jvm_usage_threshold'] * jstat_max_jvm)):
+                logging.error("Warning!! JVM heap size above threshold, "
+                              "current_heap: %f MB, max_heap: %f MB",
+                              (heap_size / 1024), (jstat_max_jvm / 1024))
+                return True
+        return False
+
     def _run_mem_monitor(self):
         '''Monitor the memory usage of the fetcher process'''
         fetch_proc = psutil.Process(self.fetcher.pid)
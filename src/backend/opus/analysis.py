@@ -15,6 +15,8 @@ import threading
 import time
 
 from . import common_utils, exception, storage, order, messaging
+# Imported so their interfaces can be selected as a storage_type
+from . import memory_storage, sqlite_storage
 from . import uds_msg_pb2 as uds_msg
 from .pvm import posix
 
@@ -25,6 +27,7 @@ class Analyser(threading.Thread):
         '''Initialize class members'''
         super(Analyser, self).__init__(*args, **kwargs)
         self.stop_event = threading.Event()
+        self.release_hook = lambda num_msgs, num_bytes: None
         self.daemon = True
 
     def run(self):
@@ -35,6 +38,11 @@ class Analyser(threading.Thread):
         '''Should be overridden in the derived class'''
         pass
 
+    def register_release_hook(self, hook):
+        '''Registers a callable taking a message and byte count that is
+        called as messages finish processing'''
+        self.release_hook = hook
+
     def do_shutdown(self):
         '''Shutdown the thread gracefully'''
         if __debug__:
@@ -70,9 +78,12 @@ class LoggingAnalyser(Analyser):
         and writes them to a file'''
         for msg in msg_list:
             if msg[0] and msg[1]:
-                self.file_object.write(msg[0])
+                self.file_object.write(msg[0].dumps())
                 self.file_object.write(msg[1])
         self.file_object.flush()
+        self.release_hook(len(msg_list),
+                          sum(messaging.HeaderRecord.length + len(pay)
+                              for _, pay in msg_list))
 
     def do_shutdown(self):
         '''Flush all pending writes to disk
@@ -89,12 +100,17 @@ class OrderingAnalyser(Analyser):
         super(OrderingAnalyser, self).__init__(*args, **kwargs)
         # TODO(tb403) - Proper max_wind
         self.event_orderer = order.EventOrderer(50)
+        self.idle_timeout = None  # Seconds to wait before calling on_idle
         self.queue_cleared = threading.Event()
         self.msg_handler = self.process
         self.snapshot_state = False
         self.msg_fh = None
         self.opus_snapshot_dir = opus_snapshot_dir
         self.msg_queue_data_file = None
+        # Queue depth of messages handled but not yet released to the
+        # producer, held back while process may still discard them
+        self.unreleased_msgs = 0
+        self.unreleased_bytes = 0
         self.load_orderer()
 
     def get_snapshot_dir(self):
@@ -106,21 +122,20 @@ class OrderingAnalyser(Analyser):
         if not os.path.isfile(self.msg_queue_data_file):
             return
 
-        hdr_len = messaging.Header.length
+        hdr_len = messaging.HeaderRecord.length
         try:
             with open(self.msg_queue_data_file, "rb") as fp:
                 while True:
-                    hdr = fp.read(hdr_len)
-                    if hdr == b'':
+                    hdr_buf = fp.read(hdr_len)
+                    if hdr_buf == b'':
                         break
-                    hdr_obj = messaging.Header()
-                    hdr_obj.loads(hdr)
+                    hdr = messaging.HeaderRecord.loads(hdr_buf)
 
-                    pay_len = hdr_obj.payload_len
+                    pay_len = hdr.payload_len
                     if pay_len == 0:
                         continue
                     pay = fp.read(pay_len)
-                    msg = [(hdr_obj.timestamp, (hdr, pay))]
+                    msg = [(hdr.timestamp, (hdr, pay))]
                     self.event_orderer.push(msg)
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
@@ -139,12 +154,22 @@ class OrderingAnalyser(Analyser):
         while not self.stop_event.is_set():
             try:
                 logging.info("T:Waiting for message")
-                _, msg = self.event_orderer.pop()
+                item = self.event_orderer.pop(self.idle_timeout)
+                if item is None:
+                    self.on_idle()
+                    continue
+                _, msg = item
                 logging.info("T:Got message!")
                 self.msg_handler(msg)
+                self.unreleased_msgs += 1
+                self.unreleased_bytes += (messaging.HeaderRecord.length +
+                                          len(msg[1]))
+                if not self.holding():
+                    self.release_processed()
             except Queue.Empty:
                 if __debug__:
                     logging.debug("T:Queue cleared, clearing state tables.")
+                self.flush()
                 self.queue_cleared.set()
 
                 if self.snapshot_state:
@@ -196,7 +221,7 @@ class OrderingAnalyser(Analyser):
         self.do_shutdown()
 
     def put_msg_file(self, (hdr, pay)):
-        self.msg_fh.write(hdr)
+        self.msg_fh.write(hdr.dumps())
         self.msg_fh.write(pay)
         self.msg_fh.flush()
 
@@ -205,12 +230,9 @@ class OrderingAnalyser(Analyser):
         blank markers are found.'''
         msg_chunk = []
         for hdr, pay in msg_list:
-            hdr_obj = messaging.Header()
-            hdr_obj.loads(hdr)
-
-            msg_chunk += [(hdr_obj.timestamp, (hdr, pay))]
+            msg_chunk += [(hdr.timestamp, (hdr, pay))]
 
-            if hdr_obj.payload_type == uds_msg.TERM_MSG:
+            if hdr.payload_type == uds_msg.TERM_MSG:
                 if __debug__:
                     logging.debug("M:Received term message.")
                     logging.debug("M:Pushing remaining message chunk.")
@@ -232,13 +254,34 @@ class OrderingAnalyser(Analyser):
                 if __debug__:
                     logging.debug("M:Queue cleared, continuing.")
 
-        logging.debug("M:Pushing message with timestamp: %d.", hdr_obj.timestamp)
+        logging.debug("M:Pushing message with timestamp: %d.", hdr.timestamp)
         self.event_orderer.push(msg_chunk)
 
     def cleanup(self):
         '''Run any code that needs to happen whenever the queue is cleared.'''
         raise NotImplementedError()
 
+    def on_idle(self):
+        '''Called when no message arrived within idle_timeout seconds.'''
+        pass
+
+    def holding(self):
+        '''Returns True while process holds messages that are not yet
+        committed.'''
+        return False
+
+    def release_processed(self):
+        '''Returns the queue depth of the handled messages to the
+        producer.'''
+        if self.unreleased_msgs:
+            self.release_hook(self.unreleased_msgs, self.unreleased_bytes)
+            self.unreleased_msgs = 0
+            self.unreleased_bytes = 0
+
+    def flush(self):
+        '''Complete processing of any messages held back by process.'''
+        pass
+
     def process(self, (hdr, pay)):
         '''Process a single message.'''
         raise NotImplementedError()
@@ -252,13 +295,38 @@ class PVMAnalyser(OrderingAnalyser):
     the significant operations and their interactions with the underlying
     storage system.'''
     def __init__(self, storage_type, storage_args, opus_lite,
-                 neo4j_cfg, *args, **kwargs):
+                 neo4j_cfg, batch_size=1, batch_time_ms=0,
+                 lazy_fd_inherit=False, coalesce_events=False,
+                 coalesce_window_ms=10, *args, **kwargs):
         super(PVMAnalyser, self).__init__(*args, **kwargs)
         self.storage_type = storage_type
         self.storage_args = storage_args
-        self.storage_args['neo4j_cfg'] = neo4j_cfg
+        if storage_type == storage.DBInterface.__name__:
+            self.storage_args['neo4j_cfg'] = neo4j_cfg
         self.opus_lite = opus_lite
+        self.lazy_fd_inherit = lazy_fd_inherit  # Configurable
         self.proc_state_file = None
+        self.cache_state_file = None
+        self.name_filter_file = None
+
+        # Group commit, messages are applied in a single transaction once
+        # batch_size messages are held or the oldest is batch_time_ms old,
+        # a batch_time_ms of 0 sets no time limit
+        self.batch_size = batch_size  # Configurable
+        self.batch_time = batch_time_ms / 1000  # Configurable
+        self.batch = []
+        self.batch_start = None
+        if self.batch_size > 1 and self.batch_time > 0:
+            self.idle_timeout = self.batch_time
+
+        # Runs of repeated read/write calls on one fd are merged into a
+        # single event, disable to keep every call for forensic use
+        self.coalescer = None
+        if coalesce_events:  # Configurable
+            self.coalescer = posix.EventCoalescer(coalesce_window_ms)
+            if (self.idle_timeout is None or
+                    self.coalescer.window_secs < self.idle_timeout):
+                self.idle_timeout = self.coalescer.window_secs
 
     def run(self):
         '''Run a standard processing loop, also close the storage interface
@@ -268,7 +336,16 @@ class PVMAnalyser(OrderingAnalyser):
                                                   **self.storage_args)
         self.proc_state_file = self.get_snapshot_dir() + "/.opus_proc_state.dat"
         posix.handle_proc_load_state(self.proc_state_file)
+        posix.handle_fd_inherit_mode(self.lazy_fd_inherit)
+        self.cache_state_file = (self.get_snapshot_dir() +
+                                 "/.opus_cache_state.dat")
+        self.db_iface.cache_man.load_cache(self.cache_state_file)
+        self.name_filter_file = (self.get_snapshot_dir() +
+                                 "/.opus_name_filter.dat")
+        self.db_iface.load_name_filter(self.name_filter_file)
         super(PVMAnalyser, self).run()
+        self.flush()
+        self.db_iface.dump_name_filter()
         self.db_iface.close()
 
     def cleanup(self):
@@ -279,48 +356,141 @@ class PVMAnalyser(OrderingAnalyser):
         if __debug__:
             logging.error("Dumping process state to file")
         posix.handle_proc_dump_state(self.proc_state_file)
+        self.db_iface.cache_man.dump_cache(self.cache_state_file)
+        self.db_iface.dump_name_filter()
 
     def process(self, (hdr, pay)):
-        '''Process a single front end message, applying it's effects to the
-        database.'''
-        hdr_obj = messaging.Header()
-        hdr_obj.loads(hdr)
-        pay_obj = common_utils.get_payload_type(hdr_obj)
-        pay_obj.ParseFromString(pay)
-        logging.debug("PVM:Received message with timestamp: %d, payload_type: %d, pid: %d.", hdr_obj.timestamp, hdr_obj.payload_type, hdr_obj.pid)
+        '''Process a single front end message, first passing it through the
+        event coalescer if enabled.'''
+        if self.coalescer is None:
+            self.submit((hdr, pay, None))
+            return
+        for msg in self.coalescer.push((hdr, pay)):
+            self.submit(msg)
+
+    def submit(self, msg):
+        '''Applies the effects of a (header, payload, payload object)
+        message to the database, the payload object is None if the payload
+        has not been parsed yet. In group commit mode the message is added
+        to the current batch instead.'''
+        if self.batch_size <= 1:
+            with self.db_iface.start_transaction():
+                self.apply_msg(msg)
+            return
+
+        if not self.batch:
+            self.batch_start = time.time()
+        self.batch.append(msg)
+        if len(self.batch) >= self.batch_size or self.__batch_expired():
+            self.flush()
+
+    def __batch_expired(self):
+        return (self.batch_time > 0 and
+                time.time() - self.batch_start >= self.batch_time)
+
+    def on_idle(self):
+        '''Commit a coalesced run or a partial batch once it has been held
+        for too long.'''
+        if self.coalescer is not None and self.coalescer.expired():
+            for msg in self.coalescer.drain():
+                self.submit(msg)
+        if self.batch and self.__batch_expired():
+            self.flush()
+        if not self.holding():
+            self.release_processed()
+
+    def holding(self):
+        return bool(self.batch) or (self.coalescer is not None and
+                                    self.coalescer.run is not None)
+
+    def flush(self):
+        '''Applies all batched messages in a single transaction. If the
+        transaction fails it is rolled back along with the in memory process
+        state and the batch is retried one message per transaction, so a
+        bad message only loses itself. Any held coalesced run is submitted
+        first. The queue depth of the messages is released once they are
+        committed or dropped.'''
+        if self.coalescer is not None:
+            for msg in self.coalescer.drain():
+                self.submit(msg)
+        if self.batch:
+            batch = self.batch
+            self.batch = []
+            self.__commit_batch(batch)
+        self.release_processed()
+
+    def __commit_batch(self, batch):
+        '''Commits batch, retrying each message separately on failure'''
+        posix.handle_checkpoint()
+        try:
+            with self.db_iface.start_transaction():
+                for msg in batch:
+                    self.apply_msg(msg)
+            posix.handle_commit()
+            return
+        except Exception as exc:
+            logging.error("Batch of %d messages failed, retrying each "
+                          "message separately: %s", len(batch), exc)
+            self.rollback()
+
+        for hdr, pay, pay_obj in batch:
+            posix.handle_checkpoint()
+            try:
+                with self.db_iface.start_transaction():
+                    self.apply_msg((hdr, pay, pay_obj))
+                posix.handle_commit()
+            except Exception as exc:
+                logging.error("Dropping message with timestamp: %d, "
+                              "payload_type: %d, pid: %d. %s",
+                              hdr.timestamp, hdr.payload_type, hdr.pid, exc)
+                self.rollback()
+
+    def rollback(self):
+        '''Undo the changes to the in memory state made since the last
+        checkpoint after a failed transaction.'''
+        posix.handle_rollback()
+        self.db_iface.cache_man.clear()
+
+    def apply_msg(self, (hdr, pay, pay_obj)):
+        '''Applies the effects of a single front end message to the
+        database, must be called inside a transaction. The payload is only
+        parsed if pay_obj is None.'''
+        if pay_obj is None:
+            pay_obj = common_utils.get_payload_type(hdr)
+            pay_obj.ParseFromString(pay)
+        logging.debug("PVM:Received message with timestamp: %d, payload_type: %d, pid: %d.", hdr.timestamp, hdr.payload_type, hdr.pid)
 
         # Set system time for current message
-        self.db_iface.set_sys_time_for_msg(hdr_obj.sys_time)
-
-        with self.db_iface.start_transaction():
-            if hdr_obj.payload_type == uds_msg.FUNCINFO_MSG:
-                posix.handle_function(self.db_iface,
-                                      hdr_obj.pid,
-                                      pay_obj)
-            elif hdr_obj.payload_type == uds_msg.AGGREGATION_MSG:
-                posix.handle_bulk_functions(self.db_iface,
-                                            hdr_obj.pid,
-                                            pay_obj)
-            elif hdr_obj.payload_type == uds_msg.STARTUP_MSG:
-                posix.handle_process(self.db_iface,
-                                     hdr_obj,
-                                     pay_obj,
-                                     self.opus_lite)
-            elif hdr_obj.payload_type == uds_msg.GENERIC_MSG:
-                if pay_obj.msg_type == uds_msg.DISCON:
-                    posix.handle_disconnect(self.db_iface,
-                                            hdr_obj,
-                                            hdr_obj.pid)
-                elif pay_obj.msg_type == uds_msg.PRE_FUNC_CALL:
-                    posix.handle_prefunc(hdr_obj.pid,
-                                         pay_obj)
-            elif hdr_obj.payload_type == uds_msg.TERM_MSG:
-                posix.handle_startup(self.db_iface,
-                                     pay_obj)
-            elif hdr_obj.payload_type == uds_msg.LIBINFO_MSG:
-                posix.handle_libinfo(self.db_iface,
-                                     hdr_obj.pid,
+        self.db_iface.set_sys_time_for_msg(hdr.sys_time)
+
+        if hdr.payload_type == uds_msg.FUNCINFO_MSG:
+            posix.handle_function(self.db_iface,
+                                  hdr.pid,
+                                  pay_obj)
+        elif hdr.payload_type == uds_msg.AGGREGATION_MSG:
+            posix.handle_bulk_functions(self.db_iface,
+                                        hdr.pid,
+                                        pay_obj)
+        elif hdr.payload_type == uds_msg.STARTUP_MSG:
+            posix.handle_process(self.db_iface,
+                                 hdr,
+                                 pay_obj,
+                                 self.opus_lite)
+        elif hdr.payload_type == uds_msg.GENERIC_MSG:
+            if pay_obj.msg_type == uds_msg.DISCON:
+                posix.handle_disconnect(self.db_iface,
+                                        hdr,
+                                        hdr.pid)
+            elif pay_obj.msg_type == uds_msg.PRE_FUNC_CALL:
+                posix.handle_prefunc(hdr.pid,
                                      pay_obj)
+        elif hdr.payload_type == uds_msg.TERM_MSG:
+            posix.handle_startup(self.db_iface,
+                                 pay_obj)
+        elif hdr.payload_type == uds_msg.LIBINFO_MSG:
+            posix.handle_libinfo(self.db_iface,
+                                 hdr.pid,
+                                 pay_obj)
 
 
 class StatisticsAnalyser(PVMAnalyser):
@@ -156,6 +156,7 @@ def handle_status(cac, _):
         rsp['producer']['status'] = "Alive"
     else:
         rsp['producer']['status'] = "Dead"
+    rsp['producer'].update(cac.daemon_manager.pf_queue.get_status())
 
     # Query Interface
     if hasattr(cac.daemon_manager, "query_interface"):
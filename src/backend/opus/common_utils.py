@@ -7,9 +7,11 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
 import bisect
-import collections
 import copy
+import hashlib
 import logging
+import math
+import struct
 import time
 import os
 
@@ -49,44 +51,272 @@ class FixedDict(object):  # pylint: disable=R0903
         return len(self._dictionary)
 
 
-class IndexList(collections.MutableSequence):
-    '''A list that maintains a bisectable index based on a key function.'''
-    def __init__(self, key):
-        self.key = key
-        self.list = []
-        self.index = []
+class SortedChunkList(object):
+    '''A sequence of values ordered by integer keys. Entries are held in
+    chunks of at most chunk_size so inserting at any position only shifts the
+    entries of one chunk, keys are held separately as plain integers so a
+    search never touches the values. Entries with equal keys keep their
+    insertion order.'''
+    def __init__(self, chunk_size=512):
+        self.chunk_size = chunk_size
+        self.keys = []  # Chunks of keys
+        self.vals = []  # Chunks of values, parallel to keys
+        self.maxes = []  # Largest key in each chunk
+        self.length = 0
+
+    def _locate(self, key):
+        '''Returns the chunk and offset at which key would be inserted.'''
+        c = bisect.bisect_right(self.maxes, key)
+        if c == len(self.maxes):
+            if c == 0:
+                return 0, 0
+            return c - 1, len(self.keys[c - 1])
+        return c, bisect.bisect_right(self.keys[c], key)
+
+    def _before(self, c, i):
+        '''Returns the value preceding position i of chunk c.'''
+        if i > 0:
+            return self.vals[c][i - 1]
+        elif c > 0:
+            return self.vals[c - 1][-1]
+        return None
+
+    def _after(self, c, i):
+        '''Returns the value at position i of chunk c, or the start of the
+        next chunk.'''
+        if c < len(self.vals) and i < len(self.vals[c]):
+            return self.vals[c][i]
+        elif c + 1 < len(self.vals):
+            return self.vals[c + 1][0]
+        return None
+
+    def add(self, key, val):
+        '''Inserts val with key after any entries with an equal key.'''
+        self.length += 1
+        if not self.keys:
+            self.keys.append([key])
+            self.vals.append([val])
+            self.maxes.append(key)
+            return
+
+        c, i = self._locate(key)
+        keys = self.keys[c]
+        vals = self.vals[c]
+        keys.insert(i, key)
+        vals.insert(i, val)
+        if i == len(keys) - 1:
+            self.maxes[c] = key
+
+        if len(keys) > self.chunk_size:
+            half = len(keys) // 2
+            self.keys.insert(c + 1, keys[half:])
+            self.vals.insert(c + 1, vals[half:])
+            del keys[half:]
+            del vals[half:]
+            self.maxes[c] = keys[-1]
+            self.maxes.insert(c + 1, self.keys[c + 1][-1])
+
+    def floor(self, key):
+        '''Returns the value of the last entry with a key not greater than
+        key, or None.'''
+        c, i = self._locate(key)
+        return self._before(c, i)
+
+    def neighbours(self, key):
+        '''Returns the values either side of the position key would be
+        inserted at, either may be None.'''
+        c, i = self._locate(key)
+        return self._before(c, i), self._after(c, i)
+
+    def items(self):
+        '''Iterates over the (key, value) pairs in order.'''
+        for keys, vals in zip(self.keys, self.vals):
+            for item in zip(keys, vals):
+                yield item
+
+    def __iter__(self):
+        for vals in self.vals:
+            for val in vals:
+                yield val
 
-    def insert(self, i, val):
-        '''Insert an item into the list.'''
-        self.list.insert(i, val)
-        self.index.insert(i, self.key(val))
+    def __len__(self):
+        return self.length
 
-    def find(self, val, key=None):
-        '''Find an items position in the list by bisecting the index.'''
-        if key is None:
-            return bisect.bisect(self.index, self.key(val))
+    def __repr__(self):
+        return str([key for keys in self.keys for key in keys])
+
+
+class ClockCache(object):
+    '''A dictionary like cache that holds at most capacity entries, or is
+    unbounded if capacity is None, a capacity of 0 caches nothing. When full
+    an entry is evicted using the CLOCK algorithm, every entry has a
+    reference bit that is set when it is accessed and the clock hand evicts
+    the first entry it finds with a clear bit, clearing bits as it passes.
+    Hits, misses and evictions are counted.'''
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.slots = {}  # key -> slot
+        self.keys = []
+        self.vals = []
+        self.refs = []
+        self.free = []  # Slots emptied by deletion
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''Returns the value for key or default, counting the access.'''
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.refs[slot] = True
+        return self.vals[slot]
+
+    def _evict(self):
+        '''Evicts an entry and returns its now empty slot.'''
+        while True:
+            slot = self.hand
+            self.hand = (self.hand + 1) % len(self.keys)
+            if self.refs[slot]:
+                self.refs[slot] = False
+                continue
+            del self.slots[self.keys[slot]]
+            self.evictions += 1
+            return slot
+
+    def __setitem__(self, key, val):
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.vals[slot] = val
+            self.refs[slot] = True
+            return
+        if self.capacity == 0:
+            return
+
+        if self.free:
+            slot = self.free.pop()
+        elif self.capacity is None or len(self.keys) < self.capacity:
+            slot = len(self.keys)
+            self.keys.append(None)
+            self.vals.append(None)
+            self.refs.append(False)
         else:
-            return bisect.bisect(self.index, key(val))
+            slot = self._evict()
+        self.keys[slot] = key
+        self.vals[slot] = val
+        self.refs[slot] = False
+        self.slots[key] = slot
 
-    def __getitem__(self, i):
-        return self.list[i]
+    def __getitem__(self, key):
+        return self.vals[self.slots[key]]
 
-    def __setitem__(self, i, x):
-        self.list[i] = x
-        self.index[i] = self.key(x)
+    def __delitem__(self, key):
+        slot = self.slots.pop(key)
+        self.keys[slot] = None
+        self.vals[slot] = None
+        self.refs[slot] = False
+        self.free.append(slot)
 
-    def __delitem__(self, i):
-        del self.list[i]
-        del self.index[i]
+    def __contains__(self, key):
+        return key in self.slots
 
     def __len__(self):
-        return len(self.list)
+        return len(self.slots)
+
+    def items(self):
+        '''Returns a list of (key, value) pairs without counting accesses.'''
+        return [(key, self.vals[slot]) for key, slot in self.slots.items()]
+
+    def clear(self):
+        '''Removes all entries, the counters are kept.'''
+        self.slots = {}
+        self.keys = []
+        self.vals = []
+        self.refs = []
+        self.free = []
+        self.hand = 0
+
+    def stats(self):
+        '''Returns the size, capacity and access counters.'''
+        return {'size': len(self.slots),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class UndoJournal(object):
+    '''Records the old values of dictionary entries as they are changed so
+    the changes can be undone. Nothing is recorded until start is called,
+    commit keeps the changes made since and rollback undoes them, both end
+    the recording. Values changed in place must be replaced instead, only
+    the reference held by the dictionary is recorded.'''
+    MISSING = object()
+
+    def __init__(self):
+        self.entries = None  # None when not recording
+
+    def start(self):
+        self.entries = []
+
+    def record(self, dictionary, key):
+        '''Records the entry key of dictionary before it is changed.'''
+        if self.entries is not None:
+            self.entries.append((dictionary, key,
+                                 dictionary.get(key, UndoJournal.MISSING)))
+
+    def commit(self):
+        self.entries = None
+
+    def rollback(self):
+        if self.entries is None:
+            return
+        for dictionary, key, val in reversed(self.entries):
+            if val is UndoJournal.MISSING:
+                dictionary.pop(key, None)
+            else:
+                dictionary[key] = val
+        self.entries = None
+
+
+class BloomFilter(object):
+    '''A Bloom filter of strings sized for capacity entries at the given
+    false positive rate. Membership tests never give false negatives.'''
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                      (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity *
+                                           math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        '''Returns the bit positions for key using double hashing.'''
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        hash1, hash2 = struct.unpack_from(b'<QQ', hashlib.md5(key).digest())
+        return [(hash1 + i * hash2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        '''Adds key to the filter.'''
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
 
-    def __contains__(self, x):
-        return x in self.list
-
-    def __repr__(self):
-        return str(self.index)
+    def __len__(self):
+        return self.count
 
 
 def meta_factory(base, tag, *args, **kwargs):
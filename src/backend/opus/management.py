@@ -39,7 +39,8 @@ def _startup_touch_file(touch_file):
 
     header.payload_len = term_msg.ByteSize()
 
-    return header.dumps(), term_msg.SerializeToString()
+    return (messaging.HeaderRecord(*header.self_to_tuple()),
+            term_msg.SerializeToString())
 
 
 def _shutdown_touch_file(touch_file):
@@ -55,7 +56,11 @@ class DaemonManager(object):
         self.router = ipc.Router(queue_class=multiprocessing.Queue)
         self.router.run_forever()
 
-        self.pf_queue = ProducerFetcherQueue()
+        if "PFQueue" in config_util.safe_read_config(self.config, "MODULES"):
+            self.pf_queue = config_util.load_module(config, "PFQueue",
+                                                    ProducerFetcherQueue)
+        else:
+            self.pf_queue = ProducerFetcherQueue()
 
         analyser_ctlr_cfg = config_util.safe_read_config(self.config,
                                                          "ANALYSER_CONTROLLER")
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+'''
+In memory implementation of the storage interface. The provenance graph is
+held in Python lists and periodically snapshotted to a file, it needs no JVM
+and no database.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import bisect
+import cPickle as pickle
+import logging
+import os
+import time
+
+from .exception import OPUSException
+from .storage import StorageIFace, SCHEMA_VERSION
+
+_MISSING = object()
+
+
+class _NodeRecord(object):
+    '''Properties and adjacency lists of a node, the adjacency lists map a
+    relationship type to relationship IDs in creation order'''
+    __slots__ = ('props', 'rels_out', 'rels_in')
+
+    def __init__(self, props=None):
+        self.props = {} if props is None else props
+        self.rels_out = {}
+        self.rels_in = {}
+
+
+class _RelRecord(object):
+    '''Endpoints, type and properties of a relationship'''
+    __slots__ = ('start', 'end', 'type', 'props')
+
+    def __init__(self, start, end, rel_type, props=None):
+        self.start = start
+        self.end = end
+        self.type = rel_type
+        self.props = {} if props is None else props
+
+
+class MemoryRelView(object):
+    '''The relationships of a node, optionally restricted to one type'''
+    __slots__ = ('iface', 'node_id', 'rel_type')
+
+    def __init__(self, iface, node_id, rel_type=None):
+        self.iface = iface
+        self.node_id = node_id
+        self.rel_type = rel_type
+
+    def _rels(self, adj):
+        if self.rel_type is not None:
+            rel_ids = adj.get(self.rel_type, ())
+        elif len(adj) == 1:
+            rel_ids = adj.values()[0]
+        else:
+            rel_ids = sorted(rel_id for lst in adj.values() for rel_id in lst)
+        return [MemoryRelationship(self.iface, rel_id) for rel_id in rel_ids]
+
+    @property
+    def incoming(self):
+        '''Relationships ending at the node'''
+        return self._rels(self.iface.nodes[self.node_id].rels_in)
+
+    @property
+    def outgoing(self):
+        '''Relationships starting at the node'''
+        return self._rels(self.iface.nodes[self.node_id].rels_out)
+
+    def create(self, rel_type, to_node):
+        '''Creates a relationship of rel_type from the node to to_node'''
+        return self.iface.new_relationship(self.node_id, to_node.id,
+                                           rel_type)
+
+
+class MemoryNode(object):
+    '''Node proxy, reads and writes go to the node's record'''
+    __slots__ = ('iface', 'id')
+
+    def __init__(self, iface, node_id):
+        self.iface = iface
+        self.id = node_id
+
+    @property
+    def relationships(self):
+        return MemoryRelView(self.iface, self.id)
+
+    def __getattr__(self, name):
+        # Relationship types are upper case, e.g. node.PROC_OBJ.incoming
+        if name.isupper():
+            return MemoryRelView(self.iface, self.id, name)
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        val = self.iface.nodes[self.id].props[key]
+        return list(val) if isinstance(val, list) else val
+
+    def __setitem__(self, key, val):
+        if isinstance(val, (list, tuple)):
+            val = list(val)
+        self.iface.set_prop(self.iface.nodes[self.id],
+                            self.id >= self.iface.node_mark, key, val)
+
+    def has_key(self, key):
+        return key in self.iface.nodes[self.id].props
+
+    def __contains__(self, key):
+        return key in self.iface.nodes[self.id].props
+
+    def keys(self):
+        return self.iface.nodes[self.id].props.keys()
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryNode) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<MemoryNode %d>" % self.id
+
+
+class MemoryRelationship(object):
+    '''Relationship proxy, has no relationships attribute so the cache
+    manager can tell it apart from a node'''
+    __slots__ = ('iface', 'id')
+
+    def __init__(self, iface, rel_id):
+        self.iface = iface
+        self.id = rel_id
+
+    @property
+    def start(self):
+        return MemoryNode(self.iface, self.iface.rels[self.id].start)
+
+    @property
+    def end(self):
+        return MemoryNode(self.iface, self.iface.rels[self.id].end)
+
+    @property
+    def type(self):
+        return self.iface.rels[self.id].type
+
+    def __getitem__(self, key):
+        return self.iface.rels[self.id].props[key]
+
+    def __setitem__(self, key, val):
+        self.iface.set_prop(self.iface.rels[self.id],
+                            self.id >= self.iface.rel_mark, key, val)
+
+    def has_key(self, key):
+        return key in self.iface.rels[self.id].props
+
+    def delete(self):
+        '''Deletes the relationship'''
+        self.iface.del_relationship(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryRelationship) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<MemoryRelationship %d>" % self.id
+
+
+class InMemoryGraphInterface(StorageIFace):
+    '''In memory implementation of storage interface. Node and relationship
+    records are held in lists indexed by their integer IDs with per type
+    adjacency lists on each node. Changes made in a transaction are
+    journalled so a failed transaction can be undone. When filename is
+    given the graph is restored from it on start and written back to it
+    every snapshot_interval_s seconds and on close. Periodic snapshots are
+    written by a forked child, which sees a copy on write image of the
+    graph, so commits do not wait for them.'''
+
+    SNAPSHOT_FILE = "opus.graph"
+
+    def __init__(self, filename=None, snapshot_interval_s=300,
+                 cache_sizes=None, name_filter_capacity=10000000,
+                 name_filter_error_rate=0.001, packed_events=False,
+                 index_event_times=True, packed_flush_events=1000,
+                 packed_flush_span_ms=1000, name_filter_dump_interval_s=600,
+                 **kwargs):
+        super(InMemoryGraphInterface, self).__init__(
+            cache_sizes, name_filter_capacity, name_filter_error_rate,
+            packed_events, index_event_times, packed_flush_events,
+            packed_flush_span_ms, name_filter_dump_interval_s, **kwargs)
+        # filename may still name a database directory of another backend
+        if filename is not None and os.path.isdir(filename):
+            filename = os.path.join(filename,
+                                    InMemoryGraphInterface.SNAPSHOT_FILE)
+        self.filename = filename
+        self.snapshot_interval = snapshot_interval_s  # Configurable
+        self.last_snapshot = time.time()
+        self.snapshot_pid = None  # Child writing a background snapshot
+
+        self.nodes = []
+        self.rels = []
+
+        # (idx_type, idx_name) -> key -> node IDs in the order indexed, with
+        # the same IDs as a set in index_members for membership tests.
+        # Sorted key lists for range lookups are rebuilt when a key is added.
+        self.indexes = {}
+        self.index_members = {}
+        self.sorted_keys = {}
+
+        # Undo journal of the current transaction, records created in the
+        # transaction are dropped by truncating back to the marks
+        self.journal = None
+        self.node_mark = 0
+        self.rel_mark = 0
+
+        if self.filename is not None and os.path.isfile(self.filename):
+            self.__restore()
+
+    def close(self):
+        '''Writes a final snapshot'''
+        super(InMemoryGraphInterface, self).close()
+        if self.filename is not None:
+            self.snapshot()
+
+    def _transaction(self):
+        '''Returns an in memory transaction'''
+
+        class MemoryTransaction(object):
+
+            def __init__(self, iface):
+                self.iface = iface
+
+            def __enter__(self, *args, **kwargs):
+                self.iface.journal = []
+                self.iface.node_mark = len(self.iface.nodes)
+                self.iface.rel_mark = len(self.iface.rels)
+
+            def __exit__(self, exc_type, *args):
+                if exc_type is not None:
+                    self.iface.rollback()
+                self.iface.journal = None
+
+        return MemoryTransaction(self)
+
+    def _end_transaction(self, failed):
+        '''Starts a background snapshot once snapshot_interval_s has passed
+        since the last one'''
+        super(InMemoryGraphInterface, self)._end_transaction(failed)
+        if (not failed and self.filename is not None and
+                time.time() - self.last_snapshot >= self.snapshot_interval):
+            self.__start_snapshot()
+
+    def rollback(self):
+        '''Undoes the changes made by the current transaction'''
+        for entry in reversed(self.journal):
+            kind = entry[0]
+            if kind == 'prop':
+                _, props, key, old = entry
+                if old is _MISSING:
+                    del props[key]
+                else:
+                    props[key] = old
+            elif kind == 'adj':
+                # The relationship may have been deleted again
+                if entry[2] in entry[1]:
+                    entry[1].remove(entry[2])
+            elif kind == 'del':
+                _, rel_id, rec = entry
+                self.rels[rel_id] = rec
+                self.__link(rel_id, rec)
+            elif kind == 'idx':
+                _, key_map, member_map, key, node_id = entry
+                key_map[key].remove(node_id)
+                member_map[key].discard(node_id)
+                if not key_map[key]:
+                    del key_map[key]
+                    del member_map[key]
+        del self.nodes[self.node_mark:]
+        del self.rels[self.rel_mark:]
+        self.sorted_keys = {}
+
+    def set_prop(self, rec, created, key, val):
+        '''Sets a property of a record, journalling the old value unless the
+        record was created in the current transaction'''
+        if self.journal is not None and not created:
+            self.journal.append(('prop', rec.props, key,
+                                 rec.props.get(key, _MISSING)))
+        rec.props[key] = val
+
+    def __link(self, rel_id, rec):
+        '''Adds a relationship to the adjacency lists of its endpoints'''
+        out_lst = self.nodes[rec.start].rels_out.setdefault(rec.type, [])
+        in_lst = self.nodes[rec.end].rels_in.setdefault(rec.type, [])
+        bisect.insort(out_lst, rel_id)
+        bisect.insort(in_lst, rel_id)
+        return out_lst, in_lst
+
+    def new_relationship(self, start_id, end_id, rel_type):
+        '''Creates a relationship'''
+        rel_id = len(self.rels)
+        rec = _RelRecord(start_id, end_id, rel_type)
+        self.rels.append(rec)
+        out_lst, in_lst = self.__link(rel_id, rec)
+        if self.journal is not None:
+            if start_id < self.node_mark:
+                self.journal.append(('adj', out_lst, rel_id))
+            if end_id < self.node_mark:
+                self.journal.append(('adj', in_lst, rel_id))
+        return MemoryRelationship(self, rel_id)
+
+    def del_relationship(self, rel_id):
+        '''Deletes a relationship'''
+        rec = self.rels[rel_id]
+        if rec is None:
+            return
+        self.nodes[rec.start].rels_out[rec.type].remove(rel_id)
+        self.nodes[rec.end].rels_in[rec.type].remove(rel_id)
+        self.rels[rel_id] = None
+        if self.journal is not None and rel_id < self.rel_mark:
+            self.journal.append(('del', rel_id, rec))
+
+    def _new_node(self):
+        '''Creates a node, the node ID is its position in the node list'''
+        node_id = len(self.nodes)
+        self.nodes.append(_NodeRecord({'node_id': node_id}))
+        return MemoryNode(self, node_id)
+
+    def _write_index(self, idx_type, idx_name, idx_key, idx_val):
+        '''Adds an entry to the index'''
+        key_map = self.indexes.setdefault((idx_type, idx_name), {})
+        member_map = self.index_members.setdefault((idx_type, idx_name), {})
+        node_ids = key_map.get(idx_key)
+        if node_ids is None:
+            node_ids = key_map[idx_key] = []
+            member_map[idx_key] = set()
+            self.sorted_keys.pop((idx_type, idx_name), None)
+        elif idx_val.id in member_map[idx_key]:
+            return
+        node_ids.append(idx_val.id)
+        member_map[idx_key].add(idx_val.id)
+        if self.journal is not None:
+            self.journal.append(('idx', key_map, member_map, idx_key,
+                                 idx_val.id))
+
+    def get_latest_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the node with the highest node ID indexed under the key,
+        or None'''
+        node_ids = self.indexes.get((idx_type, idx_name), {}).get(idx_key)
+        if not node_ids:
+            return None
+        return MemoryNode(self, max(node_ids))
+
+    def get_indexed_range(self, idx_type, idx_name, start_key, end_key):
+        '''Returns the nodes indexed with keys between start_key and end_key
+        inclusive, in key order'''
+        key_map = self.indexes.get((idx_type, idx_name), {})
+        keys = self.sorted_keys.get((idx_type, idx_name))
+        if keys is None:
+            keys = self.sorted_keys[(idx_type, idx_name)] = sorted(key_map)
+        lo = bisect.bisect_left(keys, start_key)
+        hi = bisect.bisect_right(keys, end_key)
+        return [MemoryNode(self, node_id)
+                for key in keys[lo:hi]
+                for node_id in sorted(key_map[key])]
+
+    def get_index_keys(self, idx_type, idx_name):
+        '''Returns every key in the index'''
+        return self.indexes.get((idx_type, idx_name), {}).keys()
+
+    def get_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the nodes indexed under the key in node ID order'''
+        node_ids = self.indexes.get((idx_type, idx_name), {}).get(idx_key, ())
+        return [MemoryNode(self, node_id) for node_id in sorted(node_ids)]
+
+    def _load_ref(self, kind, ref_id):
+        '''Returns the node ('n') or relationship ('r') with the given
+        ID, raises KeyError if it does not exist'''
+        store = self.nodes if kind == 'n' else self.rels
+        if ref_id < 0 or ref_id >= len(store) or store[ref_id] is None:
+            raise KeyError(ref_id)
+        if kind == 'n':
+            return MemoryNode(self, ref_id)
+        return MemoryRelationship(self, ref_id)
+
+    def __write_snapshot(self):
+        '''Writes the graph to filename. Only properties, relationship
+        endpoints and indexes are stored, adjacency lists are rebuilt on
+        restore. The file is replaced atomically.'''
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "wb") as fh:
+            pickle.dump((SCHEMA_VERSION,
+                         [rec.props for rec in self.nodes],
+                         [None if rec is None else
+                          (rec.start, rec.end, rec.type, rec.props)
+                          for rec in self.rels],
+                         self.indexes),
+                        fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.filename)
+
+    def __wait_snapshot(self, block):
+        '''Reaps the background snapshot child, returns False if it is
+        still running'''
+        if self.snapshot_pid is None:
+            return True
+        pid, status = os.waitpid(self.snapshot_pid,
+                                 0 if block else os.WNOHANG)
+        if pid == 0:
+            return False
+        self.snapshot_pid = None
+        if status != 0:
+            logging.error("Background snapshot to %s failed with status %d",
+                          self.filename, status)
+        return True
+
+    def __start_snapshot(self):
+        '''Forks a child that writes the snapshot, unless one is still
+        running'''
+        if not self.__wait_snapshot(False):
+            return
+        self.last_snapshot = time.time()
+        try:
+            pid = os.fork()
+        except OSError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            return
+        if pid == 0:
+            # Only this thread exists in the child, so it must not take
+            # locks such as the logging lock
+            status = 1
+            try:
+                self.__write_snapshot()
+                status = 0
+            finally:
+                os._exit(status)
+        self.snapshot_pid = pid
+
+    def snapshot(self):
+        '''Writes the graph to filename, waiting for any background snapshot
+        to complete first'''
+        self.__wait_snapshot(True)
+        try:
+            self.__write_snapshot()
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("OPUS file open error, %s", self.filename)
+        self.last_snapshot = time.time()
+        if __debug__:
+            logging.debug("Snapshot of %d nodes and %d relationships "
+                          "written to %s", len(self.nodes), len(self.rels),
+                          self.filename)
+
+    def __restore(self):
+        '''Loads the graph from the snapshot in filename'''
+        try:
+            with open(self.filename, "rb") as fh:
+                version, nodes, rels, self.indexes = pickle.load(fh)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("OPUS file open error, %s", self.filename)
+        if version != SCHEMA_VERSION:
+            raise OPUSException("Snapshot %s has schema version %d, "
+                                "expected %d" % (self.filename, version,
+                                                 SCHEMA_VERSION))
+
+        self.nodes = [_NodeRecord(props) for props in nodes]
+        for rel_id, rel in enumerate(rels):
+            if rel is None:
+                self.rels.append(None)
+                continue
+            rec = _RelRecord(*rel)
+            self.rels.append(rec)
+            self.nodes[rec.start].rels_out.setdefault(rec.type,
+                                                      []).append(rel_id)
+            self.nodes[rec.end].rels_in.setdefault(rec.type,
+                                                   []).append(rel_id)
+        self.index_members = {
+            idx: {key: set(node_ids) for key, node_ids in key_map.items()}
+            for idx, key_map in self.indexes.items()}
+        logging.info("Restored %d nodes and %d relationships from %s",
+                     len(self.nodes), len(self.rels), self.filename)
@@ -84,33 +84,54 @@ def _rewind(n):
 
 def monitor_status(helper, follow):
     pay = helper.make_request({'cmd': 'status'})
-    print_status_rsp(pay)
-    n = (len(pay) - 1) + (len(pay['analyser']) - 1)
+    n = print_status_rsp(pay)
     while follow:
         _rewind(n)
         print("\n".join([" "*50]*n))
         _rewind(n)
         pay = helper.make_request({'cmd': 'status'})
-        print_status_rsp(pay)
-        n = (len(pay) - 1) + (len(pay['analyser']) - 1)
+        n = print_status_rsp(pay)
         sys.stdout.flush()
         time.sleep(1)
 
 
 def print_status_rsp(pay):
-    '''Prints status response to stdout'''
-    print("{0:<20} {1:<12}".format("Producer", pay['producer']['status']))
+    '''Prints status response to stdout, returns the number of lines
+    printed'''
+    lines = []
+    tmp_pr = pay['producer']
+    lines.append("{0:<20} {1:<12}".format("Producer", tmp_pr['status']))
+    if 'queue_msgs' in tmp_pr:
+        lines.append("    {:d} msgs, {:d} bytes pending".format(
+            tmp_pr['queue_msgs'], tmp_pr['queue_bytes']))
+    if 'stall_time' in tmp_pr:
+        lines.append("    {:.1f}s stalled{}".format(
+            tmp_pr['stall_time'],
+            " (stalled now)" if tmp_pr['queue_stalled'] else ""))
 
     tmp_an = pay['analyser']
-    print("{0:<20} {1:<12}".format("Analyser", tmp_an['status']))
+    lines.append("{0:<20} {1:<12}".format("Analyser", tmp_an['status']))
     if 'num_msgs' in tmp_an:
-        print("    {:d} msgs in queue".format(tmp_an['num_msgs']))
+        lines.append("    {:d} msgs in queue".format(tmp_an['num_msgs']))
     if 'inbound_rate' in tmp_an:
-        print("    {:.1f}/s msgs added".format(tmp_an['inbound_rate']))
+        lines.append("    {:.1f}/s msgs added".format(
+            tmp_an['inbound_rate']))
     if 'outbound_rate' in tmp_an:
-        print("    {:.1f}/s msgs processed".format(tmp_an['outbound_rate']))
-
-    print("{0:<20} {1:<12}".format("Query Interface", pay['query']['status']))
+        lines.append("    {:.1f}/s msgs processed".format(
+            tmp_an['outbound_rate']))
+    for name, cache in sorted(tmp_an.get('caches', {}).items()):
+        lookups = cache['hits'] + cache['misses']
+        lines.append("    {} cache: {:d}/{} entries, {:.1f}% hits, "
+                     "{:d} evicted".format(
+                         name, cache['size'],
+                         cache['capacity'] if cache['capacity'] else "-",
+                         (100.0 * cache['hits'] / lookups) if lookups else 0,
+                         cache['evictions']))
+
+    lines.append("{0:<20} {1:<12}".format("Query Interface",
+                                          pay['query']['status']))
+    print("\n".join(lines))
+    return len(lines)
 
 
 @config.auto_read_config
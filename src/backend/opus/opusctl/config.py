@@ -88,6 +88,20 @@ LOGGING:
 MODULES:
   Producer: SocketProducer
   Analyser: StatisticsAnalyser
+  PFQueue: ProducerFetcherQueue
+
+PFQUEUE:
+  ProducerFetcherQueue:
+    high_msgs: 1000000
+    low_msgs: 500000
+    high_bytes: 536870912
+    low_bytes: 268435456
+  ShmProducerFetcherQueue:
+    capacity: 67108864
+    high_msgs: 1000000
+    low_msgs: 500000
+    high_bytes: 536870912
+    low_bytes: 268435456
 
 PRODUCER:
   SocketProducer:
@@ -96,14 +110,49 @@ PRODUCER:
         addr: {server_addr}
         max_conn: 10
         select_timeout: 5.0
+        reader_type: BufferedSockReader
+        drain: true
+        drain_budget: 1048576
+  ShardedSocketProducer:
+    comm_mgr_type: ShardedCommunicationManager
+    comm_mgr_args:
+        addr: {server_addr}
+        num_shards: 4
+        max_conn: 10
+        select_timeout: 5.0
+        reader_type: BufferedSockReader
+        drain: true
+        drain_budget: 1048576
 
 ANALYSER:
   StatisticsAnalyser:
     storage_type: DBInterface
     storage_args:
       filename: {db_path}
+      id_block_size: 10000
+      cache_sizes:
+        VALID_LOCAL: 100000
+        LOCAL_GLOBAL: 100000
+        LAST_EVENT: 100000
+        NODE_BY_ID: 200000
+        IO_EVENT_CHAIN: 50000
+        GLOB_SUCCESSOR: 200000
+        META_SNAPSHOT: 10000
+      name_filter_capacity: 10000000
+      name_filter_error_rate: 0.001
+      name_filter_dump_interval_s: 600
+      packed_events: false
+      packed_flush_events: 1000
+      packed_flush_span_ms: 1000
+      index_event_times: true
+      migration_batch_size: 500
     opus_lite: true
     opus_snapshot_dir: {opus_home}
+    batch_size: 100
+    batch_time_ms: 50
+    lazy_fd_inherit: true
+    coalesce_events: false
+    coalesce_window_ms: 10
 
 ANALYSER_CONTROLLER:
   mem_mon_params:
@@ -62,11 +62,21 @@ class EventOrderer(object):
             if self._extract_cond():
                 self.q_over_min.notify()
 
-    def pop(self):
-        '''Pop the message from the queue with the lowest priority.'''
+    def pop(self, timeout=None):
+        '''Pop the message from the queue with the lowest priority. If
+        timeout is given returns None when no message could be extracted
+        within timeout seconds.'''
         with self.q_over_min:
-            while not self._extract_cond():
-                self.q_over_min.wait()
+            if timeout is None:
+                while not self._extract_cond():
+                    self.q_over_min.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self._extract_cond():
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.q_over_min.wait(remaining)
             item = self.priority_queue.get(False)
             return item
 
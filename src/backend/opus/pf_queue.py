@@ -2,6 +2,7 @@
 '''
 This module wraps the python Queue class with helper methods
 necessary to work in a single producer and consumer scenario.
+It also contains a shared memory ring buffer based alternative.
 '''
 
 from __future__ import (absolute_import, division,
@@ -9,19 +10,55 @@ from __future__ import (absolute_import, division,
 
 import logging
 import collections
+import mmap
+import struct
+import time
+import Queue
 
-from multiprocessing import Queue as MPQueue, Event, Condition
+from multiprocessing import (Queue as MPQueue, Event, Condition,
+                             Lock, Semaphore, Value)
+
+from . import messaging
 
 class ProducerFetcherQueue(object):
-    '''Wrapper around multiprocessing Queue'''
+    '''Wrapper around multiprocessing Queue. The queue tracks the number
+    of messages and bytes that have been enqueued but not yet processed by
+    the analyser. When high watermarks are configured the producer stalls
+    once either depth reaches its high mark and resumes when both are
+    back below their low marks.'''
 
-    def __init__(self):
+    def __init__(self, high_msgs=None, low_msgs=None,
+                 high_bytes=None, low_bytes=None):
         super(ProducerFetcherQueue, self).__init__()
-        self.pf_queue = MPQueue()
-        self.pfq_cond = Condition()
         self.clear_event = Event()
         self.event_exe = collections.namedtuple('Event', 'event excep')
 
+        self.high_msgs = high_msgs  # Configurable
+        self.low_msgs = low_msgs  # Configurable
+        if self.low_msgs is None and self.high_msgs is not None:
+            self.low_msgs = self.high_msgs // 2
+        self.high_bytes = high_bytes  # Configurable
+        self.low_bytes = low_bytes  # Configurable
+        if self.low_bytes is None and self.high_bytes is not None:
+            self.low_bytes = self.high_bytes // 2
+        self.watermarks = (self.high_msgs is not None or
+                           self.high_bytes is not None)
+
+        self.depth_lock = Lock()
+        self.depth_msgs = Value(str('l'), 0, lock=False)
+        self.depth_bytes = Value(str('l'), 0, lock=False)
+        self.stalled = Value(str('i'), 0, lock=False)
+        self.stall_start = Value(str('d'), 0.0, lock=False)
+        self.stall_time = Value(str('d'), 0.0, lock=False)
+        self.resume_event = Event()
+
+        self._create_queue()
+
+    def _create_queue(self):
+        '''Creates the underlying queue, override in the derived class'''
+        self.pf_queue = MPQueue()
+        self.pfq_cond = Condition()
+
     def enqueue(self, msg):
         with self.pfq_cond:
             if self.clear_event.is_set():
@@ -30,6 +67,7 @@ class ProducerFetcherQueue(object):
                 return
             self.pf_queue.put(msg)
             self.pfq_cond.notify()
+        self._add_depth(msg)
 
     def dequeue(self):
         with self.pfq_cond:
@@ -61,3 +99,317 @@ class ProducerFetcherQueue(object):
 
     def get_queue_size(self):
         return self.pf_queue.qsize()
+
+    def _add_depth(self, msg):
+        num_bytes = sum(messaging.HeaderRecord.length + len(pay)
+                        for _, pay in msg)
+        with self.depth_lock:
+            self.depth_msgs.value += len(msg)
+            self.depth_bytes.value += num_bytes
+
+    def _above_high(self):
+        return ((self.high_msgs is not None and
+                 self.depth_msgs.value >= self.high_msgs) or
+                (self.high_bytes is not None and
+                 self.depth_bytes.value >= self.high_bytes))
+
+    def _below_low(self):
+        return ((self.low_msgs is None or
+                 self.depth_msgs.value <= self.low_msgs) and
+                (self.low_bytes is None or
+                 self.depth_bytes.value <= self.low_bytes))
+
+    def _resume(self):
+        '''Ends a stall, must be called with depth_lock held'''
+        self.stall_time.value += time.time() - self.stall_start.value
+        self.stalled.value = 0
+        self.resume_event.set()
+        logging.info("Producer fetcher queue below low watermark, "
+                     "resuming producer")
+
+    def release(self, num_msgs, num_bytes):
+        '''Marks messages as processed by the analyser'''
+        with self.depth_lock:
+            self.depth_msgs.value = max(0, self.depth_msgs.value - num_msgs)
+            self.depth_bytes.value = max(0, self.depth_bytes.value - num_bytes)
+            if self.stalled.value and self._below_low():
+                self._resume()
+
+    def wait_below_watermark(self, timeout):
+        '''Called by the producer before reading more messages. Returns
+        True if reading may continue, otherwise waits up to timeout
+        seconds for the queue to drain below its low watermarks and
+        returns False if it has not.'''
+        if not self.watermarks:
+            return True
+
+        with self.depth_lock:
+            if not self.stalled.value:
+                if not self._above_high():
+                    return True
+                self.stalled.value = 1
+                self.stall_start.value = time.time()
+                self.resume_event.clear()
+                logging.info("Producer fetcher queue above high watermark, "
+                             "stalling producer")
+
+        self.resume_event.wait(timeout)
+        with self.depth_lock:
+            if self.stalled.value and self._below_low():
+                self._resume()
+            return not self.stalled.value
+
+    def get_status(self):
+        '''Returns the queue depth and producer stall statistics'''
+        with self.depth_lock:
+            stall_time = self.stall_time.value
+            if self.stalled.value:
+                stall_time += time.time() - self.stall_start.value
+            return {'queue_msgs': self.depth_msgs.value,
+                    'queue_bytes': self.depth_bytes.value,
+                    'queue_stalled': bool(self.stalled.value),
+                    'stall_time': stall_time}
+
+
+class SharedRingBuffer(object):
+    '''Ring of (header, payload) frames in an anonymous shared memory
+    mapping. Each frame is the payload length, the packed header record
+    and the payload. The mapping is inherited by processes forked
+    after creation. Writers are serialised by a lock, there must only be
+    a single reader. Positions are byte counts that only ever increase,
+    each is written by one side only and read by the other.
+
+    A side that has to wait sets its waiting flag, checks the ring again
+    and then sleeps on a semaphore that the other side posts once it has
+    made progress.'''
+    CTRL_SIZE = 128
+    WRITER_CTRL = struct.Struct(str("QQQ"))  # write_pos, written, waiting
+    READER_CTRL = struct.Struct(str("QQQ"))  # read_pos, read, waiting
+    READER_CTRL_OFFSET = 64
+    WAITING = struct.Struct(str("Q"))
+    WAITING_OFFSET = 16  # Of the waiting field within either ctrl block
+    FRAME_HDR = struct.Struct(str("I"))  # payload length
+    WRAP_MARKER = 0xFFFFFFFF
+    WAIT_TIMEOUT = 1.0
+
+    def __init__(self, capacity):
+        super(SharedRingBuffer, self).__init__()
+        self.capacity = capacity
+        self.shm = mmap.mmap(-1, self.CTRL_SIZE + capacity)
+        self.write_lock = Lock()
+        self.data_sem = Semaphore(0)
+        self.space_sem = Semaphore(0)
+
+    def _writer_ctrl(self):
+        return self.WRITER_CTRL.unpack_from(self.shm, 0)
+
+    def _reader_ctrl(self):
+        return self.READER_CTRL.unpack_from(self.shm,
+                                            self.READER_CTRL_OFFSET)
+
+    def _set_writer_ctrl(self, write_pos, written, waiting):
+        self.WRITER_CTRL.pack_into(self.shm, 0, write_pos, written, waiting)
+
+    def _set_reader_ctrl(self, read_pos, read, waiting):
+        self.READER_CTRL.pack_into(self.shm, self.READER_CTRL_OFFSET,
+                                   read_pos, read, waiting)
+
+    def _clear_reader_waiting(self):
+        '''Clears only the waiting field so the read position the reader
+        may be updating is left alone.'''
+        self.WAITING.pack_into(self.shm, self.READER_CTRL_OFFSET +
+                               self.WAITING_OFFSET, 0)
+
+    def frame_size(self, pay):
+        return (self.FRAME_HDR.size + messaging.HeaderRecord.length +
+                len(pay))
+
+    def _space_needed(self, write_pos, size):
+        '''Returns the bytes needed to place a frame of size at write_pos,
+        including any padding to skip to the start of the ring.'''
+        to_end = self.capacity - (write_pos % self.capacity)
+        if to_end < size:
+            return to_end + size
+        return size
+
+    def used(self):
+        write_pos, _, _ = self._writer_ctrl()
+        read_pos, _, _ = self._reader_ctrl()
+        return write_pos - read_pos
+
+    def count(self):
+        _, written, _ = self._writer_ctrl()
+        _, read, _ = self._reader_ctrl()
+        return written - read
+
+    def fits(self, pay):
+        '''Returns True if a frame for pay can always be placed. A frame
+        larger than half the ring may need more than the whole ring once
+        the padding to skip to its start is added, so it could never be
+        written.'''
+        return self.frame_size(pay) <= self.capacity // 2
+
+    def put(self, msg_list, abort_event):
+        '''Writes each (header, payload) pair of msg_list to the ring,
+        waiting for space as needed. Messages that do not fit in the ring
+        are dropped and writing stops if abort_event is set. Returns the
+        number of messages written, these are the leading messages of
+        msg_list that fit. The reader is woken once, after the last frame
+        is published.'''
+        num_written = 0
+        with self.write_lock:
+            try:
+                for hdr, pay in msg_list:
+                    size = self.frame_size(pay)
+                    if not self.fits(pay):
+                        logging.error("Dropping message of %d bytes, larger "
+                                      "than half the queue capacity", size)
+                        continue
+                    if not self._wait_for_space(size, abort_event):
+                        break
+                    self._write_frame(hdr, pay, size)
+                    num_written += 1
+            finally:
+                self._notify_reader()
+        return num_written
+
+    def _wait_for_space(self, size, abort_event):
+        while True:
+            write_pos, written, waiting = self._writer_ctrl()
+            needed = self._space_needed(write_pos, size)
+            if self.capacity - self.used() >= needed:
+                if waiting:
+                    self._set_writer_ctrl(write_pos, written, 0)
+                return True
+            if abort_event.is_set():
+                return False
+            self._set_writer_ctrl(write_pos, written, 1)
+            if self.capacity - self.used() >= needed:
+                continue
+            self.space_sem.acquire(True, self.WAIT_TIMEOUT)
+
+    def _write_frame(self, hdr, pay, size):
+        write_pos, written, waiting = self._writer_ctrl()
+        offset = write_pos % self.capacity
+        to_end = self.capacity - offset
+        if to_end < size:
+            if to_end >= self.FRAME_HDR.size:
+                self.FRAME_HDR.pack_into(self.shm, self.CTRL_SIZE + offset,
+                                         self.WRAP_MARKER)
+            write_pos += to_end
+            offset = 0
+
+        start = self.CTRL_SIZE + offset
+        self.FRAME_HDR.pack_into(self.shm, start, len(pay))
+        start += self.FRAME_HDR.size
+        hdr.pack_into(self.shm, start)
+        start += messaging.HeaderRecord.length
+        self.shm[start:start + len(pay)] = pay
+
+        # Publish the frame only once its contents are in place
+        self._set_writer_ctrl(write_pos + size, written + 1, waiting)
+
+    def _notify_reader(self):
+        '''Posts data_sem if the reader is waiting. The flag is cleared
+        first so that later puts do not post again before the reader has
+        run, which would leave it spinning on stale posts.'''
+        if self._reader_ctrl()[2]:
+            self._clear_reader_waiting()
+            self.data_sem.release()
+
+    def get_all(self):
+        '''Returns a list of all (header, payload) pairs in the ring'''
+        ret_list = []
+        hdr_len = messaging.HeaderRecord.length
+        write_pos, _, _ = self._writer_ctrl()
+        read_pos, read, waiting = self._reader_ctrl()
+
+        while read_pos < write_pos:
+            offset = read_pos % self.capacity
+            to_end = self.capacity - offset
+            if to_end < self.FRAME_HDR.size:
+                read_pos += to_end
+                continue
+            pay_len, = self.FRAME_HDR.unpack_from(self.shm,
+                                                  self.CTRL_SIZE + offset)
+            if pay_len == self.WRAP_MARKER:
+                read_pos += to_end
+                continue
+            start = self.CTRL_SIZE + offset + self.FRAME_HDR.size
+            hdr = messaging.HeaderRecord.loads_from(self.shm, start)
+            start += hdr_len
+            ret_list.append((hdr, self.shm[start:start + pay_len]))
+            read_pos += self.FRAME_HDR.size + hdr_len + pay_len
+
+        if ret_list:
+            self._set_reader_ctrl(read_pos, read + len(ret_list), waiting)
+            if self._writer_ctrl()[2]:
+                self.space_sem.release()
+        return ret_list
+
+    def wait_for_data(self):
+        '''Blocks until the ring may hold data or a wakeup is posted'''
+        read_pos, read, _ = self._reader_ctrl()
+        self._set_reader_ctrl(read_pos, read, 1)
+        if self.count() == 0:
+            self.data_sem.acquire(True, self.WAIT_TIMEOUT)
+        self._set_reader_ctrl(read_pos, read, 0)
+
+    def wakeup_reader(self):
+        self.data_sem.release()
+
+    def wakeup_writers(self):
+        self.space_sem.release()
+
+
+class ShmProducerFetcherQueue(ProducerFetcherQueue):
+    '''Producer fetcher queue backed by a shared memory ring buffer. This
+    avoids pickling every batch and the feeder thread of the
+    multiprocessing Queue. Dequeue returns all queued messages as a
+    single list.'''
+
+    def __init__(self, capacity=67108864, *args, **kwargs):
+        self.capacity = capacity  # Configurable, in bytes
+        self.ring = None
+        super(ShmProducerFetcherQueue, self).__init__(*args, **kwargs)
+
+    def _create_queue(self):
+        self.ring = SharedRingBuffer(self.capacity)
+
+    def enqueue(self, msg):
+        if self.clear_event.is_set():
+            if __debug__:
+                logging.debug("Cannot enqueue, queue is in clearing mode")
+            return
+        num_written = self.ring.put(msg, self.clear_event)
+        written = [frame for frame in msg
+                   if self.ring.fits(frame[1])][:num_written]
+        if len(written) < len(msg):
+            if __debug__:
+                logging.debug("Enqueued %d of %d messages",
+                              len(written), len(msg))
+        self._add_depth(written)
+
+    def dequeue(self):
+        while True:
+            if self.event_exe.event.is_set():
+                raise self.event_exe.excep
+            msg_list = self.ring.get_all()
+            if msg_list:
+                return msg_list
+            if self.clear_event.is_set():
+                raise Queue.Empty()
+            if __debug__:
+                logging.debug("Waiting on queue data")
+            self.ring.wait_for_data()
+
+    def start_clear(self):
+        self.clear_event.set()
+        self.ring.wakeup_reader()
+        self.ring.wakeup_writers()
+
+    def wakeup(self):
+        self.ring.wakeup_reader()
+
+    def get_queue_size(self):
+        return self.ring.count()
@@ -11,7 +11,10 @@ from __future__ import (absolute_import, division,
 
 
 import errno
+import fcntl
 import logging
+import os
+import Queue
 import select
 import socket
 import struct
@@ -70,11 +73,13 @@ def create_close_conn_obj(sock_obj, pid):
     header.payload_len = gen_msg.ByteSize()
     header.sys_time = int(time.time())
 
-    return header.dumps(), gen_msg.SerializeToString()
+    return (messaging.HeaderRecord(*header.self_to_tuple()),
+            gen_msg.SerializeToString())
 
 
 class SockReader(object):
-    '''Reads header and payload from a non-blocking socket'''
+    '''Reads header and payload from a non-blocking socket. Messages are
+    returned as a parsed messaging.HeaderRecord and the raw payload.'''
 
     def __init__(self, sock_obj):
         '''Initialize data members'''
@@ -93,15 +98,14 @@ class SockReader(object):
             if status_code != MultiCommunicationManager.StatusCode.success:
                 return status_code, None, None
 
-            # If header is fully received, construct the header object
-            if len(self.buf_data) == messaging.Header.length:
-                self.header = messaging.Header()
-                self.header.loads(self.buf_data)
+            # If header is fully received, construct the header record
+            if len(self.buf_data) == messaging.HeaderRecord.length:
+                self.header = messaging.HeaderRecord.loads(self.buf_data)
                 if __debug__:
                     logging.debug("Header: %s", self.header.__str__())
 
         # Account for header data already present
-        hdr_len = messaging.Header.length
+        hdr_len = messaging.HeaderRecord.length
         remaining_len = self.header.payload_len - (len(self.buf_data) -
                                                    hdr_len)
 
@@ -110,7 +114,7 @@ class SockReader(object):
         if status_code != MultiCommunicationManager.StatusCode.success:
             return status_code, None, None
 
-        hdr_buf = self.buf_data[:hdr_len]
+        header = self.header
         pay_buf = self.buf_data[hdr_len:]
 
         # Deserialization only needed for debugging during development
@@ -127,7 +131,7 @@ class SockReader(object):
         self.buf_data = b''
         self.header = None
 
-        return status_code, hdr_buf, pay_buf
+        return status_code, header, pay_buf
 
     def _fill_buffer(self, remaining_len):
         '''Calls receive and appends buffer'''
@@ -164,6 +168,11 @@ class SockReader(object):
             size -= len(data)
         return buf, status_code
 
+    def has_buffered_message(self):
+        '''Returns True if a complete message is already buffered and can
+        be returned without reading from the socket'''
+        return False
+
     def get_sock_obj(self):
         '''Returns socket object'''
         return self.sock_obj
@@ -173,6 +182,123 @@ class SockReader(object):
         self.sock_obj.close()
 
 
+class BufferedSockReader(SockReader):
+    '''Reads header and payload from a non-blocking socket into a
+    preallocated per-connection buffer using recv_into. Data is read in as
+    large chunks as are available and complete messages are sliced out of
+    the buffer, so each message is copied out exactly once.'''
+
+    def __init__(self, sock_obj, buf_size=131072):
+        '''Initialize data members'''
+        super(BufferedSockReader, self).__init__(sock_obj)
+        self.buf = bytearray(buf_size)
+        self.view = memoryview(self.buf)
+        self.read_pos = 0  # Start of the first unconsumed byte
+        self.write_pos = 0  # End of the received data
+
+    def get_message(self):
+        '''Returns the next complete message, reading from the socket only
+        if the buffer does not already contain one'''
+        status_code = MultiCommunicationManager.StatusCode.success
+
+        while True:
+            msg_len = self._buffered_msg_len()
+            if msg_len is not None:
+                return (status_code,) + self._pop_message(msg_len)
+
+            status_code = self._fill_buffer()
+            if status_code != MultiCommunicationManager.StatusCode.success:
+                return status_code, None, None
+
+    def has_buffered_message(self):
+        '''Returns True if a complete message is already buffered'''
+        return self._buffered_msg_len() is not None
+
+    def _buffered_msg_len(self):
+        '''Returns the total length of the message at the head of the
+        buffer if it has been fully received, else None'''
+        avail = self.write_pos - self.read_pos
+        hdr_len = messaging.HeaderRecord.length
+        if avail < hdr_len:
+            return None
+
+        if self.header is None:
+            self.header = messaging.HeaderRecord.loads_from(self.buf,
+                                                            self.read_pos)
+            if __debug__:
+                logging.debug("Header: %s", self.header.__str__())
+
+        msg_len = hdr_len + self.header.payload_len
+        if avail < msg_len:
+            self._reserve(msg_len)
+            return None
+        return msg_len
+
+    def _pop_message(self, msg_len):
+        '''Copies the payload at the head of the buffer out and
+        consumes the message'''
+        hdr_end = self.read_pos + messaging.HeaderRecord.length
+        msg_end = self.read_pos + msg_len
+
+        header = self.header
+        pay_buf = self.view[hdr_end:msg_end].tobytes()
+
+        self.header = None
+        if msg_end == self.write_pos:
+            self.read_pos = 0
+            self.write_pos = 0
+        else:
+            self.read_pos = msg_end
+        return header, pay_buf
+
+    def _reserve(self, msg_len):
+        '''Ensures there is room after read_pos for a message of msg_len
+        bytes, compacting or growing the buffer as required'''
+        if self.read_pos + msg_len <= len(self.buf):
+            return
+
+        avail = self.write_pos - self.read_pos
+        pending = self.view[self.read_pos:self.write_pos].tobytes()
+        if msg_len > len(self.buf):
+            if __debug__:
+                logging.debug("Growing socket buffer to %d bytes", msg_len)
+            self.view = None
+            self.buf = bytearray(msg_len)
+            self.view = memoryview(self.buf)
+        self.view[0:avail] = pending
+        self.read_pos = 0
+        self.write_pos = avail
+
+    def _fill_buffer(self):
+        '''Receives as much data as is available into the free space at the
+        end of the buffer'''
+        if self.write_pos == len(self.buf):
+            self._reserve(self.write_pos - self.read_pos + 1)
+
+        status_code = MultiCommunicationManager.StatusCode.success
+        while True:
+            try:
+                nbytes = self.sock_obj.recv_into(self.view[self.write_pos:])
+                if nbytes == 0:
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.close_connection
+                self.write_pos += nbytes
+            except socket.error as exc:
+                if exc.errno == errno.EAGAIN or exc.errno == errno.EWOULDBLOCK:
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.try_again_later
+                elif exc.errno == errno.EINTR:
+                    logging.error("Error: %d, Message: %s",
+                                  exc.errno, exc.strerror)
+                    continue
+                else:
+                    logging.error("Error: %d, Message: %s",
+                                  exc.errno, exc.strerror)
+                    status_code = \
+                        MultiCommunicationManager.StatusCode.close_connection
+            return status_code
+
+
 class CommunicationManager(object):
     '''Base class for the communication manager class'''
     def __init__(self):
@@ -196,6 +322,8 @@ class MultiCommunicationManager(CommunicationManager):
 
     def __init__(self, addr,
                  max_conn=10, select_timeout=5.0,
+                 reader_type="SockReader", reader_args=None,
+                 drain=False, drain_budget=1048576,
                  *args, **kwargs):
         '''Initialize the class members'''
         super(MultiCommunicationManager, self).__init__(*args, **kwargs)
@@ -204,8 +332,18 @@ class MultiCommunicationManager(CommunicationManager):
         self.addr = addr  # Configurable
         self.max_server_conn = max_conn  # Configurable
         self.select_timeout = select_timeout  # Configurable
+        self.reader_type = reader_type  # Configurable
+        self.reader_args = reader_args if reader_args is not None else {}
+        self.drain = drain  # Configurable
+        self.drain_budget = drain_budget  # Configurable, bytes per wakeup
+        self.pending = set()  # fds with complete messages left buffered
         self.server_socket = None
+        self.listen_fileno = None
+        self.epoll = select.epoll()
+        self._setup_listener()
 
+    def _setup_listener(self):
+        '''Binds the server socket and registers it with epoll'''
         try:
             self.server_socket = multisocket.MultiFamilySocket(
                 socket.SOCK_STREAM)
@@ -214,31 +352,39 @@ class MultiCommunicationManager(CommunicationManager):
         except socket.error as err:
             if self.server_socket:
                 self.server_socket.close()
+            self.epoll.close()
             logging.error("Error: %s %s", str(err), format_stack())
             raise OPUSException("socket error")
         self.server_socket.setblocking(0)  # Make the socket non-blocking
-        self.epoll = select.epoll()
-        self.epoll.register(self.server_socket.fileno(),
+        self.listen_fileno = self.server_socket.fileno()
+        self.epoll.register(self.listen_fileno,
                             select.EPOLLIN | select.EPOLLERR)
 
     def do_poll(self):
         '''Returns a list of tuples for all ready file descriptors'''
         ret_list = []  # List of tuples of form (header, payload)
 
+        # Connections that still hold buffered messages will not raise
+        # another event, so do not block if there are any.
+        pending = self.pending
+        self.pending = set()
+        timeout = 0 if pending else self.select_timeout
+
         try:
-            event_list = self.epoll.poll(self.select_timeout)
+            event_list = self.epoll.poll(timeout)
         except IOError as err:
             logging.error("Error: %s %s", str(err), format_stack())
-            return ret_list
+            event_list = []
 
-        if not event_list:
+        if not event_list and not pending:
             if __debug__:
                 logging.debug("epoll timed out")
             return ret_list
 
         for fileno, event in event_list:
-            if fileno == self.server_socket.fileno():
-                self._handle_new_connection()
+            pending.discard(fileno)
+            if fileno == self.listen_fileno:
+                self._handle_listener_event(ret_list)
             elif event & select.EPOLLIN:
                 sock_obj = self.input_client_map[fileno].get_sock_obj()
                 self._handle_client(sock_obj, ret_list)
@@ -247,17 +393,39 @@ class MultiCommunicationManager(CommunicationManager):
                     logging.debug("Got an EPOLLHUP event")
                 sock_obj = self.input_client_map[fileno].get_sock_obj()
                 self._handle_close_connection(sock_obj, ret_list)
+
+        for fileno in pending:
+            if fileno in self.input_client_map:
+                sock_obj = self.input_client_map[fileno].get_sock_obj()
+                self._handle_client(sock_obj, ret_list)
         return ret_list
 
     def _handle_client(self, sock_obj, ret_list):
-        '''Receives data from client or closes the client connection'''
+        '''Receives data from client or closes the client connection. In
+        drain mode all complete messages are read until the socket would
+        block or the per connection byte budget is used up, otherwise a
+        single message is read.'''
         sock_rdr = self.input_client_map[sock_obj.fileno()]
-        status_code, header_buf, payload_buf = sock_rdr.get_message()
+        budget = self.drain_budget if self.drain else 0
+        consumed = 0
+
+        while True:
+            status_code, header_buf, payload_buf = sock_rdr.get_message()
+            if status_code != self.StatusCode.success:
+                break
+            ret_list += [(header_buf, payload_buf)]
+            consumed += messaging.HeaderRecord.length + len(payload_buf)
+            if consumed >= budget:
+                break
 
         if status_code == self.StatusCode.success:
             if __debug__:
                 logging.debug("Got valid data")
-            ret_list += [(header_buf, payload_buf)]
+
+            # Buffered readers may have received more messages than were
+            # consumed, these will not trigger another epoll event.
+            if sock_rdr.has_buffered_message():
+                self.pending.add(sock_obj.fileno())
         elif status_code == self.StatusCode.close_connection:
             self._handle_close_connection(sock_obj, ret_list)
         elif status_code == self.StatusCode.try_again_later:
@@ -266,6 +434,7 @@ class MultiCommunicationManager(CommunicationManager):
 
     def _handle_close_connection(self, sock_obj, ret_list):
         '''Handles close event or hang up event on the client socket'''
+        self.pending.discard(sock_obj.fileno())
         self.epoll.unregister(sock_obj.fileno())
         if sock_obj.fileno() in self.input_client_map:
             del self.input_client_map[sock_obj.fileno()]
@@ -282,6 +451,10 @@ class MultiCommunicationManager(CommunicationManager):
             logging.debug('closing socket: %d', sock_obj.fileno())
         sock_obj.close()
 
+    def _handle_listener_event(self, ret_list):
+        '''Handles an event on the listening descriptor'''
+        self._handle_new_connection()
+
     def _handle_new_connection(self):
         '''Accepts and adds the new connection to the fd list'''
         client_fd, _ = self.server_socket.accept()
@@ -291,10 +464,16 @@ class MultiCommunicationManager(CommunicationManager):
                           " pid: %d, uid: %d, gid: %d",
                           pid, uid, gid)
         client_fd.setblocking(0)  # Make the socket non-blocking
+        self._add_connection(client_fd, pid)
+
+    def _add_connection(self, client_fd, pid):
+        '''Starts polling an accepted client connection'''
         self.epoll.register(client_fd.fileno(),
                             select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)
 
-        sock_rdr = SockReader(client_fd)  # Instantiate a SockReader object
+        # Instantiate a SockReader object of the configured type
+        sock_rdr = common_utils.meta_factory(SockReader, self.reader_type,
+                                             client_fd, **self.reader_args)
         self.input_client_map[client_fd.fileno()] = sock_rdr
 
         if pid in self.pid_map:
@@ -325,8 +504,183 @@ class MultiCommunicationManager(CommunicationManager):
             self.input_client_map[fileno].close()
 
 
+class ShardResult(list):
+    '''Holds the return value of work run inside a shard'''
+    def __init__(self):
+        super(ShardResult, self).__init__()
+        self.done = threading.Event()
+
+
+class ShardCommunicationManager(MultiCommunicationManager):
+    '''Polls the client connections handed to it by a
+    ShardedCommunicationManager. In place of a server socket the shard
+    waits on a wakeup pipe, work posted from other threads is run inside
+    the poll loop so the connection maps are only used by one thread.'''
+    def __init__(self, *args, **kwargs):
+        '''Initialize the class members'''
+        self.inbox = Queue.Queue()  # (func, args, result) to run in loop
+        self.wake_fds = None
+        self.wake_lock = threading.Lock()  # Orders wakeup before close
+        self.closed = threading.Event()
+        super(ShardCommunicationManager, self).__init__(None, *args, **kwargs)
+
+    def _setup_listener(self):
+        '''Creates the wakeup pipe and registers it with epoll'''
+        self.wake_fds = os.pipe()
+        for fileno in self.wake_fds:
+            flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+            fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.listen_fileno = self.wake_fds[0]
+        self.epoll.register(self.listen_fileno,
+                            select.EPOLLIN | select.EPOLLERR)
+
+    def _handle_listener_event(self, ret_list):
+        '''Drains the wakeup pipe and runs all posted work'''
+        try:
+            while os.read(self.listen_fileno, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.error("Error: %d, Message: %s",
+                              exc.errno, exc.strerror)
+
+        while True:
+            try:
+                func, args, result = self.inbox.get_nowait()
+            except Queue.Empty:
+                break
+            ret = func(ret_list, *args)
+            if result is not None:
+                result.append(ret)
+                result.done.set()
+
+    def poll_posted(self):
+        '''Runs the work posted to this shard without reading any client
+        connection, waiting up to select_timeout for a wakeup. Returns the
+        messages produced by the work.'''
+        ret_list = []
+        try:
+            readable, _, _ = select.select([self.listen_fileno], [], [],
+                                           self.select_timeout)
+        except select.error as err:
+            logging.error("Error: %s", str(err))
+            readable = []
+        if readable:
+            self._handle_listener_event(ret_list)
+        return ret_list
+
+    def wakeup(self):
+        '''Interrupts a blocking poll of this shard. Holds wake_lock so
+        the pipe cannot be closed, and its descriptor reused, mid write.'''
+        with self.wake_lock:
+            if self.closed.is_set():
+                return
+            try:
+                os.write(self.wake_fds[1], b'\0')
+            except OSError as exc:
+                # A full pipe will wake the shard anyway
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error("Error: %d, Message: %s",
+                                  exc.errno, exc.strerror)
+
+    def _post(self, func, *args):
+        '''Runs func inside the poll loop without waiting for it'''
+        self.inbox.put((func, args, None))
+        self.wakeup()
+
+    def _call(self, default, func, *args):
+        '''Runs func inside the poll loop and returns its result, or
+        default if the shard is closed first'''
+        if self.closed.is_set():
+            return default
+        result = ShardResult()
+        self.inbox.put((func, args, result))
+        self.wakeup()
+        while not result.done.wait(self.select_timeout):
+            if self.closed.is_set():
+                break
+        return result[0] if result else default
+
+    def hand_off(self, client_fd, pid):
+        '''Passes an accepted client connection to this shard'''
+        self._post(self._adopt_connection, client_fd, pid)
+
+    def _adopt_connection(self, ret_list, client_fd, pid):
+        self._add_connection(client_fd, pid)
+
+    def _detach_in_loop(self, ret_list, pid):
+        '''Close messages are returned from the shard's own poll so they
+        are enqueued after any messages already read from the pid.'''
+        res, close_msgs = super(ShardCommunicationManager, self).detach(pid)
+        ret_list += close_msgs
+        return res, []
+
+    def detach(self, pid):
+        return self._call((None, []), self._detach_in_loop, pid)
+
+    def _ps_in_loop(self, ret_list):
+        return super(ShardCommunicationManager, self).ps()
+
+    def ps(self):
+        return self._call({}, self._ps_in_loop)
+
+    def close(self):
+        '''Close all connections, including any not yet adopted'''
+        # Once closed is set under wake_lock no wakeup writes to the pipe
+        with self.wake_lock:
+            self.closed.set()
+        while True:
+            try:
+                func, args, result = self.inbox.get_nowait()
+            except Queue.Empty:
+                break
+            if func == self._adopt_connection:
+                args[0].close()
+            elif result is not None:
+                result.done.set()
+
+        self.epoll.unregister(self.listen_fileno)
+        for fileno in self.wake_fds:
+            os.close(fileno)
+        for fileno in self.input_client_map:
+            self.epoll.unregister(fileno)
+            self.input_client_map[fileno].close()
+
+
+class ShardedCommunicationManager(MultiCommunicationManager):
+    '''Accepts client connections and hands them off to a fixed number of
+    ShardCommunicationManager instances, each polled by its own thread.
+    Connections are assigned by pid so that every socket of a process is
+    read by the same shard.'''
+    def __init__(self, addr, num_shards=4, *args, **kwargs):
+        '''Initialize the class members'''
+        if num_shards < 1:
+            raise OPUSException("num_shards must be at least 1")
+        super(ShardedCommunicationManager, self).__init__(addr,
+                                                          *args, **kwargs)
+        self.shards = [ShardCommunicationManager(*args, **kwargs)
+                       for _ in range(num_shards)]  # Configurable
+
+    def _shard_for(self, pid):
+        return self.shards[pid % len(self.shards)]
+
+    def _add_connection(self, client_fd, pid):
+        '''Hands the accepted connection off to the shard owning pid'''
+        self._shard_for(pid).hand_off(client_fd, pid)
+
+    def detach(self, pid):
+        return self._shard_for(pid).detach(pid)
+
+    def ps(self):
+        pid_map = {}
+        for shard in self.shards:
+            pid_map.update(shard.ps())
+        return pid_map
+
+
 class Producer(threading.Thread):
     '''Base class for the producer thread'''
+    STALL_CHECK_INTERVAL = 1.0  # seconds between watermark checks
     def __init__(self, pf_queue, router):
         '''Initialize class data members'''
         super(Producer, self).__init__()
@@ -386,7 +740,12 @@ class SocketProducer(Producer):
     def run(self):
         '''Spin until thread stop event is set'''
         while not self.stop_event.isSet():
-            msg_list = self.comm_manager.do_poll()
+            # Leave messages in the socket buffers while the queue is
+            # above its high watermark
+            if self.pf_queue.wait_below_watermark(self.STALL_CHECK_INTERVAL):
+                msg_list = self.comm_manager.do_poll()
+            else:
+                msg_list = []
 
             if self.msg_waiting.is_set():
                 self.msg_waiting.clear()
@@ -432,3 +791,49 @@ class SocketProducer(Producer):
             self.ret = {"success": False,
                         "msg": "%s is not a valid command." % cmd['cmd']}
         return []
+
+
+class ShardedSocketProducer(SocketProducer):
+    '''Socket producer that spreads client connections over several epoll
+    loops. The producer thread accepts connections and handles commands,
+    each shard of its ShardedCommunicationManager is polled by a separate
+    thread that enqueues messages directly on the producer fetcher queue.'''
+    def __init__(self, *args, **kwargs):
+        '''Initialize the class data members'''
+        super(ShardedSocketProducer, self).__init__(*args, **kwargs)
+        if not isinstance(self.comm_manager, ShardedCommunicationManager):
+            raise OPUSException("ShardedSocketProducer requires a "
+                                "ShardedCommunicationManager")
+        self.shard_threads = []
+        for num, shard in enumerate(self.comm_manager.shards):
+            thread = threading.Thread(target=self._run_shard,
+                                      args=(shard,),
+                                      name="ProducerShard-%d" % num)
+            thread.daemon = True
+            self.shard_threads.append(thread)
+
+    def _run_shard(self, shard):
+        '''Spin on a single shard until thread stop event is set'''
+        while not self.stop_event.isSet():
+            if self.pf_queue.wait_below_watermark(0):
+                msg_list = shard.do_poll()
+            else:
+                # Leave messages in the socket buffers while stalled but
+                # keep running hand offs and commands posted to the shard
+                msg_list = shard.poll_posted()
+            if msg_list:
+                self._send_data_to_fetcher(msg_list)
+        shard.close()
+
+    def run(self):
+        '''Start the shard threads and accept connections until thread
+        stop event is set'''
+        for thread in self.shard_threads:
+            thread.start()
+
+        super(ShardedSocketProducer, self).run()
+
+        for shard in self.comm_manager.shards:
+            shard.wakeup()
+        for thread in self.shard_threads:
+            thread.join(common_utils.THREAD_JOIN_SLACK)
@@ -4,4 +4,4 @@ PVM - Init Module
 '''
 
 from .core import (version_local, version_global, get_l, get_g, drop_l, drop_g,
-                   bind, unbind)
+                   bind, unbind, FdEntry, FdTable)
@@ -6,8 +6,140 @@ PVM core operations implementations.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import collections
+
 from .. import storage, traversal, common_utils
 
+
+# A valid local object of a process and the state of its process link
+FdEntry = collections.namedtuple('FdEntry', ['loc_id', 'state'])
+
+
+class FdTable(object):
+    '''In memory table of the valid local objects of each process, keyed by
+    the process node ID and the local name. Only processes registered with
+    track are recorded, lookups for other processes return None so that the
+    caller can fall back to querying the database.
+
+    A process may also hold inherited entries, locals of its parent that
+    it has not yet created its own version of. These map the local name to
+    the parent's local node ID.
+
+    Changes are recorded in journal while a checkpoint is open so that
+    rollback can undo them.'''
+    tables = {}
+    inherited = {}
+    journal = common_utils.UndoJournal()
+
+    @classmethod
+    def track(cls, proc_id):
+        '''Starts recording locals for the process with node ID proc_id.'''
+        cls.journal.record(cls.tables, proc_id)
+        cls.tables[proc_id] = {}
+
+    @classmethod
+    def untrack(cls, proc_id):
+        '''Stops recording locals for the process with node ID proc_id.'''
+        cls.journal.record(cls.tables, proc_id)
+        cls.journal.record(cls.inherited, proc_id)
+        cls.tables.pop(proc_id, None)
+        cls.inherited.pop(proc_id, None)
+
+    @classmethod
+    def entries(cls, proc_id):
+        '''Returns the name to FdEntry dict for proc_id or None if the
+        process is not tracked.'''
+        return cls.tables.get(proc_id)
+
+    @classmethod
+    def set(cls, proc_id, name, loc_id, state=storage.LinkState.NONE):
+        '''Records loc_id as the valid local called name.'''
+        if proc_id in cls.tables:
+            cls.journal.record(cls.tables[proc_id], name)
+            cls.tables[proc_id][name] = FdEntry(loc_id, state)
+            cls.forget_inherited(proc_id, name)
+
+    @classmethod
+    def set_state(cls, proc_id, name, loc_id, state):
+        '''Updates the link state recorded for local loc_id.'''
+        table = cls.tables.get(proc_id)
+        if table is not None and name in table:
+            if table[name].loc_id == loc_id:
+                cls.journal.record(table, name)
+                table[name] = FdEntry(loc_id, state)
+
+    @classmethod
+    def drop(cls, proc_id, name, loc_id):
+        '''Removes local loc_id, it is no longer valid.'''
+        table = cls.tables.get(proc_id)
+        if table is not None and name in table:
+            if table[name].loc_id == loc_id:
+                cls.journal.record(table, name)
+                del table[name]
+
+    @classmethod
+    def inherit(cls, proc_id, parent_id):
+        '''Records the open locals of parent_id, including those it has
+        itself inherited, as inherited entries of proc_id. Locals marked close
+        on exec are not inherited. Returns False if parent_id is not tracked.'''
+        if proc_id not in cls.tables or parent_id not in cls.tables:
+            return False
+
+        refs = dict(cls.inherited.get(parent_id, {}))
+        for name, entry in cls.tables[parent_id].items():
+            if entry.state != storage.LinkState.CLOEXEC:
+                refs[name] = entry.loc_id
+        for name in cls.tables[proc_id]:
+            refs.pop(name, None)
+        if refs:
+            cls.journal.record(cls.inherited, proc_id)
+            cls.inherited[proc_id] = refs
+        return True
+
+    @classmethod
+    def inherited_local(cls, proc_id, name):
+        '''Returns the ID of the parent local inherited as name or None.'''
+        refs = cls.inherited.get(proc_id)
+        if refs is None:
+            return None
+        return refs.get(name)
+
+    @classmethod
+    def forget_inherited(cls, proc_id, name=None):
+        '''Removes the inherited entry name, or all inherited entries
+        if name is None.'''
+        if name is None:
+            cls.journal.record(cls.inherited, proc_id)
+            cls.inherited.pop(proc_id, None)
+            return
+        refs = cls.inherited.get(proc_id)
+        if refs is not None and name in refs:
+            cls.journal.record(refs, name)
+            del refs[name]
+            if not refs:
+                cls.journal.record(cls.inherited, proc_id)
+                del cls.inherited[proc_id]
+
+    @classmethod
+    def copy_state(cls):
+        '''Returns a copy of the tables that can be passed to restore.'''
+        return ({proc_id: dict(table)
+                 for proc_id, table in cls.tables.items()},
+                {proc_id: dict(refs)
+                 for proc_id, refs in cls.inherited.items()})
+
+    @classmethod
+    def restore(cls, state):
+        '''Replaces the tables with state.'''
+        cls.tables, cls.inherited = state
+
+    @classmethod
+    def clear(cls):
+        '''Removes all tables.'''
+        cls.tables = {}
+        cls.inherited = {}
+
+
 def cache_new_local(db_iface, loc_node, proc_node, loc_proc_rel):
     '''Updates the IO_EVENT_CHAIN and VALID_LOCAL
     cache with the new local'''
@@ -24,11 +156,11 @@ def cache_new_local(db_iface, loc_node, proc_node, loc_proc_rel):
     idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                                         (proc_node.id, loc_node['name']))
     if idx_list is None:
-        idx_list = common_utils.IndexList(lambda x: int(x.local['mono_time']))
+        idx_list = common_utils.SortedChunkList()  # Chains by mono_time
 
     fd_chain = storage.FdChain()
     fd_chain.local = loc_node
-    idx_list.append(fd_chain)
+    idx_list.add(traversal.get_mono_time(loc_node), fd_chain)
     db_iface.cache_man.update(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                     (proc_node.id, loc_node['name']), idx_list)
 
@@ -63,6 +195,7 @@ def version_local(db_iface, old_loc_node, glob_node, glob_loc_rel):
     # Create link from local to process
     new_rel = db_iface.create_relationship(new_loc_node, proc_node,
                                  storage.RelType.PROC_OBJ)
+    FdTable.set(proc_node.id, new_loc_node['name'], new_loc_node.id)
 
     db_iface.cache_man.invalidate(storage.CACHE_NAMES.VALID_LOCAL,
                                   (proc_node.id, old_loc_node['name']))
@@ -72,12 +205,18 @@ def version_local(db_iface, old_loc_node, glob_node, glob_loc_rel):
 
     # Change local->process link status to INACTIVE
     rel_link['state'] = storage.LinkState.INACTIVE
+    db_iface.flush_events(old_loc_node)
 
     return new_loc_node
 
 
 def version_global(db_iface, old_glob_node):
     '''Versions the global object identified by old_glob_node.'''
+    # Versioning a global that already has successors can change the
+    # latest version of every global before it
+    if len(old_glob_node.relationships.incoming) > 0:
+        db_iface.cache_man.clear(storage.CACHE_NAMES.GLOB_SUCCESSOR)
+
     new_glob_node = db_iface.create_node(storage.NodeType.GLOBAL)
 
     if old_glob_node.has_key('name'):
@@ -86,18 +225,20 @@ def version_global(db_iface, old_glob_node):
         new_glob_node['name'] = list(name_list)
         for name in name_list:
             # Update file index
-            db_iface.update_index(storage.DBInterface.FILE_INDEX,
+            db_iface.update_index(storage.StorageIFace.FILE_INDEX,
                                   'name', name, new_glob_node)
-        # Update time index
-        db_iface.update_time_index(storage.DBInterface.FILE_INDEX,
+        # Update time index, the lineage keeps one entry per hourly bucket
+        db_iface.update_time_index(storage.StorageIFace.FILE_INDEX,
                                    new_glob_node['sys_time'],
-                                   new_glob_node)
+                                   new_glob_node, old_glob_node)
 
     if old_glob_node.has_key('githash'):
         new_glob_node['githash'] = old_glob_node['githash']
 
     db_iface.create_relationship(new_glob_node, old_glob_node,
                                  storage.RelType.GLOB_OBJ_PREV)
+    db_iface.cache_man.update(storage.CACHE_NAMES.GLOB_SUCCESSOR,
+                              old_glob_node.id, new_glob_node)
 
     # Create new versions of all local objects associated with
     # the old global object and link them to the new global object
@@ -122,6 +263,7 @@ def get_l(db_iface, proc_node, loc_name):
     # Create a relation from local--->process node
     loc_proc_rel = db_iface.create_relationship(loc_node, proc_node,
                                  storage.RelType.PROC_OBJ)
+    FdTable.set(proc_node.id, loc_name, loc_node.id)
 
     # Add the new local object node to the IO_EVENT_CHAIN cache
     cache_new_local(db_iface, loc_node, proc_node, loc_proc_rel)
@@ -143,11 +285,11 @@ def get_g(db_iface, loc_node, glob_name, githash=None):
         new_glob_node['name'] = [glob_name]
 
         # Update file index
-        db_iface.update_index(storage.DBInterface.FILE_INDEX,
+        db_iface.update_index(storage.StorageIFace.FILE_INDEX,
                               'name', glob_name, new_glob_node)
 
         # Update time index
-        db_iface.update_time_index(storage.DBInterface.FILE_INDEX,
+        db_iface.update_time_index(storage.StorageIFace.FILE_INDEX,
                                    new_glob_node['sys_time'],
                                    new_glob_node)
     else:
@@ -166,6 +308,8 @@ def drop_l(db_iface, loc_node):
     # process object to LinkState.CLOSED
     proc_node, rel_link = traversal.get_process_from_local(db_iface, loc_node)
     rel_link['state'] = storage.LinkState.CLOSED
+    FdTable.drop(proc_node.id, loc_node['name'], loc_node.id)
+    db_iface.flush_events(loc_node)
 
     db_iface.cache_man.invalidate(storage.CACHE_NAMES.VALID_LOCAL,
                                   (proc_node.id, loc_node['name']))
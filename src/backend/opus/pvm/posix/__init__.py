@@ -7,4 +7,7 @@ from .core import (handle_function, handle_process,
                    handle_disconnect, handle_prefunc,
                    handle_startup, handle_cleanup,
                    handle_bulk_functions, handle_libinfo,
-                   handle_proc_load_state, handle_proc_dump_state)
+                   handle_proc_load_state, handle_proc_dump_state,
+                   handle_checkpoint, handle_commit, handle_rollback,
+                   handle_fd_inherit_mode)
+from .coalesce import EventCoalescer
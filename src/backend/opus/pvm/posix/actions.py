@@ -120,6 +120,8 @@ def delete_single_name(db_iface, omega_id, glob_node):
                                           storage.RelType.GLOB_OBJ_PREV)
     if len(prev_ver_rel_list) > 0:
         prev_ver_rel_list[0]['state'] = storage.LinkState.DELETED
+        db_iface.cache_man.invalidate(storage.CACHE_NAMES.GLOB_SUCCESSOR,
+                                      glob_node.id)
 
     loc_node_rel_list = traversal.get_locals_from_global(db_iface,
                                                          new_glob_node)
@@ -145,7 +147,7 @@ def delete_multiple_names(db_iface, omega_id, glob_node, glob_name):
 
     side_glob_node = db_iface.create_node(storage.NodeType.GLOBAL)
     side_glob_node['name'] = [glob_name]
-    db_iface.update_index(storage.DBInterface.FILE_INDEX, 'name',
+    db_iface.update_index(storage.StorageIFace.FILE_INDEX, 'name',
                           glob_name, side_glob_node)
 
     glob_prev_rel = db_iface.create_relationship(side_glob_node, glob_node,
@@ -193,12 +195,14 @@ def link_action(db_iface, proc_node, orig_name, new_name):
     orig_name_list = new_o_glob_node['name']
     for name in tmp_name_list:
         orig_name_list.append(name)
-        db_iface.update_index(storage.DBInterface.FILE_INDEX,
+        db_iface.update_index(storage.StorageIFace.FILE_INDEX,
                               'name', name, new_o_glob_node)
     new_o_glob_node['name'] = orig_name_list
 
     db_iface.create_relationship(new_o_glob_node, new_glob_node,
                                  storage.RelType.GLOB_OBJ_PREV)
+    db_iface.cache_man.update(storage.CACHE_NAMES.GLOB_SUCCESSOR,
+                              new_glob_node.id, new_o_glob_node)
 
     pvm.drop_l(db_iface, new_o_loc_node)
     return loc_node
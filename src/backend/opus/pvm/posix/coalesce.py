@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Coalescing of repeated IO function messages before they reach the PVM.
+'''
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import logging
+import time
+
+from . import functions
+from ... import messaging
+from ... import uds_msg_pb2 as uds_msg
+
+
+class EventCoalescer(object):
+    '''Merges runs of consecutive read and write calls made by one process
+    to the same function on the same file descriptor into a single message.
+    The merged message keeps the begin time of the first call, takes the end
+    time and return value of the last call and carries the number of calls
+    as an extra argument. Only one run is held at a time so message order
+    is preserved. Messages are returned as (header, payload, payload object)
+    where the payload object is the parsed FUNCINFO payload, or None for
+    other messages, so it need not be parsed again.'''
+    ACTIONS = ("read", "write")
+    COUNT_ARG = "coalesced_count"
+
+    def __init__(self, window_ms):
+        self.window = window_ms * 1000000  # Message times are in nanoseconds
+        self.window_secs = window_ms / 1000
+        self.run = None
+
+    @classmethod
+    def _run_key(cls, hdr, pay_obj):
+        '''Returns the key a message is coalesced on, or None if the message
+        can not be coalesced.'''
+        mapping = functions.FuncController.func_map.get(pay_obj.func_name)
+        if mapping is None or mapping['action'] not in cls.ACTIONS:
+            return None
+        try:
+            fd = functions.get_fd_from_msg(pay_obj)
+        except KeyError:
+            return None
+        return (hdr.pid, fd, pay_obj.func_name, pay_obj.error_num)
+
+    def push(self, (hdr, pay)):
+        '''Adds a message to the coalescer, returns the list of messages that
+        are ready to be applied.'''
+        if hdr.payload_type != uds_msg.FUNCINFO_MSG:
+            return self.drain() + [(hdr, pay, None)]
+
+        pay_obj = uds_msg.FuncInfoMessage()
+        pay_obj.ParseFromString(pay)
+        key = self._run_key(hdr, pay_obj)
+
+        if (self.run is not None and key == self.run['key'] and
+                pay_obj.begin_time - self.run['begin'] <= self.window):
+            self.run['count'] += 1
+            self.run['end'] = pay_obj.end_time
+            self.run['ret_val'] = pay_obj.ret_val
+            return []
+
+        ready = self.drain()
+        if key is None:
+            ready.append((hdr, pay, pay_obj))
+        else:
+            self.run = {'key': key, 'msg': (hdr, pay), 'pay_obj': pay_obj,
+                        'begin': pay_obj.begin_time, 'end': pay_obj.end_time,
+                        'ret_val': pay_obj.ret_val, 'count': 1,
+                        'started': time.time()}
+        return ready
+
+    def expired(self):
+        '''Returns True if the held run is older than the window.'''
+        return (self.run is not None and
+                time.time() - self.run['started'] >= self.window_secs)
+
+    def drain(self):
+        '''Returns the held run as a list of at most one message.'''
+        if self.run is None:
+            return []
+        run = self.run
+        self.run = None
+
+        if run['count'] == 1:
+            return [run['msg'] + (run['pay_obj'],)]
+
+        hdr = run['msg'][0]
+        pay_obj = run['pay_obj']
+        pay_obj.end_time = run['end']
+        pay_obj.ret_val = run['ret_val']
+        count_arg = pay_obj.args.add()
+        count_arg.key = self.COUNT_ARG
+        count_arg.value = str(run['count'])
+        pay = pay_obj.SerializeToString()
+
+        if __debug__:
+            logging.debug("Coalesced %d calls to %s from pid %d.",
+                          run['count'], pay_obj.func_name, hdr.pid)
+        return [(messaging.HeaderRecord(hdr.timestamp, hdr.pid,
+                                        hdr.payload_type, len(pay),
+                                        hdr.tid, hdr.sys_time), pay, pay_obj)]
@@ -57,6 +57,27 @@ def handle_proc_load_state(file_name):
     process.ProcStateController.load_state(file_name)
 
 
+def handle_fd_inherit_mode(lazy):
+    '''Sets whether new processes inherit file descriptors lazily'''
+    process.ProcStateController.lazy_fd_inherit = lazy
+
+
+def handle_checkpoint():
+    '''Starts journalling changes to the internal state of the process
+    class'''
+    process.ProcStateController.checkpoint()
+
+
+def handle_commit():
+    '''Keeps the changes to the process class since the checkpoint'''
+    process.ProcStateController.commit()
+
+
+def handle_rollback():
+    '''Undoes the changes to the process class since the checkpoint'''
+    process.ProcStateController.rollback()
+
+
 def handle_disconnect(db_iface, hdr, pid):
     '''Handle the disconnection of a process.'''
     db_iface.set_mono_time_for_msg(hdr.timestamp)
@@ -88,6 +109,6 @@ def handle_libinfo(db_iface, pid, pay):
         process.ProcStateController.resolve_process(pid))
 
     time_stamp = proc_node['timestamp']
-    for pair in pay.library:
-        utils.add_meta_to_proc(db_iface, proc_node, pair.key, pair.value,
-                                time_stamp, storage.RelType.LIB_META)
+    utils.add_meta_snapshot(db_iface, proc_node,
+                            [(pair.key, pair.value) for pair in pay.library],
+                            time_stamp, storage.RelType.LIB_SNAPSHOT)
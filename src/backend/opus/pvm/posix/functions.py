@@ -46,16 +46,55 @@ def _parse_mapping(msg, mapping):
         return str(mapping[1])
 
 
-def wrap_action(action, arg_map):
+def compile_arg_map(arg_map):
+    '''Compiles an argument mapping into a function taking a msg and
+    returning the dictionary of mapped arguments. The message arguments are
+    walked once from the end, stopping as soon as every needed key has been
+    found, so the last of any duplicate keys is used.'''
+    msg_args = {}
+    consts = {}
+    fields = []
+    for k, mapping in arg_map.items():
+        if mapping[0] == "msg_arg":
+            msg_args.setdefault(mapping[1], []).append(k)
+        elif mapping[0] == "const":
+            consts[k] = str(mapping[1])
+        else:
+            fields.append((k, mapping))
+    num_keys = len(msg_args)
+
+    def extract(msg):
+        '''Extractor internal. '''
+        arg_set = dict(consts)
+        if num_keys > 0:
+            found = 0
+            for obj in reversed(msg.args):
+                names = msg_args.get(obj.key)
+                if names is None or names[0] in arg_set:
+                    continue
+                for name in names:
+                    arg_set[name] = obj.value
+                found += 1
+                if found == num_keys:
+                    break
+            else:
+                for key, names in msg_args.items():
+                    if names[0] not in arg_set:
+                        raise KeyError(key)
+        for k, mapping in fields:
+            arg_set[k] = _parse_mapping(msg, mapping)
+        return arg_set
+    return extract
+
+
+def wrap_action(action, extract):
     '''Converts an item from the ActionMap into a lambda taking
-    storage interface, process node and a msg.'''
+    storage interface, process node and a msg, using the compiled argument
+    extractor extract.'''
     def fun(db_iface, proc_node, msg):
         '''Wrapper internal. '''
-        arg_set = {}
-        for k, val in arg_map.items():
-            arg_set[k] = _parse_mapping(msg, val)
         return actions.ActionMap.call(action, msg.error_num,
-                                      db_iface, proc_node, **arg_set)
+                                      db_iface, proc_node, **extract(msg))
     return fun
 
 
@@ -63,6 +102,7 @@ class FuncController(object):
     '''Mapping for function names to definitions.'''
     funcs = {}
     func_map = {}
+    fd_extractors = {}
 
     @classmethod
     def load(cls, func_file):
@@ -72,7 +112,13 @@ class FuncController(object):
                                                func_file) as conf:
                 cls.func_map = yaml.safe_load(conf)
                 for func_name, mapping in cls.func_map.items():
-                    cls.register(func_name, wrap_action(**mapping))
+                    arg_map = mapping['arg_map']
+                    cls.register(func_name,
+                                 wrap_action(mapping['action'],
+                                             compile_arg_map(arg_map)))
+                    if 'filedes' in arg_map:
+                        cls.fd_extractors[func_name] = compile_arg_map(
+                            {'filedes': arg_map['filedes']})
         except IOError:
             logging.error("Failed to read in config file.")
             raise
@@ -108,8 +154,7 @@ FuncController.load("pvm.yaml")
 
 def get_fd_from_msg(msg):
     '''Given a function message retrieves the filedescriptor it operates on.'''
-    mapping = FuncController.func_map[msg.func_name]['arg_map']['filedes']
-    return _parse_mapping(msg, mapping)
+    return FuncController.fd_extractors[msg.func_name](msg)['filedes']
 
 
 def load_cache(db_iface, loc_name, proc_node, mono_time):
@@ -123,26 +168,56 @@ def load_cache(db_iface, loc_name, proc_node, mono_time):
     except utils.NoMatchingLocalError:
         pass
 
-    result = db_iface.query("START s=node(" + str(proc_node.id) + ") "
-                            "MATCH (s)<-[:PROC_OBJ]-(l),"
-                            "(l)-[?:IO_EVENTS]->(m), "
-                            "p=(m)-[:PREV_EVENT*0..]->(n) "
-                            "WHERE l.name = '" + loc_name + "' "
-                            "AND not((n)-[:PREV_EVENT]->()) "
-                            "RETURN l,NODES(p) ORDER BY l.mono_time")
-
-    ret = common_utils.IndexList(lambda x: int(x.local['mono_time']))
+    ret = common_utils.SortedChunkList()  # Chains by mono_time
 
-    for row in result:
+    for rel in proc_node.PROC_OBJ.incoming:
+        loc_node = rel.start
+        if loc_node['name'] != loc_name:
+            continue
         chain = storage.FdChain()
-        chain.local = row['l']
-        if row['NODES(p)'] is not None:
-            for node in row['NODES(p)']:
-                chain.chain.insert(0, node)
-        ret.append(chain)
+        chain.local = loc_node
+
+        # Walk back from the last event of the local to its first
+        events = []
+        for ev_rel in loc_node.IO_EVENTS.outgoing:
+            event_node = ev_rel.end
+            while event_node is not None:
+                events.append(event_node)
+                prev_node = None
+                for prev_rel in event_node.PREV_EVENT.outgoing:
+                    prev_node = prev_rel.end
+                event_node = prev_node
+        for node in reversed(events):
+            chain.chain.add(int(node['before_time']), node)
+        ret.add(traversal.get_mono_time(loc_node), chain)
     return ret
 
 
+def add_packed_function(db_iface, proc_node, des, msg):
+    '''Buffers the event for an aggregated message on the local named des
+    that was current when the call began.'''
+    idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
+                                      (proc_node.id, des))
+    chain = None
+    if idx_list is not None:
+        chain = idx_list.floor(msg.begin_time)
+
+    if chain is None:
+        # Older locals are only held by the chain loaded from the database
+        idx_list = load_cache(db_iface, des, proc_node, msg.begin_time)
+        db_iface.cache_man.update(storage.CACHE_NAMES.IO_EVENT_CHAIN,
+                                  (proc_node.id, des), idx_list)
+        chain = idx_list.floor(msg.begin_time)
+
+    if chain is None:
+        logging.error("Misplaced message.")
+        logging.error(msg)
+        return
+
+    db_iface.append_event(chain.local, msg.func_name, msg.ret_val,
+                          msg.begin_time, msg.end_time)
+
+
 def process_aggregate_functions(db_iface, proc_node, msg_list):
     '''Processes an aggregation message.'''
     for smsg in msg_list:
@@ -152,63 +227,70 @@ def process_aggregate_functions(db_iface, proc_node, msg_list):
 
         db_iface.set_mono_time_for_msg(msg.begin_time)
 
+        if db_iface.packed_events:
+            add_packed_function(db_iface, proc_node, des, msg)
+            continue
+
         idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                                           (proc_node.id, des))
 
-        if idx_list is None:
+        loaded = idx_list is None
+        if loaded:
             idx_list = load_cache(db_iface, des, proc_node, msg.begin_time)
+            db_iface.cache_man.update(storage.CACHE_NAMES.IO_EVENT_CHAIN,
+                                      (proc_node.id, des), idx_list)
 
         evt = utils.event_from_msg(db_iface, msg)
 
-        j = idx_list.find(evt, key=lambda x: int(x['before_time']))
+        chain = idx_list.floor(msg.begin_time)
 
-        if j == 0:
+        if chain is None and not loaded:
+            # A chain rebuilt after eviction only holds the newest locals
+            idx_list = load_cache(db_iface, des, proc_node, msg.begin_time)
+            db_iface.cache_man.update(storage.CACHE_NAMES.IO_EVENT_CHAIN,
+                                      (proc_node.id, des), idx_list)
+            chain = idx_list.floor(msg.begin_time)
+
+        if chain is None:
             logging.error("Misplaced message.")
             logging.error(evt.__repr__())
             logging.error(idx_list)
             logging.error(evt['before_time'])
             continue
 
-        # J pointed to local after the needed one
-        chain = idx_list[j-1]
+        # Events either side of the new one in the chain of the local that
+        # was current when the call began
+        prev_evt, next_evt = chain.chain.neighbours(msg.begin_time)
 
-        if len(chain.chain) == 0:
+        if prev_evt is None and next_evt is None:
             db_iface.create_relationship(chain.local, evt,
                                          storage.RelType.IO_EVENTS)
             db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
                                           chain.local.id)
-            chain.chain.insert(0, evt)
+        elif prev_evt is None:
+            db_iface.create_relationship(
+                next_evt, evt, storage.RelType.PREV_EVENT)
+        elif next_evt is None:
+            for tmp_rel in chain.local.IO_EVENTS.outgoing:
+                db_iface.delete_relationship(tmp_rel)
+
+            db_iface.create_relationship(
+                evt, prev_evt, storage.RelType.PREV_EVENT)
+            db_iface.create_relationship(
+                chain.local, evt, storage.RelType.IO_EVENTS)
+
+            db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
+                                          chain.local.id)
         else:
-            i = chain.chain.find(evt)
-
-            if i == 0:
-                db_iface.create_relationship(
-                    chain.chain[0], evt, storage.RelType.PREV_EVENT)
-                chain.chain.insert(0, evt)
-            elif i == len(chain.chain):
-                end = len(chain.chain)
-
-                for tmp_rel in chain.local.IO_EVENTS.outgoing:
-                    db_iface.delete_relationship(tmp_rel)
-
-                db_iface.create_relationship(
-                    evt, chain.chain[end-1], storage.RelType.PREV_EVENT)
-                db_iface.create_relationship(
-                    chain.local, evt, storage.RelType.IO_EVENTS)
-
-                db_iface.cache_man.invalidate(storage.CACHE_NAMES.LAST_EVENT,
-                                              chain.local.id)
-                chain.chain.append(evt)
-            else:
-                for tmp_rel in chain.chain[i].PREV_EVENT.outgoing:
-                    db_iface.delete_relationship(tmp_rel)
+            for tmp_rel in next_evt.PREV_EVENT.outgoing:
+                db_iface.delete_relationship(tmp_rel)
 
-                db_iface.create_relationship(
-                    chain.chain[i], evt, storage.RelType.PREV_EVENT)
-                db_iface.create_relationship(
-                    evt, chain.chain[i-1], storage.RelType.PREV_EVENT)
+            db_iface.create_relationship(
+                next_evt, evt, storage.RelType.PREV_EVENT)
+            db_iface.create_relationship(
+                evt, prev_evt, storage.RelType.PREV_EVENT)
 
-                chain.chain.insert(i, evt)
+        chain.chain.add(msg.begin_time, evt)
 
 
 @FuncController.dec('fork')
@@ -231,6 +313,7 @@ def posix_popen(db_iface, proc_node, msg):
 @utils.check_message_error_num
 def posix_fcloseall(db_iface, proc_node, _):
     '''Implementation of fcloseall in PVM semantics.'''
+    pvm.FdTable.forget_inherited(proc_node.id)
     local_node_link_list = traversal.get_locals_from_process(db_iface,
                                                              proc_node)
 
@@ -507,9 +590,21 @@ def posix_clearenv(db_iface, proc_node, msg):
     env_meta_list = traversal.get_proc_meta(db_iface, proc_node,
                                             storage.RelType.ENV_META)
 
+    changed = set()
     for meta_node, meta_rel in env_meta_list:
+        changed.add(meta_node['name'])
         utils.version_meta(db_iface, proc_node, meta_node, meta_rel,
                            (meta_node['name'], None, msg.end_time))
+
+    # Unset the variables of the environment snapshot
+    env_snapshot = traversal.get_proc_snapshot(db_iface, proc_node,
+                                               storage.RelType.ENV_SNAPSHOT)
+    for name in env_snapshot:
+        if name in changed:
+            continue
+        meta_node = utils.new_meta(db_iface, name, None, msg.end_time)
+        db_iface.create_relationship(proc_node, meta_node,
+                                     storage.RelType.ENV_META)
     return proc_node
 
 
@@ -564,11 +659,12 @@ def posix_fcntl(db_iface, proc_node, msg):
                           storage.LinkState.CLOEXEC)
     if int(args['cmd']) == fcntl.F_SETFD:
         if int(args['arg']) == fcntl.FD_CLOEXEC:
-            db_iface.set_link_state(loc_node.PROC_OBJ.outgoing,
-                                    storage.LinkState.CLOEXEC)
+            state = storage.LinkState.CLOEXEC
         else:
-            db_iface.set_link_state(loc_node.PROC_OBJ.outgoing,
-                                    storage.LinkState.NONE)
+            state = storage.LinkState.NONE
+        db_iface.set_link_state(loc_node.PROC_OBJ.outgoing, state)
+        pvm.FdTable.set_state(proc_node.id, args['filedes'],
+                              loc_node.id, state)
 
     return loc_node
 
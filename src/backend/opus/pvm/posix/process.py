@@ -27,9 +27,34 @@ def create_proc(db_iface, pid, time_stamp):
     db_iface.cache_man.update(storage.CACHE_NAMES.NODE_BY_ID,
                             proc_node.id, proc_node)
 
+    # Record the locals of the process from its creation onwards
+    pvm.FdTable.track(proc_node.id)
+
     return proc_node
 
 
+def get_open_locals(db_iface, proc_node, inherited=False):
+    '''Returns the local object nodes of proc_node that are neither closed
+    nor marked close on exec. Uses the processes fd table when it is
+    tracked, otherwise the database is queried. If inherited is set the
+    parent locals the process has inherited but not yet used are included.'''
+    entries = pvm.FdTable.entries(proc_node.id)
+    if entries is None:
+        loc_node_link_list = traversal.get_locals_from_process(db_iface,
+                                                               proc_node)
+        return [loc_node for (loc_node, loc_proc_rel) in loc_node_link_list
+                if loc_proc_rel['state'] not in [storage.LinkState.CLOSED,
+                                                 storage.LinkState.CLOEXEC]]
+
+    loc_ids = [entry.loc_id for entry in entries.values()
+               if entry.state != storage.LinkState.CLOEXEC]
+    if inherited:
+        refs = pvm.FdTable.inherited.get(proc_node.id, {})
+        loc_ids.extend(loc_id for name, loc_id in refs.items()
+                       if name not in entries)
+    return [db_iface.get_node_by_id(loc_id) for loc_id in loc_ids]
+
+
 def expand_proc(db_iface, proc_node, pay, opus_lite):
     '''Expand a process node with a binary relation and with meta data
     from a given startup message payload 'pay'.'''
@@ -56,51 +81,31 @@ def expand_proc(db_iface, proc_node, pay, opus_lite):
         utils.add_meta_to_proc(db_iface, proc_node, "gid", pay.group_name,
                                time_stamp, storage.RelType.OTHER_META)
 
-    for pair in pay.environment:
-        utils.add_meta_to_proc(db_iface, proc_node, pair.key, pair.value,
-                               time_stamp, storage.RelType.ENV_META)
+    utils.add_meta_snapshot(db_iface, proc_node,
+                            [(pair.key, pair.value)
+                             for pair in pay.environment],
+                            time_stamp, storage.RelType.ENV_SNAPSHOT)
 
-    for pair in pay.system_info:
-        utils.add_meta_to_proc(db_iface, proc_node, pair.key, pair.value,
-                               time_stamp, storage.RelType.OTHER_META)
-
-    for pair in pay.resource_limit:
-        utils.add_meta_to_proc(db_iface, proc_node, pair.key, pair.value,
-                               time_stamp, storage.RelType.OTHER_META)
+    utils.add_meta_snapshot(db_iface, proc_node,
+                            [(pair.key, pair.value)
+                             for pair in pay.system_info] +
+                            [(pair.key, pair.value)
+                             for pair in pay.resource_limit],
+                            time_stamp, storage.RelType.OTHER_SNAPSHOT)
 
 
-def clone_file_des(db_iface, old_proc_node, new_proc_node):
+def clone_file_des(db_iface, old_proc_node, new_proc_node, lazy=False):
     '''Copies over file descriptors, and global to process path information
-    from the old_proc_node to new_proc_node.'''
-    loc_node_link_list = traversal.get_locals_from_process(db_iface,
-                                                           old_proc_node)
-    for (loc_node, loc_proc_rel) in loc_node_link_list:
-        if loc_proc_rel['state'] in [storage.LinkState.CLOSED,
-                                     storage.LinkState.CLOEXEC]:
-            continue
-
-        new_loc_node = pvm.get_l(db_iface, new_proc_node, loc_node['name'])
-
-        gl_list = traversal.get_globals_from_local(db_iface, loc_node)
-        if len(gl_list) == 0:
-            continue
-
-        glob_node, glob_loc_rel = gl_list[0]
-
-        # Find the newest valid version of the global object
-        # since we call version_global within the loop
-        latest_glob_node = traversal.get_glob_latest_version(db_iface,
-                                                             glob_node)
-        if latest_glob_node is not None:
-            # If in OPUS lite mode, copy over link state from parent
-            old_state = None
-            if (old_proc_node.has_key('opus_lite') and
-                old_proc_node['opus_lite']):
-                if glob_loc_rel is not None:
-                    old_state = glob_loc_rel['state']
-
-            new_glob_node = pvm.version_global(db_iface, latest_glob_node)
-            pvm.bind(db_iface, new_loc_node, new_glob_node, old_state)
+    from the old_proc_node to new_proc_node. If lazy is set the file
+    descriptors are only recorded as inherited, they are copied when the
+    new process first uses them.'''
+    if lazy and pvm.FdTable.inherit(new_proc_node.id, old_proc_node.id):
+        return
+
+    opus_lite = (old_proc_node.has_key('opus_lite') and
+                 old_proc_node['opus_lite'])
+    for loc_node in get_open_locals(db_iface, old_proc_node, True):
+        utils.inherit_local(db_iface, new_proc_node, loc_node, opus_lite)
 
 
 class ProcStateController(object):
@@ -113,13 +118,19 @@ class ProcStateController(object):
     PIDMAP = {}
     pid_proc_nodes_map = {} # PID -> [proc_node.id list]
 
+    # Records changes to the maps above while a checkpoint is open
+    journal = common_utils.UndoJournal()
+
+    # Forked processes inherit file descriptors lazily
+    lazy_fd_inherit = False  # Configurable
+
     @classmethod
     def proc_fork(cls, db_iface, p_node, pid, timestamp):
         '''Handle a process 'p_node' forking a child with pid 'pid' at time
         'timestamp'. Returns True if this is successful and False if this
         violates the state system.'''
         if pid not in cls.proc_map:
-            cls.proc_map[pid] = cls.proc_states.FORK
+            cls.__update(cls.proc_map, pid, cls.proc_states.FORK)
             new_proc_node = create_proc(db_iface, pid, timestamp)
 
             if p_node.has_key('opus_lite'):
@@ -128,8 +139,9 @@ class ProcStateController(object):
             cls.__add_proc_node(pid, new_proc_node)
             db_iface.create_relationship(new_proc_node, p_node,
                                          storage.RelType.PROC_PARENT)
-            clone_file_des(db_iface, p_node, new_proc_node)
-            cls.PIDMAP[pid] = new_proc_node.id
+            clone_file_des(db_iface, p_node, new_proc_node,
+                           cls.lazy_fd_inherit)
+            cls.__update(cls.PIDMAP, pid, new_proc_node.id)
             return True
         else:
             logging.warning("Process %d received invalid request to fork while"
@@ -138,13 +150,24 @@ class ProcStateController(object):
                             cls.proc_states.enum_str(cls.proc_map[pid]))
             return False
 
+    @classmethod
+    def __update(cls, dictionary, key, val):
+        '''Sets an entry of one of the class maps, journalling it'''
+        cls.journal.record(dictionary, key)
+        dictionary[key] = val
+
+    @classmethod
+    def __remove(cls, dictionary, key):
+        '''Deletes an entry of one of the class maps, journalling it'''
+        cls.journal.record(dictionary, key)
+        del dictionary[key]
+
     @classmethod
     def __add_proc_node(cls, pid, proc_node):
-        '''Maintains a list of process nodes for each pid'''
-        if pid in cls.pid_proc_nodes_map:
-            cls.pid_proc_nodes_map[pid].append(proc_node.id)
-        else:
-            cls.pid_proc_nodes_map[pid] = [proc_node.id]
+        '''Maintains a list of process nodes for each pid. The list is
+        replaced rather than changed in place so it can be journalled.'''
+        cls.__update(cls.pid_proc_nodes_map, pid,
+                     cls.pid_proc_nodes_map.get(pid, []) + [proc_node.id])
 
     @classmethod
     def __is_forked_process(cls, pid):
@@ -157,7 +180,7 @@ class ProcStateController(object):
 
     @classmethod
     def __handle_normal_process(cls, db_iface, hdr, pay, opus_lite):
-        cls.proc_map[hdr.pid] = cls.proc_states.NORMAL
+        cls.__update(cls.proc_map, hdr.pid, cls.proc_states.NORMAL)
 
         proc_node = create_proc(db_iface, hdr.pid, hdr.timestamp)
         cls.__add_proc_node(hdr.pid, proc_node)
@@ -165,18 +188,18 @@ class ProcStateController(object):
 
         for i in range(3):
             pvm.get_l(db_iface, proc_node, str(i))
-        cls.PIDMAP[hdr.pid] = proc_node.id
+        cls.__update(cls.PIDMAP, hdr.pid, proc_node.id)
 
     @classmethod
     def __handle_forked_process(cls, db_iface, hdr, pay, opus_lite):
-        cls.proc_map[hdr.pid] = cls.proc_states.NORMAL
+        cls.__update(cls.proc_map, hdr.pid, cls.proc_states.NORMAL)
         proc_node = db_iface.get_node_by_id(cls.PIDMAP[hdr.pid])
         expand_proc(db_iface, proc_node, pay, opus_lite)
-        cls.PIDMAP[hdr.pid] = proc_node.id
+        cls.__update(cls.PIDMAP, hdr.pid, proc_node.id)
 
     @classmethod
     def __handle_vforked_process(cls, db_iface, hdr, pay, opus_lite):
-        cls.proc_map[hdr.pid] = cls.proc_states.NORMAL
+        cls.__update(cls.proc_map, hdr.pid, cls.proc_states.NORMAL)
         proc_node = create_proc(db_iface, hdr.pid, hdr.timestamp)
         cls.__add_proc_node(hdr.pid, proc_node)
         expand_proc(db_iface, proc_node, pay, opus_lite)
@@ -185,12 +208,13 @@ class ProcStateController(object):
         parent_proc_node = db_iface.get_node_by_id(parent_proc_node_id)
         db_iface.create_relationship(proc_node, parent_proc_node,
                                     storage.RelType.PROC_PARENT)
-        clone_file_des(db_iface, parent_proc_node, proc_node)
-        cls.PIDMAP[hdr.pid] = proc_node.id
+        clone_file_des(db_iface, parent_proc_node, proc_node,
+                       cls.lazy_fd_inherit)
+        cls.__update(cls.PIDMAP, hdr.pid, proc_node.id)
 
     @classmethod
     def __handle_execed_process(cls, db_iface, hdr, pay, opus_lite):
-        cls.proc_map[hdr.pid] = cls.proc_states.NORMAL
+        cls.__update(cls.proc_map, hdr.pid, cls.proc_states.NORMAL)
         proc_node = create_proc(db_iface, hdr.pid, hdr.timestamp)
         cls.__add_proc_node(hdr.pid, proc_node)
         expand_proc(db_iface, proc_node, pay, opus_lite)
@@ -200,8 +224,9 @@ class ProcStateController(object):
 
         db_iface.create_relationship(proc_node, old_proc_node,
                                     storage.RelType.PROC_OBJ_PREV)
-        clone_file_des(db_iface, old_proc_node, proc_node)
-        cls.PIDMAP[hdr.pid] = proc_node.id
+        clone_file_des(db_iface, old_proc_node, proc_node,
+                       cls.lazy_fd_inherit)
+        cls.__update(cls.PIDMAP, hdr.pid, proc_node.id)
 
         # Clear the previous process object cache
         cls.__clear_process_cache(db_iface, old_proc_node)
@@ -211,7 +236,10 @@ class ProcStateController(object):
 
         # Remove the previous process node from pid_proc_nodes_map
         if old_proc_node_id in cls.pid_proc_nodes_map[hdr.pid]:
-            cls.pid_proc_nodes_map[hdr.pid].remove(old_proc_node_id)
+            cls.__update(cls.pid_proc_nodes_map, hdr.pid,
+                         [node_id for node_id in
+                          cls.pid_proc_nodes_map[hdr.pid]
+                          if node_id != old_proc_node_id])
 
 
     @classmethod
@@ -237,7 +265,7 @@ class ProcStateController(object):
 
         if pid in cls.proc_map:
             if cls.proc_map[pid] == cls.proc_states.NORMAL:
-                cls.proc_map[pid] = cls.proc_states.EXECED
+                cls.__update(cls.proc_map, pid, cls.proc_states.EXECED)
                 return True
             else:
                 logging.warning("Process %d received invalid request to "
@@ -281,6 +309,8 @@ class ProcStateController(object):
             storage.CACHE_NAMES.NODE_BY_ID,
             proc_node['node_id'])
 
+        pvm.FdTable.untrack(proc_node.id)
+
 
     @classmethod
     def __clear_caches(cls, db_iface, pid):
@@ -305,12 +335,7 @@ class ProcStateController(object):
             if proc_node['status'] == storage.PROCESS_STATE.ALIVE:
                 continue
 
-            loc_node_link_list = traversal.get_locals_from_process(db_iface,
-                                                                proc_node)
-            for (loc_node, rel_link) in loc_node_link_list:
-                if rel_link['state'] in [storage.LinkState.CLOSED,
-                                        storage.LinkState.CLOEXEC]:
-                    continue
+            for loc_node in get_open_locals(db_iface, proc_node):
                 loc_node = actions.close_action_helper(db_iface, loc_node)
 
 
@@ -322,14 +347,14 @@ class ProcStateController(object):
 
         if pid in cls.proc_map:
             if cls.proc_map[pid] == cls.proc_states.EXECED:
-                cls.proc_map[pid] = cls.proc_states.NORMAL
+                cls.__update(cls.proc_map, pid, cls.proc_states.NORMAL)
                 return True
             else:
                 cls.__close_all_open_fds(db_iface, pid)
                 cls.__clear_caches(db_iface, pid)
-                del cls.pid_proc_nodes_map[pid]
-                del cls.PIDMAP[pid]
-                del cls.proc_map[pid]
+                cls.__remove(cls.pid_proc_nodes_map, pid)
+                cls.__remove(cls.PIDMAP, pid)
+                cls.__remove(cls.proc_map, pid)
         else:
             logging.warning("Unknown process %d disconnected.",
                             pid)
@@ -347,6 +372,26 @@ class ProcStateController(object):
                           "present in the system.", pid)
             return None
 
+    @classmethod
+    def checkpoint(cls):
+        '''Starts journalling changes to the class data structures and the
+        fd tables so that rollback can undo them, only the entries changed
+        are recorded'''
+        cls.journal.start()
+        pvm.FdTable.journal.start()
+
+    @classmethod
+    def commit(cls):
+        '''Keeps the changes made since checkpoint'''
+        cls.journal.commit()
+        pvm.FdTable.journal.commit()
+
+    @classmethod
+    def rollback(cls):
+        '''Undoes the changes made since checkpoint'''
+        cls.journal.rollback()
+        pvm.FdTable.journal.rollback()
+
     @classmethod
     def dump_state(cls, file_name):
         '''Writes all class data structures to file'''
@@ -355,6 +400,7 @@ class ProcStateController(object):
                 pickle.dump(cls.proc_map, fh)
                 pickle.dump(cls.PIDMAP, fh)
                 pickle.dump(cls.pid_proc_nodes_map, fh)
+                pickle.dump(pvm.FdTable.copy_state(), fh)
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException("OPUS file open error, %s", file_name)
@@ -370,6 +416,12 @@ class ProcStateController(object):
                 cls.proc_map = pickle.load(fh)
                 cls.PIDMAP = pickle.load(fh)
                 cls.pid_proc_nodes_map = pickle.load(fh)
+                try:
+                    pvm.FdTable.restore(pickle.load(fh))
+                except EOFError:
+                    # State from a version without fd tables, the
+                    # database is queried for these processes instead
+                    pvm.FdTable.clear()
         except IOError as exc:
             logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
             raise exception.OPUSException("OPUS file open error, %s", file_name)
@@ -382,3 +434,4 @@ class ProcStateController(object):
         '''Clears up the classes data structures.'''
         cls.PIDMAP = {}
         cls.proc_map = {}
+        pvm.FdTable.clear()
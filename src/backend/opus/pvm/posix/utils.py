@@ -9,6 +9,7 @@ from __future__ import (absolute_import, division,
 
 
 import functools
+import hashlib
 import logging
 
 from ... import pvm, storage, traversal
@@ -45,6 +46,37 @@ def add_meta_to_proc(db_iface, proc_node, name, val, time_stamp, rel_type):
     db_iface.create_relationship(proc_node, meta_node, rel_type)
 
 
+def meta_snapshot_hash(rel_type, pairs):
+    '''Returns the content hash of a set of name, value pairs'''
+    digest = hashlib.sha1(rel_type.encode('utf-8'))
+    for name, val in sorted(pairs):
+        digest.update(b'\0' + name.encode('utf-8') +
+                      b'=' + val.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def add_meta_snapshot(db_iface, proc_node, pairs, time_stamp, rel_type):
+    '''Links a process node to the meta snapshot node holding the name, value
+    pairs. Snapshots are shared by every process with the same set of pairs,
+    a new one is only created for a set that has not been seen before.'''
+    pairs = dict(pairs).items()
+    if len(pairs) == 0:
+        return
+
+    snap_hash = meta_snapshot_hash(rel_type, pairs)
+    snap_node = traversal.get_meta_snapshot(db_iface, snap_hash)
+    if snap_node is None:
+        pairs.sort()
+        snap_node = db_iface.create_node(storage.NodeType.META)
+        snap_node['hash'] = snap_hash
+        snap_node['keys'] = [name for name, _ in pairs]
+        snap_node['values'] = [val for _, val in pairs]
+        snap_node['timestamp'] = time_stamp
+        db_iface.update_index(storage.StorageIFace.META_INDEX,
+                              'hash', snap_hash, snap_node)
+    db_iface.create_relationship(proc_node, snap_node, rel_type)
+
+
 def new_meta(db_iface, name, val, time_stamp):
     '''Create a new meta object node with the given name,
     value and timestamp.'''
@@ -74,22 +106,60 @@ def event_from_msg(db_iface, msg):
     if len(arg_values) > 0:
         event_node['arg_values'] = arg_values
 
-    event_node['before_time'] = str(msg.begin_time)
-    event_node['after_time'] = str(msg.end_time)
+    event_node['before_time'] = msg.begin_time
+    event_node['after_time'] = msg.end_time
+    db_iface.update_index(storage.StorageIFace.EVENT_INDEX, 'before_time',
+                          msg.begin_time, event_node)
     return event_node
 
 
 def proc_get_local(db_iface, proc_node, loc_name):
     '''Retrieves the local object node that corresponds with
     a given name from a process node.'''
+    entries = pvm.FdTable.entries(proc_node.id)
+    if entries is None:
+        loc_node, _ = traversal.get_valid_local(db_iface, proc_node, loc_name)
+    elif loc_name in entries:
+        loc_node = db_iface.get_node_by_id(entries[loc_name].loc_id)
+    else:
+        loc_node = None
+        parent_loc_id = pvm.FdTable.inherited_local(proc_node.id, loc_name)
+        if parent_loc_id is not None:
+            loc_node = inherit_local(
+                db_iface, proc_node, db_iface.get_node_by_id(parent_loc_id),
+                proc_node.has_key('opus_lite') and proc_node['opus_lite'])
 
-    loc_node, _ = traversal.get_valid_local(db_iface, proc_node, loc_name)
     if loc_node is None:
         raise NoMatchingLocalError(proc_node, loc_name)
 
     return loc_node
 
 
+def inherit_local(db_iface, proc_node, parent_loc_node, opus_lite):
+    '''Gives proc_node its own copy of the local parent_loc_node, bound to a
+    new version of the global object the parent local refers to. In OPUS
+    lite mode the link state of the parent local is copied over.'''
+    new_loc_node = pvm.get_l(db_iface, proc_node, parent_loc_node['name'])
+
+    gl_list = traversal.get_globals_from_local(db_iface, parent_loc_node)
+    if len(gl_list) == 0:
+        return new_loc_node
+
+    glob_node, glob_loc_rel = gl_list[0]
+
+    # Find the newest valid version of the global object
+    # since version_global may have been called since
+    latest_glob_node = traversal.get_glob_latest_version(db_iface, glob_node)
+    if latest_glob_node is not None:
+        old_state = None
+        if opus_lite and glob_loc_rel is not None:
+            old_state = glob_loc_rel['state']
+
+        new_glob_node = pvm.version_global(db_iface, latest_glob_node)
+        pvm.bind(db_iface, new_loc_node, new_glob_node, old_state)
+    return new_loc_node
+
+
 def update_proc_meta(db_iface, proc_node, meta_name, new_val, timestamp):
     '''Updates the meta object meta_name for the process with a new value
     and timestamp. Adds a new object if an existing one cannot be found.'''
@@ -112,26 +182,37 @@ def update_proc_meta(db_iface, proc_node, meta_name, new_val, timestamp):
                                  storage.RelType.OTHER_META)
 
 
-def update_event_chain_cache(db_iface, loc_node, event_node):
-    '''Finds the correct fd chain object and appends event node to the chain'''
+def update_event_chain_cache(db_iface, loc_node, event_node, time_stamp):
+    '''Finds the correct fd chain object and adds event node, which began at
+    time_stamp, to the chain'''
     proc_node, _ = traversal.get_process_from_local(db_iface, loc_node)
     idx_list = db_iface.cache_man.get(storage.CACHE_NAMES.IO_EVENT_CHAIN,
                                       (proc_node.id, loc_node['name']))
     if idx_list is None:
-        logging.error("Unable to get cached events for pid: %d and fd: %s",
-                      proc_node['pid'], loc_node['name'])
+        # The chain may have been evicted, it is reloaded from the database
+        # when next needed
+        if __debug__:
+            logging.debug("Unable to get cached events for pid: %d and fd: %s",
+                          proc_node['pid'], loc_node['name'])
     else:
-        loc_index = idx_list.find(loc_node, key=lambda x: int(x['mono_time']))
-        fd_chain = idx_list[loc_index - 1]
-        fd_chain.chain.append(event_node)
+        fd_chain = idx_list.floor(traversal.get_mono_time(loc_node))
+        if fd_chain is not None:
+            fd_chain.chain.add(int(time_stamp), event_node)
 
 
 def add_event(db_iface, node, msg):
     '''Adds an event to node, automatically deriving the object type.'''
     rel_type = None
-    event_node = event_from_msg(db_iface, msg)
     node_type = node['type']
 
+    if (node_type == storage.NodeType.LOCAL and
+            db_iface.packed_events):
+        db_iface.append_event(node, msg.func_name, msg.ret_val,
+                              msg.begin_time, msg.end_time)
+        return
+
+    event_node = event_from_msg(db_iface, msg)
+
     if node_type == storage.NodeType.LOCAL:
         rel_type = storage.RelType.IO_EVENTS
     elif node_type == storage.NodeType.PROCESS:
@@ -162,7 +243,7 @@ def add_event(db_iface, node, msg):
 
     # Update IO_EVENT_CHAIN cache
     if node_type == storage.NodeType.LOCAL:
-        update_event_chain_cache(db_iface, node, event_node)
+        update_event_chain_cache(db_iface, node, event_node, msg.begin_time)
 
 
 def _bind_global_to_new_local(db_iface, proc_node, o_loc_node, i_loc_node):
@@ -206,6 +287,8 @@ def proc_dup_fd(db_iface, proc_node, fd_i, fd_o, lp_link_state=None):
     o_loc_node = pvm.get_l(db_iface, proc_node, fd_o)
     if lp_link_state is not None:
         db_iface.set_link_state(o_loc_node.PROC_OBJ.outgoing, lp_link_state)
+        pvm.FdTable.set_state(proc_node.id, fd_o, o_loc_node.id,
+                              lp_link_state)
 
     _bind_global_to_new_local(db_iface, proc_node, o_loc_node, i_loc_node)
 
@@ -214,7 +297,8 @@ def process_put_env(db_iface, proc_node, env, overwrite):
     '''Helper for edit processes environment, attempts to put name, val, ts
     into the processes environment. Clears keys if val is None, only overwrites
     existing keys if overwrite is set and inserts if the key is not found and
-    val is not None.'''
+    val is not None. Changes to variables from the processes environment
+    snapshot are recorded as ENV_META nodes that override the snapshot.'''
     found = False
     (name, val, time_stamp) = env
 
@@ -228,7 +312,14 @@ def process_put_env(db_iface, proc_node, env, overwrite):
                 break
             version_meta(db_iface, proc_node, meta_node, meta_rel, env)
 
-    if not found and val is not None:
+    if not found:
+        env_snapshot = traversal.get_proc_snapshot(
+            db_iface, proc_node, storage.RelType.ENV_SNAPSHOT)
+        if name in env_snapshot:
+            if not overwrite:
+                return
+        elif val is None:
+            return
         new_meta_node = new_meta(db_iface, name, val, time_stamp)
         db_iface.create_relationship(proc_node, new_meta_node,
                                      storage.RelType.ENV_META)
@@ -274,12 +365,15 @@ def set_link(db_iface, loc_node, state, glob_node_list=None):
     if len(glob_node_list) == 1:
         glob_node, rel_link = glob_node_list[0]
         rel_link['state'] = state
-        if state == storage.LinkState.BIN:
+        # A binary global is only added to the process index the first
+        # time it is exec'd
+        if (state == storage.LinkState.BIN and
+                db_iface.update_time_index(storage.StorageIFace.PROC_INDEX,
+                                           glob_node['sys_time'],
+                                           glob_node)):
             for name in glob_node['name']:
-                db_iface.update_index(storage.DBInterface.PROC_INDEX,
+                db_iface.update_index(storage.StorageIFace.PROC_INDEX,
                                       "name", name, glob_node)
-            db_iface.update_time_index(storage.DBInterface.PROC_INDEX,
-                                       glob_node['sys_time'], glob_node)
 
 
 def process_rw_pair(db_iface, proc_node, msg):
@@ -5,6 +5,8 @@ TODO
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import logging
+
 
 class ClientQueryControl(object):
     client_qry_methods = {}
@@ -20,7 +22,12 @@ class ClientQueryControl(object):
     def exec_method(cls, db_iface, msg):
         if msg['qry_method'] in cls.client_qry_methods:
             logging.info("opus.query.ClientQueryControl: method: %s, args: %s", repr(msg['qry_method']), repr(msg['qry_args']))
-            return cls.client_qry_methods[msg['qry_method']](db_iface,
-                                                             msg['qry_args'])
+            method = cls.client_qry_methods[msg['qry_method']]
+            if db_iface.supports_cypher:
+                return method(db_iface, msg['qry_args'])
+            # Graph walks read the backend directly, so they must not
+            # interleave with the analyser's transactions
+            with db_iface.trans_lock:
+                return method(db_iface, msg['qry_args'])
         else:
             return {"success": False, "msg": "Invalid query command"}
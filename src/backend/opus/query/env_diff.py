@@ -36,10 +36,16 @@ class DictDiffer(object):
                    if self.past_dict[o] == self.current_dict[o])
 
 
-def convert_to_dict(meta_lst):
-    meta_dict = {}
+def convert_to_dict(meta_lst, meta_dict=None):
+    '''Applies the meta nodes in meta_lst to meta_dict, a node
+    without a value removes its name'''
+    if meta_dict is None:
+        meta_dict = {}
     for meta_node in meta_lst:
-        meta_dict[meta_node['name']] = meta_node['value']
+        if meta_node.has_key('value'):
+            meta_dict[meta_node['name']] = meta_node['value']
+        else:
+            meta_dict.pop(meta_node['name'], None)
     return meta_dict
 
 
@@ -48,7 +54,33 @@ def get_date_time_str(sys_time):
         '%Y-%m-%d %H:%M:%S')
 
 
+def walk_proc_from_binary(db_iface, prog_name, start_date, end_date):
+    '''Returns the processes executed from the binary in order by walking
+    the graph'''
+    bin_glob_nodes = query_interface.find_globals(
+        db_iface, storage.StorageIFace.PROC_INDEX, prog_name)
+    bin_glob_nodes.sort(key=lambda node: node['sys_time'])
+
+    proc_list = []
+    for bin_glob_node in bin_glob_nodes:
+        for rel in bin_glob_node.LOC_OBJ.outgoing:
+            for proc_rel in rel.end.PROC_OBJ.outgoing:
+                proc_node = proc_rel.end
+                if (start_date is not None and end_date is not None and
+                        not (int(start_date) <= proc_node['sys_time'] <=
+                             int(end_date))):
+                    continue
+                proc_list.append(proc_node)
+    return proc_list
+
+
 def get_proc_from_binary(db_iface, prog_name, start_date, end_date):
+    if not db_iface.supports_cypher:
+        return [proc_node for proc_node in
+                walk_proc_from_binary(db_iface, prog_name, start_date,
+                                      end_date)
+                if not proc_node.PROC_PARENT.outgoing]
+
     proc_list = []
 
     qry = "START "
@@ -73,6 +105,9 @@ def get_proc_from_binary(db_iface, prog_name, start_date, end_date):
 
 def get_meta_data(db_iface, proc_node, rel_type):
     '''Returns list of environment varialbles for the process'''
+    if not db_iface.supports_cypher:
+        return [rel.end for rel in getattr(proc_node, rel_type).outgoing]
+
     meta_lst = []
 
     qry = "START "
@@ -87,12 +122,35 @@ def get_meta_data(db_iface, proc_node, rel_type):
     return meta_lst
 
 
+def get_snapshot_data(db_iface, proc_node, rel_type):
+    '''Returns the name to value dict of the meta snapshots of the process'''
+    meta_dict = {}
+    if not db_iface.supports_cypher:
+        for rel in getattr(proc_node, rel_type).outgoing:
+            meta_dict.update(zip(rel.end['keys'], rel.end['values']))
+        return meta_dict
+
+    qry = "START "
+    qry += "proc_node=node({id}) "
+    qry += "MATCH proc_node-[:" + rel_type + "]->snap_node  "
+    qry += "RETURN snap_node "
+    rows = db_iface.locked_query(qry, id=proc_node.id)
+
+    for row in rows:
+        snap_node = row['snap_node']
+        meta_dict.update(zip(snap_node['keys'], snap_node['values']))
+    return meta_dict
+
+
 def check_proc_bin_mod(db_iface, prog_name, proc_node1, proc_node2):
     '''Returns the process(es) that wrote to the binary
     between two process invocations'''
     start_date = proc_node1['sys_time']
     end_date = proc_node2['sys_time']
 
+    if not db_iface.supports_cypher:
+        return walk_proc_bin_mod(db_iface, prog_name, start_date, end_date)
+
     qry = "START glob_node=node:%s('%s %s')"
     time_idx_qry = query_interface.__construct_time_idx_qry(start_date,
                                                             end_date)
@@ -122,6 +180,28 @@ def check_proc_bin_mod(db_iface, prog_name, proc_node1, proc_node2):
             for row in result]
 
 
+def walk_proc_bin_mod(db_iface, prog_name, start_date, end_date):
+    '''Returns the process(es) that wrote to the binary between two dates by
+    walking the graph'''
+    write_states = [storage.LinkState.WRITE, storage.LinkState.RaW]
+    rows = {}
+    for glob_node in query_interface.find_globals(
+            db_iface, storage.StorageIFace.FILE_INDEX, prog_name,
+            start_date, end_date, pattern=True):
+        for _, proc_node, rel2 in query_interface.walk_proc_links(
+                glob_node, write_states, [storage.LinkState.BIN]):
+            if not start_date <= proc_node['sys_time'] <= end_date:
+                continue
+            bin_glob_node = rel2.start
+            mod_program = (bin_glob_node['name'][0]
+                           if bin_glob_node.has_key('name') else None)
+            rows[(mod_program, glob_node['name'][0], proc_node.id)] = \
+                (mod_program, proc_node)
+    return [{'prog': mod_program,
+             'date': get_date_time_str(proc_node['sys_time'])}
+            for mod_program, proc_node in rows.values()]
+
+
 def get_diff(dict1, dict2):
     diff = DictDiffer(dict2, dict1)
 
@@ -136,26 +216,38 @@ def get_diff(dict1, dict2):
 
 
 def diff_other_meta(db_iface, proc_node1, proc_node2):
-    other_meta_dict1 = convert_to_dict(get_meta_data(db_iface, proc_node1,
-                                       storage.RelType.OTHER_META))
-    other_meta_dict2 = convert_to_dict(get_meta_data(db_iface, proc_node2,
-                                       storage.RelType.OTHER_META))
+    other_meta_dict1 = convert_to_dict(
+        get_meta_data(db_iface, proc_node1, storage.RelType.OTHER_META),
+        get_snapshot_data(db_iface, proc_node1,
+                          storage.RelType.OTHER_SNAPSHOT))
+    other_meta_dict2 = convert_to_dict(
+        get_meta_data(db_iface, proc_node2, storage.RelType.OTHER_META),
+        get_snapshot_data(db_iface, proc_node2,
+                          storage.RelType.OTHER_SNAPSHOT))
     return get_diff(other_meta_dict1, other_meta_dict2)
 
 
 def diff_env_meta(db_iface, proc_node1, proc_node2):
-    env_meta_dict1 = convert_to_dict(get_meta_data(db_iface, proc_node1,
-                                     storage.RelType.ENV_META))
-    env_meta_dict2 = convert_to_dict(get_meta_data(db_iface, proc_node2,
-                                     storage.RelType.ENV_META))
+    env_meta_dict1 = convert_to_dict(
+        get_meta_data(db_iface, proc_node1, storage.RelType.ENV_META),
+        get_snapshot_data(db_iface, proc_node1,
+                          storage.RelType.ENV_SNAPSHOT))
+    env_meta_dict2 = convert_to_dict(
+        get_meta_data(db_iface, proc_node2, storage.RelType.ENV_META),
+        get_snapshot_data(db_iface, proc_node2,
+                          storage.RelType.ENV_SNAPSHOT))
     return get_diff(env_meta_dict1, env_meta_dict2)
 
 
 def diff_lib_meta(db_iface, proc_node1, proc_node2):
-    lib_meta_dict1 = convert_to_dict(get_meta_data(db_iface, proc_node1,
-                                     storage.RelType.LIB_META))
-    lib_meta_dict2 = convert_to_dict(get_meta_data(db_iface, proc_node2,
-                                     storage.RelType.LIB_META))
+    lib_meta_dict1 = convert_to_dict(
+        get_meta_data(db_iface, proc_node1, storage.RelType.LIB_META),
+        get_snapshot_data(db_iface, proc_node1,
+                          storage.RelType.LIB_SNAPSHOT))
+    lib_meta_dict2 = convert_to_dict(
+        get_meta_data(db_iface, proc_node2, storage.RelType.LIB_META),
+        get_snapshot_data(db_iface, proc_node2,
+                          storage.RelType.LIB_SNAPSHOT))
     return get_diff(lib_meta_dict1, lib_meta_dict2)
 
 
@@ -204,8 +296,8 @@ def get_diffs(db_iface, args):
     if not all(n in args for n in ('node_id1', 'node_id2', 'prog_name')):
         return {"success": False,
                 "msg": "Could not get process nodes"}
-    proc_node1 = db_iface.db.node[int(args['node_id1'])]
-    proc_node2 = db_iface.db.node[int(args['node_id2'])]
+    proc_node1 = db_iface.load_node(int(args['node_id1']))
+    proc_node2 = db_iface.load_node(int(args['node_id2']))
 
     return {"success": True,
             "bin_mods": check_proc_bin_mod(db_iface,
@@ -96,15 +96,27 @@ def get_cwd(proc_node):
         return cwd['value']
 
 
-def get_meta(link_type):
-    name_value_map = {}
+def get_meta(link_type, name_value_map=None):
+    if name_value_map is None:
+        name_value_map = {}
     for tmp_rel in link_type.outgoing:
-        if not tmp_rel.end.has_key('name') or not tmp_rel.end.has_key('value'):
+        if not tmp_rel.end.has_key('name'):
+            continue
+        if not tmp_rel.end.has_key('value'):
+            name_value_map.pop(tmp_rel.end['name'], None)
             continue
         name_value_map[tmp_rel.end['name']] = tmp_rel.end['value']
     return name_value_map
 
 
+def get_snapshot_meta(link_type):
+    name_value_map = {}
+    for tmp_rel in link_type.outgoing:
+        name_value_map.update(zip(tmp_rel.end['keys'],
+                                  tmp_rel.end['values']))
+    return name_value_map
+
+
 def descend_down_proc_tree(db_iface, proc_node, proc_tree_map):
     '''Recursively descends down the process hierarchy and finds
     files written, read or executed'''
@@ -140,25 +152,30 @@ def find_files_read_and_written_by_process(db_iface, proc_node, proc_tree_map):
     read_write_files = []
     cmd_args = get_command_args(proc_node)
     cwd = get_cwd(proc_node)
-    sys_meta = get_meta(proc_node.OTHER_META)
-    env_meta = get_meta(proc_node.ENV_META)
-    lib_meta = get_meta(proc_node.LIB_META)
-
-    rows = db_iface.locked_query(
-        "START proc_node=node(" + str(proc_node.id) + ") "
-        "MATCH proc_node<-[:PROC_OBJ]-loc_node, "
-        "loc_node<-[rel:LOC_OBJ]-glob_node "
-        "WHERE rel.state in [{r},{w},{rw},{b}] "
-        "RETURN glob_node, rel "
-        "ORDER BY glob_node.node_id desc",
-        r=storage.LinkState.READ,
-        w=storage.LinkState.WRITE,
-        rw=storage.LinkState.RaW,
-        b=storage.LinkState.BIN)
-
-    for row in rows:
-        glob_node = row['glob_node']
-        rel = row['rel']
+    sys_meta = get_meta(proc_node.OTHER_META,
+                        get_snapshot_meta(proc_node.OTHER_SNAPSHOT))
+    env_meta = get_meta(proc_node.ENV_META,
+                        get_snapshot_meta(proc_node.ENV_SNAPSHOT))
+    lib_meta = get_meta(proc_node.LIB_META,
+                        get_snapshot_meta(proc_node.LIB_SNAPSHOT))
+
+    if db_iface.supports_cypher:
+        rows = db_iface.locked_query(
+            "START proc_node=node(" + str(proc_node.id) + ") "
+            "MATCH proc_node<-[:PROC_OBJ]-loc_node, "
+            "loc_node<-[rel:LOC_OBJ]-glob_node "
+            "WHERE rel.state in [{r},{w},{rw},{b}] "
+            "RETURN glob_node, rel "
+            "ORDER BY glob_node.node_id desc",
+            r=storage.LinkState.READ,
+            w=storage.LinkState.WRITE,
+            rw=storage.LinkState.RaW,
+            b=storage.LinkState.BIN)
+        rows = [(row['glob_node'], row['rel']) for row in rows]
+    else:
+        rows = walk_globals_of_process(proc_node)
+
+    for glob_node, rel in rows:
 
         if check_filter(glob_node) is False:
             continue
@@ -219,6 +236,35 @@ def find_files_read_and_written_by_process(db_iface, proc_node, proc_tree_map):
             get_write_history(db_iface, gnode['name'][0], proc_tree_map)
 
 
+def walk_globals_of_process(proc_node):
+    '''Returns (global, LOC_OBJ relationship) for the files read, written or
+    executed by the process, latest global first'''
+    states = [storage.LinkState.READ, storage.LinkState.WRITE,
+              storage.LinkState.RaW, storage.LinkState.BIN]
+    rows = []
+    for loc_rel in proc_node.PROC_OBJ.incoming:
+        for rel in loc_rel.start.LOC_OBJ.incoming:
+            if rel['state'] in states:
+                rows.append((rel.start, rel))
+    rows.sort(key=lambda row: row[0]['node_id'], reverse=True)
+    return rows
+
+
+def walk_write_history(db_iface, file_name):
+    '''Returns the processes that wrote to file_name, latest first'''
+    procs = {}
+    for glob_node in db_iface.get_indexed(storage.StorageIFace.FILE_INDEX,
+                                          'name', file_name):
+        for rel in glob_node.LOC_OBJ.outgoing:
+            if rel['state'] not in [storage.LinkState.WRITE,
+                                    storage.LinkState.RaW]:
+                continue
+            for proc_rel in rel.end.PROC_OBJ.outgoing:
+                procs[proc_rel.end.id] = proc_rel.end
+    return sorted(procs.values(), key=lambda node: node['node_id'],
+                  reverse=True)
+
+
 def get_write_history(db_iface, file_name, proc_tree_map):
 
     if file_name in GlobData.file_hist_list:
@@ -227,19 +273,22 @@ def get_write_history(db_iface, file_name, proc_tree_map):
     GlobData.file_hist_list.append(file_name)
     logging.debug("Getting write histories for: %s", file_name)
 
-    rows = db_iface.locked_query(
-        "START file_glob_node=node:FILE_INDEX('name:\"" + file_name + "\"') "
-        "MATCH file_glob_node-[rel1:LOC_OBJ]->file_loc_node,  "
-        "file_loc_node-[:PROC_OBJ]->proc_node "
-        "WHERE rel1.state in [{w},{rw}] "
-        "RETURN distinct proc_node "
-        "ORDER by proc_node.node_id DESC",
-        w=storage.LinkState.WRITE,
-        rw=storage.LinkState.RaW)
-
-    for row in rows:
-        proc_node = row['proc_node']
-
+    if db_iface.supports_cypher:
+        rows = db_iface.locked_query(
+            "START file_glob_node=node:FILE_INDEX('name:\"" + file_name +
+            "\"') "
+            "MATCH file_glob_node-[rel1:LOC_OBJ]->file_loc_node,  "
+            "file_loc_node-[:PROC_OBJ]->proc_node "
+            "WHERE rel1.state in [{w},{rw}] "
+            "RETURN distinct proc_node "
+            "ORDER by proc_node.node_id DESC",
+            w=storage.LinkState.WRITE,
+            rw=storage.LinkState.RaW)
+        proc_nodes = [row['proc_node'] for row in rows]
+    else:
+        proc_nodes = walk_write_history(db_iface, file_name)
+
+    for proc_node in proc_nodes:
         if file_name == GlobData.queried_file:
             update_last_modified_time(proc_node['sys_time'])
 
@@ -281,7 +330,7 @@ def get_all_processes(db_iface, proc_tree_map):
 
     proc_nodes = sorted(set(proc_nodes))
     for node_id in proc_nodes:
-        proc_node = db_iface.db.node[node_id]
+        proc_node = db_iface.load_node(node_id)
         descend_down_proc_tree(db_iface, proc_node, proc_tree_map)
 
 
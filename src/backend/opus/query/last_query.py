@@ -3,12 +3,57 @@ from __future__ import (absolute_import, division,
 import datetime
 
 from . import client_query
+from .. import storage, query_interface
 
 
 def fmt_time(time):
     return datetime.datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
 
 
+def get_meta_values(proc_node, name):
+    '''Returns the non empty values of the OTHER_META nodes of the process
+    with the given name'''
+    return [rel.end['value'] for rel in proc_node.OTHER_META.outgoing
+            if rel.end['name'] == name and rel.end.has_key('value') and
+            rel.end['value'] != '']
+
+
+def walk_file(db_iface, name, result_limit):
+    '''Returns (process, cmd_args) of the last processes that wrote to the
+    files matching name by walking the graph'''
+    rows = {}
+    for glob_node in query_interface.find_globals(
+            db_iface, storage.StorageIFace.FILE_INDEX, name, pattern=True):
+        for rel in glob_node.LOC_OBJ.outgoing:
+            if rel['state'] not in [storage.LinkState.WRITE,
+                                    storage.LinkState.RaW]:
+                continue
+            for proc_rel in rel.end.PROC_OBJ.outgoing:
+                proc_node = proc_rel.end
+                for val in get_meta_values(proc_node, 'cmd_args'):
+                    rows[(proc_node.id, val)] = (proc_node, val)
+    rows = sorted(rows.values(), key=lambda row: row[0]['sys_time'],
+                  reverse=True)
+    return rows[:result_limit]
+
+
+def walk_folder(db_iface, name, result_limit):
+    '''Returns (process, cmd_args) of the last processes run with name as
+    their working directory by walking the graph'''
+    rows = []
+    for glob_node in query_interface.find_globals(
+            db_iface, storage.StorageIFace.PROC_INDEX, None):
+        for rel in glob_node.LOC_OBJ.outgoing:
+            for proc_rel in rel.end.PROC_OBJ.outgoing:
+                proc_node = proc_rel.end
+                if name not in get_meta_values(proc_node, 'cwd'):
+                    continue
+                rows.extend((proc_node, val) for val in
+                            get_meta_values(proc_node, 'cmd_args'))
+    rows.sort(key=lambda row: row[0]['sys_time'], reverse=True)
+    return rows[:result_limit]
+
+
 @client_query.ClientQueryControl.register_query_method("query_file")
 def query_file(db_iface, args):
     '''Given a file name, this method returns the
@@ -21,18 +66,22 @@ def query_file(db_iface, args):
     if 'name' not in args:
         return {"success": False, "msg": "File name not provided in message"}
 
-    rows = db_iface.locked_query(
-        "START g1=node:FILE_INDEX('name:" + args['name'] + "') "
-        "MATCH (g1)-[:GLOBAL_OBJ_PREV*0..]->(gn)-[r1:LOC_OBJ]->(l)"
-        "-[:PROC_OBJ]->(p)-[:OTHER_META]->(m) "
-        "WHERE m.name = 'cmd_args' AND r1.state in [3,4] "
-        "AND m.value <> '' "
-        "RETURN distinct p, m.value as val "
-        "ORDER BY p.sys_time DESC LIMIT " + result_limit)
+    if db_iface.supports_cypher:
+        rows = db_iface.locked_query(
+            "START g1=node:FILE_INDEX('name:" + args['name'] + "') "
+            "MATCH (g1)-[:GLOBAL_OBJ_PREV*0..]->(gn)-[r1:LOC_OBJ]->(l)"
+            "-[:PROC_OBJ]->(p)-[:OTHER_META]->(m) "
+            "WHERE m.name = 'cmd_args' AND r1.state in [3,4] "
+            "AND m.value <> '' "
+            "RETURN distinct p, m.value as val "
+            "ORDER BY p.sys_time DESC LIMIT " + result_limit)
+        rows = [(r['p'], r['val']) for r in rows]
+    else:
+        rows = walk_file(db_iface, args['name'], int(result_limit))
 
-    data = [{'ts': fmt_time(r['p']['sys_time']),
-             'cmd': r['val']}
-            for r in rows]
+    data = [{'ts': fmt_time(proc_node['sys_time']),
+             'cmd': val}
+            for proc_node, val in rows]
 
     if len(data) > 0:
         return {'success': True, 'data': data}
@@ -52,20 +101,24 @@ def query_folder(db_iface, args):
     if 'name' not in args:
         return {"success": False, "msg": "Folder name not provided in message"}
 
-    rows = db_iface.locked_query(
-        "START g=node:PROC_INDEX('name:*') "
-        "MATCH (g)-[:LOC_OBJ]->(l)-[:PROC_OBJ]->(p),"
-        "      (p)-[:OTHER_META]->(m),"
-        "      (p)-[:OTHER_META]->(m1) "
-        "WHERE m.name = 'cwd' AND m.value = \"" + args['name'] + "\" "
-        "AND m1.name = 'cmd_args' "
-        "AND m1.value <> '' "
-        "RETURN m1.value as val, p "
-        "ORDER BY p.sys_time DESC LIMIT " + result_limit)
-
-    data = [{'ts': fmt_time(r['p']['sys_time']),
-             'cmd': r['val']}
-            for r in rows]
+    if db_iface.supports_cypher:
+        rows = db_iface.locked_query(
+            "START g=node:PROC_INDEX('name:*') "
+            "MATCH (g)-[:LOC_OBJ]->(l)-[:PROC_OBJ]->(p),"
+            "      (p)-[:OTHER_META]->(m),"
+            "      (p)-[:OTHER_META]->(m1) "
+            "WHERE m.name = 'cwd' AND m.value = \"" + args['name'] + "\" "
+            "AND m1.name = 'cmd_args' "
+            "AND m1.value <> '' "
+            "RETURN m1.value as val, p "
+            "ORDER BY p.sys_time DESC LIMIT " + result_limit)
+        rows = [(r['p'], r['val']) for r in rows]
+    else:
+        rows = walk_folder(db_iface, args['name'], int(result_limit))
+
+    data = [{'ts': fmt_time(proc_node['sys_time']),
+             'cmd': val}
+            for proc_node, val in rows]
 
     if len(data) > 0:
         return {'success': True, 'data': data}
@@ -89,15 +89,109 @@ def __construct_time_idx_qry(start_date, end_date):
     return time_idx_qry
 
 
-def __construct_prog_qry(file_states, proc_states):
+def __time_buckets(start_date, end_date):
+    '''Returns the first and last hourly buckets of a date range, or None'''
+    if not (start_date and end_date):
+        return None
+    return (int(start_date) - (int(start_date) % 3600),
+            int(end_date) - (int(end_date) % 3600))
+
+
+def __walk_bucket_lineage(idx_node, idx_type):
+    '''Returns idx_node and the later versions of its lineage that share
+    its time bucket, the node API counterpart of __construct_lineage_qry'''
+    prop = storage.StorageIFace.TIME_BUCKET_PROPS[idx_type]
+    if not idx_node.has_key(prop):
+        return [idx_node]
+    bucket = idx_node[prop]
+    lineage = [idx_node]
+    seen = set([idx_node.id])
+    for glob_node in lineage:
+        for link in glob_node.GLOB_OBJ_PREV.incoming:
+            next_node = link.start
+            if (next_node.id not in seen and next_node.has_key(prop) and
+                    next_node[prop] == bucket):
+                seen.add(next_node.id)
+                lineage.append(next_node)
+    return lineage
+
+
+def find_globals(db_iface, idx_type, search_str, start_date=None,
+                 end_date=None, lineage=False, pattern=False):
+    '''Returns the globals indexed with the name search_str, or with a name
+    matching it as a shell style pattern, all of them if it is None. Given a
+    date range only globals with a time index entry in it are returned,
+    with lineage also the later versions sharing the entry's time bucket.
+    This is the node API counterpart of the index START clauses for
+    backends without Cypher.'''
+    if search_str is None:
+        glob_nodes = db_iface.find_indexed(idx_type, 'name', "*")
+    elif pattern:
+        glob_nodes = db_iface.find_indexed(idx_type, 'name', search_str)
+    else:
+        glob_nodes = db_iface.get_indexed(idx_type, 'name', search_str)
+    buckets = __time_buckets(start_date, end_date)
+    if buckets is None:
+        return glob_nodes
+
+    in_range = set(node.id for node in
+                   db_iface.get_indexed_range(idx_type, 'time', *buckets))
+    glob_nodes = [node for node in glob_nodes if node.id in in_range]
+    if not lineage:
+        return glob_nodes
+
+    versions = {}
+    for idx_node in glob_nodes:
+        for glob_node in __walk_bucket_lineage(idx_node, idx_type):
+            versions[glob_node.id] = glob_node
+    return [versions[node_id] for node_id in sorted(versions)]
+
+
+def walk_proc_links(glob_node, glob_states, other_states):
+    '''Yields (rel, proc_node, other_rel) for each path
+    glob_node-[rel:LOC_OBJ]->()-[:PROC_OBJ]->proc_node<-[:PROC_OBJ]-()
+    <-[other_rel:LOC_OBJ]-() where the LOC_OBJ states are in glob_states
+    and other_states, the node API counterpart of the MATCH clauses below'''
+    for rel in glob_node.LOC_OBJ.outgoing:
+        if rel['state'] not in glob_states:
+            continue
+        for proc_rel in rel.end.PROC_OBJ.outgoing:
+            proc_node = proc_rel.end
+            for other_proc_rel in proc_node.PROC_OBJ.incoming:
+                if other_proc_rel.id == proc_rel.id:
+                    continue
+                for other_rel in other_proc_rel.start.LOC_OBJ.incoming:
+                    if other_rel['state'] in other_states:
+                        yield rel, proc_node, other_rel
+
+
+def __construct_lineage_qry(idx_node, glob_node):
+    '''Returns a match pattern and condition binding glob_node to the
+    versions of idx_node's lineage in the same hourly bucket. A file lineage
+    only holds one time index entry per bucket, so the later versions in the
+    bucket are only found through the first. The expansion stops at the
+    first version outside the bucket.'''
+    prop = storage.StorageIFace.TIME_BUCKET_PROPS[
+        storage.StorageIFace.FILE_INDEX]
+    path = glob_node + "_lineage"
+    pattern = (path + "=" + idx_node + "<-[:GLOB_OBJ_PREV*0..]-" +
+               glob_node + ", ")
+    cond = (" AND ALL(n IN nodes(" + path + ") WHERE n = " + idx_node +
+            " OR n." + prop + "! = " + idx_node + "." + prop + "!) ")
+    return (pattern, cond)
+
+
+def __construct_prog_qry(file_states, proc_states, lineage_qry=("", "")):
     '''Constructs and returns a query string to get programs
     from a given file'''
-    tmp_qry = " MATCH glob_node-[rel1:LOC_OBJ]->loc_node, "
+    tmp_qry = " MATCH " + lineage_qry[0]
+    tmp_qry += "glob_node-[rel1:LOC_OBJ]->loc_node, "
     tmp_qry += " loc_node-[:PROC_OBJ]->proc_node, "
     tmp_qry += " proc_node<-[:PROC_OBJ]-bin_loc_node, "
     tmp_qry += " bin_loc_node<-[rel2:LOC_OBJ]-bin_glob_node "
     tmp_qry += " WHERE rel1.state in [" + file_states + "]"
     tmp_qry += " AND rel2.state in [" + proc_states + "] "
+    tmp_qry += lineage_qry[1]
     return tmp_qry
 
 
@@ -148,18 +242,22 @@ def __add_result(result_list, bin_glob_node, proc_node,
                         file_glob_node['node_id']))
 
 
-def __get_history(db_iface, qry, file_states, proc_states):
+def __get_history(db_iface, qry, file_states, proc_states,
+                  lineage_qry=("", "")):
     '''Builds and executes a query to to get the process/file
     history after applying filters'''
     result_list = []
 
-    tmp_qry = " MATCH bin_glob_node-[rel1:LOC_OBJ]->loc_node, "
+    tmp_qry = " MATCH " + lineage_qry[0]
+    tmp_qry += "bin_glob_node-[rel1:LOC_OBJ]->loc_node, "
     tmp_qry += "loc_node-[:PROC_OBJ]->proc_node, "
     tmp_qry += "proc_node<-[:PROC_OBJ]-file_loc_node, "
     tmp_qry += "file_loc_node<-[rel2:LOC_OBJ]-file_glob_node "
     tmp_qry += "WHERE rel1.state in [" + proc_states + "] "
     tmp_qry += "AND rel2.state in [" + file_states + "] "
-    tmp_qry += "RETURN bin_glob_node, proc_node, file_glob_node, rel2 "
+    tmp_qry += lineage_qry[1]
+    tmp_qry += "RETURN DISTINCT bin_glob_node, proc_node, file_glob_node, "
+    tmp_qry += "rel2 "
     tmp_qry += "ORDER by file_glob_node.node_id DESC"
     qry += tmp_qry
 
@@ -175,8 +273,42 @@ def __get_history(db_iface, qry, file_states, proc_states):
     return result_list
 
 
+def __walk_file_proc_tree(db_iface, search_str, start_date, end_date,
+                          idx_type):
+    '''Retrieves file/process tree given time range and index type by
+    walking the graph'''
+    file_states = [storage.LinkState.READ, storage.LinkState.WRITE,
+                   storage.LinkState.RaW, storage.LinkState.NONE]
+    proc_states = [storage.LinkState.BIN]
+
+    if idx_type == storage.DBInterface.FILE_INDEX:
+        glob_nodes = find_globals(db_iface, idx_type, search_str,
+                                  start_date, end_date, lineage=True)
+        glob_nodes = [node for node in glob_nodes if node.has_key('name')]
+        states = (file_states, proc_states)
+    else:
+        glob_nodes = find_globals(db_iface, idx_type, search_str,
+                                  start_date, end_date)
+        states = (proc_states, file_states)
+
+    names = set()
+    for glob_node in glob_nodes:
+        for _, _, other_rel in walk_proc_links(glob_node, *states):
+            other_glob_node = other_rel.start
+            if other_glob_node.has_key('name'):
+                names.update(other_glob_node['name'])
+
+    tree_obj = FSTree()
+    for name in names:
+        tree_obj.build(name)
+    return tree_obj
+
+
 def __get_file_proc_tree(db_iface, search_str, start_date, end_date, idx_type):
     '''Retrieves file/process tree given time range and index type'''
+    if not db_iface.supports_cypher:
+        return __walk_file_proc_tree(db_iface, search_str, start_date,
+                                     end_date, idx_type)
 
     key_str = ""
     file_states = str(storage.LinkState.READ)
@@ -192,17 +324,21 @@ def __get_file_proc_tree(db_iface, search_str, start_date, end_date, idx_type):
         search_str = "\"" + search_str + "\""
 
     qry = "START glob_node=node:%s('%s %s')"
+    lineage_qry = ("", "")
 
     time_idx_qry = __construct_time_idx_qry(start_date, end_date)
     if time_idx_qry is not None:
         time_idx_qry += " AND "
+        if idx_type == storage.DBInterface.FILE_INDEX:
+            qry = "START idx_node=node:%s('%s %s')"
+            lineage_qry = __construct_lineage_qry("idx_node", "glob_node")
     else:
         time_idx_qry = ""
 
     qry = qry % (idx_type, time_idx_qry, __construct_name_idx_qry(search_str))
 
     if idx_type == storage.DBInterface.FILE_INDEX:
-        qry += __construct_prog_qry(file_states, proc_states)
+        qry += __construct_prog_qry(file_states, proc_states, lineage_qry)
         qry += " AND HAS (glob_node.name) "
         qry += " WITH DISTINCT bin_glob_node.name as bin_name "
         qry += " RETURN bin_name"
@@ -252,6 +388,47 @@ def __build_idx_qry(node_name, search_str, idx_type, time_idx_qry):
     return tmp_qry
 
 
+def __walk_file_proc_history(db_iface, file_name, proc_name,
+                             start_date, end_date):
+    '''Returns the history of a file/process by walking the graph, in the
+    format of get_file_proc_history'''
+    file_states = [storage.LinkState.READ, storage.LinkState.WRITE,
+                   storage.LinkState.RaW, storage.LinkState.NONE]
+    proc_states = [storage.LinkState.BIN]
+
+    bin_ids = None
+    if proc_name is not None:
+        bin_nodes = find_globals(db_iface, storage.DBInterface.PROC_INDEX,
+                                 proc_name, start_date, end_date)
+        bin_ids = set(node.id for node in bin_nodes)
+
+    rows = {}
+    if file_name is not None:
+        for file_glob_node in find_globals(db_iface,
+                                           storage.DBInterface.FILE_INDEX,
+                                           file_name, start_date, end_date,
+                                           lineage=True):
+            for rel2, proc_node, rel1 in walk_proc_links(file_glob_node,
+                                                         file_states,
+                                                         proc_states):
+                if bin_ids is None or rel1.start.id in bin_ids:
+                    rows[(rel1.id, rel2.id)] = (rel1.start, proc_node,
+                                                file_glob_node, rel2)
+    else:
+        for bin_glob_node in bin_nodes:
+            for rel1, proc_node, rel2 in walk_proc_links(bin_glob_node,
+                                                         proc_states,
+                                                         file_states):
+                rows[(rel1.id, rel2.id)] = (bin_glob_node, proc_node,
+                                            rel2.start, rel2)
+
+    result_list = []
+    for row in sorted(rows.values(), key=lambda row: row[2]['node_id'],
+                      reverse=True):
+        __add_result(result_list, *row)
+    return result_list
+
+
 # Query for the right panel
 def get_file_proc_history(db_iface, file_name, proc_name, user_name,
                           start_date, end_date):
@@ -262,6 +439,10 @@ def get_file_proc_history(db_iface, file_name, proc_name, user_name,
     if (file_name is None) and (proc_name is None):
         raise InvalidQueryException()
 
+    if not db_iface.supports_cypher:
+        return __walk_file_proc_history(db_iface, file_name, proc_name,
+                                        start_date, end_date)
+
     file_states = str(storage.LinkState.READ)
     file_states += ", " + str(storage.LinkState.WRITE)
     file_states += ", " + str(storage.LinkState.RaW)
@@ -274,6 +455,7 @@ def get_file_proc_history(db_iface, file_name, proc_name, user_name,
     file_idx_qry = ""
     proc_idx_qry = ""
     comma_char = ""
+    lineage_qry = ("", "")
 
     # Build time index range query
     time_idx_qry = __construct_time_idx_qry(start_date, end_date)
@@ -283,7 +465,11 @@ def get_file_proc_history(db_iface, file_name, proc_name, user_name,
         time_idx_qry = ""
 
     if file_name is not None:
-        file_idx_qry = __build_idx_qry("file_glob_node", file_name,
+        file_node = "file_glob_node"
+        if time_idx_qry:
+            file_node = "file_idx_node"
+            lineage_qry = __construct_lineage_qry(file_node, "file_glob_node")
+        file_idx_qry = __build_idx_qry(file_node, file_name,
                                        storage.DBInterface.FILE_INDEX,
                                        time_idx_qry)
 
@@ -297,4 +483,5 @@ def get_file_proc_history(db_iface, file_name, proc_name, user_name,
 
     qry = qry % (file_idx_qry, comma_char, proc_idx_qry)
 
-    return __get_history(db_iface, qry, file_states, proc_states)
+    return __get_history(db_iface, qry, file_states, proc_states,
+                         lineage_qry)
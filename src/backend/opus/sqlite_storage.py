@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+'''
+SQLite implementation of the storage interface. The provenance graph is held
+in a single database file and needs no JVM.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import weakref
+
+from .storage import StorageIFace, SCHEMA_VERSION, format_stack
+
+
+def _encode_value(value):
+    '''Returns the value and kind column values for a property value.
+    Kind 0 values are stored as is, lists as JSON and bools as integers.'''
+    if isinstance(value, bool):
+        return int(value), 2
+    elif isinstance(value, (list, tuple)):
+        return json.dumps(list(value)), 1
+    return value, 0
+
+
+def _decode_value(value, kind):
+    '''Rebuilds a property value from its value and kind columns'''
+    if kind == 1:
+        return json.loads(value)
+    elif kind == 2:
+        return bool(value)
+    return value
+
+
+class SQLiteRelView(object):
+    '''The relationships of a node, optionally restricted to one type'''
+
+    def __init__(self, iface, node_id, rel_type=None):
+        self.iface = iface
+        self.node_id = node_id
+        self.rel_type = rel_type
+
+    @property
+    def incoming(self):
+        '''Relationships ending at the node'''
+        return self.iface.get_rels('end_id', self.node_id, self.rel_type)
+
+    @property
+    def outgoing(self):
+        '''Relationships starting at the node'''
+        return self.iface.get_rels('start_id', self.node_id, self.rel_type)
+
+    def create(self, rel_type, to_node):
+        '''Creates a relationship of rel_type from the node to to_node'''
+        return self.iface.new_relationship(self.node_id, to_node.id,
+                                           rel_type)
+
+
+class SQLiteNode(object):
+    '''Node proxy, properties are read on first access and written through
+    to the interface's write buffer'''
+
+    def __init__(self, iface, node_id, props=None):
+        self.iface = iface
+        self.id = node_id
+        self.props = props
+        self.relationships = SQLiteRelView(iface, node_id)
+
+    def __getattr__(self, name):
+        # Relationship types are upper case, e.g. node.PROC_OBJ.incoming
+        if name.isupper():
+            return SQLiteRelView(self.iface, self.id, name)
+        raise AttributeError(name)
+
+    def _get_props(self):
+        if self.props is None:
+            self.props = self.iface.load_props('node_props', self.id)
+        return self.props
+
+    def __getitem__(self, key):
+        val = self._get_props()[key]
+        return list(val) if isinstance(val, list) else val
+
+    def __setitem__(self, key, val):
+        if isinstance(val, (list, tuple)):
+            val = list(val)
+        self._get_props()[key] = val
+        self.iface.write_prop('node_props', self.id, key, val)
+
+    def has_key(self, key):
+        return key in self._get_props()
+
+    def __contains__(self, key):
+        return key in self._get_props()
+
+    def keys(self):
+        return self._get_props().keys()
+
+    def __eq__(self, other):
+        return isinstance(other, SQLiteNode) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<SQLiteNode %d>" % self.id
+
+
+class SQLiteRelationship(object):
+    '''Relationship proxy, has no relationships attribute so the cache
+    manager can tell it apart from a node'''
+
+    def __init__(self, iface, rel_id, start_id, end_id, rel_type,
+                 props=None):
+        self.iface = iface
+        self.id = rel_id
+        self.start_id = start_id
+        self.end_id = end_id
+        self.type = rel_type
+        self.props = props
+
+    @property
+    def start(self):
+        return self.iface.get_node(self.start_id)
+
+    @property
+    def end(self):
+        return self.iface.get_node(self.end_id)
+
+    def _get_props(self):
+        if self.props is None:
+            self.props = self.iface.load_props('rel_props', self.id)
+        return self.props
+
+    def __getitem__(self, key):
+        return self._get_props()[key]
+
+    def __setitem__(self, key, val):
+        self._get_props()[key] = val
+        self.iface.write_prop('rel_props', self.id, key, val)
+
+    def has_key(self, key):
+        return key in self._get_props()
+
+    def delete(self):
+        '''Deletes the relationship and its properties'''
+        self.iface.del_relationship(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, SQLiteRelationship) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<SQLiteRelationship %d %s>" % (self.id, self.type)
+
+
+class SQLiteInterface(StorageIFace):
+    '''SQLite implementation of storage interface. Nodes, relationships,
+    their properties and the indexes are tables of a single database opened
+    in WAL mode. Writes are buffered and applied as batched executemany
+    calls of a fixed set of statements, which the connection keeps
+    prepared, when a transaction commits. Until then reads combine the
+    database with the buffered writes.'''
+
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS nodes "
+              "(id INTEGER PRIMARY KEY)",
+              "CREATE TABLE IF NOT EXISTS rels "
+              "(id INTEGER PRIMARY KEY, start_id INTEGER NOT NULL, "
+              "end_id INTEGER NOT NULL, type TEXT NOT NULL)",
+              "CREATE INDEX IF NOT EXISTS rels_start ON rels (start_id, type)",
+              "CREATE INDEX IF NOT EXISTS rels_end ON rels (end_id, type)",
+              "CREATE TABLE IF NOT EXISTS node_props "
+              "(id INTEGER NOT NULL, key TEXT NOT NULL, value, "
+              "kind INTEGER NOT NULL, PRIMARY KEY (id, key))",
+              "CREATE TABLE IF NOT EXISTS rel_props "
+              "(id INTEGER NOT NULL, key TEXT NOT NULL, value, "
+              "kind INTEGER NOT NULL, PRIMARY KEY (id, key))",
+              "CREATE TABLE IF NOT EXISTS idx "
+              "(idx_type TEXT NOT NULL, name TEXT NOT NULL, key, "
+              "node_id INTEGER NOT NULL, "
+              "UNIQUE (idx_type, name, key, node_id))",
+              "CREATE TABLE IF NOT EXISTS meta "
+              "(key TEXT PRIMARY KEY, value)"]
+
+    INSERT_NODE = "INSERT INTO nodes (id) VALUES (?)"
+    INSERT_REL = ("INSERT INTO rels (id, start_id, end_id, type) "
+                  "VALUES (?, ?, ?, ?)")
+    DELETE_REL = "DELETE FROM rels WHERE id = ?"
+    DELETE_REL_PROPS = "DELETE FROM rel_props WHERE id = ?"
+    SET_PROP = ("INSERT OR REPLACE INTO %s (id, key, value, kind) "
+                "VALUES (?, ?, ?, ?)")
+    DB_FILE = "opus.sqlite"
+
+    INSERT_IDX = ("INSERT OR IGNORE INTO idx (idx_type, name, key, node_id) "
+                  "VALUES (?, ?, ?, ?)")
+
+    def __init__(self, filename, cache_sizes=None,
+                 name_filter_capacity=10000000, name_filter_error_rate=0.001,
+                 packed_events=False, index_event_times=True,
+                 packed_flush_events=1000, packed_flush_span_ms=1000,
+                 name_filter_dump_interval_s=600, page_cache_mb=64,
+                 cached_statements=100, **kwargs):
+        super(SQLiteInterface, self).__init__(cache_sizes,
+                                              name_filter_capacity,
+                                              name_filter_error_rate,
+                                              packed_events,
+                                              index_event_times,
+                                              packed_flush_events,
+                                              packed_flush_span_ms,
+                                              name_filter_dump_interval_s,
+                                              **kwargs)
+        # filename may still name a database directory of another backend
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, SQLiteInterface.DB_FILE)
+        self.page_cache_mb = page_cache_mb  # Configurable
+        self.cached_statements = cached_statements  # Configurable
+
+        # Buffered (statement, parameters) writes in the order they were made
+        self.writes = []
+
+        # The buffered writes again, in the form reads look them up
+        self.pending_nodes = set()
+        self.pending_props = {'node_props': {}, 'rel_props': {}}
+        self.pending_rels = {}
+        self.pending_rel_ends = {}
+        self.deleted_rels = set()
+        self.pending_idx = {}
+
+        # Live proxies, so each node and relationship has one proxy
+        self.node_proxies = weakref.WeakValueDictionary()
+        self.rel_proxies = weakref.WeakValueDictionary()
+
+        try:
+            # Transactions are managed explicitly with BEGIN and COMMIT
+            self.conn = sqlite3.connect(
+                filename, check_same_thread=False, isolation_level=None,
+                cached_statements=self.cached_statements)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA cache_size=%d" %
+                              -(self.page_cache_mb * 1024))
+            with self.start_transaction():
+                for stmt in SQLiteInterface.SCHEMA:
+                    self.conn.execute(stmt)
+                row = self.conn.execute("SELECT value FROM meta "
+                                        "WHERE key = 'schema_version'"
+                                        ).fetchone()
+                if row is None:
+                    self.conn.execute("INSERT INTO meta (key, value) "
+                                      "VALUES ('schema_version', ?)",
+                                      (SCHEMA_VERSION,))
+            self.__load_next_ids()
+        except Exception as exc:
+            logging.error("Error: %s %s", str(exc), format_stack())
+            raise exc
+
+    def __load_next_ids(self):
+        '''Node and relationship IDs are allocated here rather than by
+        SQLite so inserts can be buffered'''
+        self.next_node_id = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM nodes").fetchone()[0]
+        self.next_rel_id = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM rels").fetchone()[0]
+
+    def close(self):
+        '''Close the database file'''
+        super(SQLiteInterface, self).close()
+        self.conn.close()
+
+    def _transaction(self):
+        '''Returns a SQLite transaction'''
+
+        class SQLiteTransaction(object):
+
+            def __init__(self, iface):
+                self.iface = iface
+
+            def __enter__(self, *args, **kwargs):
+                self.iface.conn.execute("BEGIN")
+
+            def __exit__(self, exc_type, *args):
+                if exc_type is None:
+                    self.iface.flush_writes()
+                    self.iface.conn.execute("COMMIT")
+                else:
+                    self.iface.rollback()
+
+        return SQLiteTransaction(self)
+
+    def rollback(self):
+        '''Rolls back the current transaction, proxies reread their
+        properties on next access. IDs allocated in the transaction are not
+        handed out again, so proxies still held for them can never be
+        mistaken for later nodes or relationships.'''
+        self.__clear_pending()
+        self.conn.execute("ROLLBACK")
+        for node in self.node_proxies.values():
+            node.props = None
+        for rel in self.rel_proxies.values():
+            rel.props = None
+
+    def __clear_pending(self):
+        '''Drops the buffered writes'''
+        self.writes = []
+        self.pending_nodes = set()
+        self.pending_props = {'node_props': {}, 'rel_props': {}}
+        self.pending_rels = {}
+        self.pending_rel_ends = {}
+        self.deleted_rels = set()
+        self.pending_idx = {}
+
+    def flush_writes(self):
+        '''Applies the buffered writes, consecutive writes with the same
+        statement are made in a single executemany call'''
+        if not self.writes:
+            return
+        for stmt, group in itertools.groupby(self.writes,
+                                             key=lambda w: w[0]):
+            self.conn.executemany(stmt, [params for _, params in group])
+        self.__clear_pending()
+
+    def _read(self, stmt, params):
+        '''Executes a query against the database only, buffered writes
+        are not yet visible to it'''
+        return self.conn.execute(stmt, params).fetchall()
+
+    def get_node(self, node_id, props=None):
+        '''Returns the proxy for a node'''
+        node = self.node_proxies.get(node_id)
+        if node is None:
+            node = SQLiteNode(self, node_id, props)
+            self.node_proxies[node_id] = node
+        elif props is not None:
+            node.props = props
+        return node
+
+    def __get_rel(self, rel_id, start_id, end_id, rel_type, props=None):
+        '''Returns the proxy for a relationship'''
+        rel = self.rel_proxies.get(rel_id)
+        if rel is None:
+            rel = SQLiteRelationship(self, rel_id, start_id, end_id,
+                                     rel_type, props)
+            self.rel_proxies[rel_id] = rel
+        else:
+            rel.start_id = start_id
+            rel.end_id = end_id
+            rel.type = rel_type
+            if props is not None:
+                rel.props = props
+        return rel
+
+    def get_rels(self, column, node_id, rel_type):
+        '''Returns the relationships with node_id as their start_id or
+        end_id column in creation order, optionally of one type'''
+        if node_id in self.pending_nodes:
+            rows = []
+        elif rel_type is None:
+            rows = self._read("SELECT id, start_id, end_id, type FROM rels "
+                              "WHERE " + column + " = ? ORDER BY id",
+                              (node_id,))
+        else:
+            rows = self._read("SELECT id, start_id, end_id, type FROM rels "
+                              "WHERE " + column + " = ? AND type = ? "
+                              "ORDER BY id", (node_id, rel_type))
+        # Buffered relationships have higher IDs than any in the database
+        rows.extend(row for row in self.pending_rel_ends.get((column,
+                                                               node_id), [])
+                    if rel_type is None or row[3] == rel_type)
+        return [self.__get_rel(*row) for row in rows
+                if row[0] not in self.deleted_rels]
+
+    def load_props(self, table, ref_id):
+        '''Reads the properties of a node or relationship'''
+        if table == 'node_props':
+            in_db = ref_id not in self.pending_nodes
+        else:
+            in_db = (ref_id not in self.pending_rels and
+                     ref_id not in self.deleted_rels)
+        if in_db:
+            rows = self._read("SELECT key, value, kind FROM " + table +
+                              " WHERE id = ?", (ref_id,))
+            props = {key: _decode_value(value, kind)
+                     for key, value, kind in rows}
+        else:
+            props = {}
+        props.update(self.pending_props[table].get(ref_id, {}))
+        return props
+
+    def write_prop(self, table, ref_id, key, val):
+        '''Buffers a property write'''
+        value, kind = _encode_value(val)
+        self.writes.append((SQLiteInterface.SET_PROP % table,
+                            (ref_id, key, value, kind)))
+        self.pending_props[table].setdefault(ref_id, {})[key] = (
+            _decode_value(value, kind))
+
+    def new_relationship(self, start_id, end_id, rel_type):
+        '''Creates a relationship'''
+        rel_id = self.next_rel_id
+        self.next_rel_id += 1
+        row = (rel_id, start_id, end_id, rel_type)
+        self.writes.append((SQLiteInterface.INSERT_REL, row))
+        self.pending_rels[rel_id] = row
+        self.pending_rel_ends.setdefault(('start_id', start_id),
+                                         []).append(row)
+        self.pending_rel_ends.setdefault(('end_id', end_id), []).append(row)
+        return self.__get_rel(rel_id, start_id, end_id, rel_type, {})
+
+    def del_relationship(self, rel_id):
+        '''Deletes a relationship'''
+        self.writes.append((SQLiteInterface.DELETE_REL, (rel_id,)))
+        self.writes.append((SQLiteInterface.DELETE_REL_PROPS, (rel_id,)))
+        self.deleted_rels.add(rel_id)
+        self.pending_rels.pop(rel_id, None)
+        self.pending_props['rel_props'].pop(rel_id, None)
+
+    def _new_node(self):
+        '''Creates a node, the node ID is the row ID so it orders nodes by
+        creation'''
+        node_id = self.next_node_id
+        self.next_node_id += 1
+        self.writes.append((SQLiteInterface.INSERT_NODE, (node_id,)))
+        self.pending_nodes.add(node_id)
+        node = self.get_node(node_id, {})
+        node['node_id'] = node_id
+        return node
+
+    def _write_index(self, idx_type, idx_name, idx_key, idx_val):
+        '''Adds an entry to the index table'''
+        self.writes.append((SQLiteInterface.INSERT_IDX,
+                            (idx_type, idx_name, idx_key, idx_val.id)))
+        index = self.pending_idx.setdefault((idx_type, idx_name), {})
+        index.setdefault(idx_key, set()).add(idx_val.id)
+
+    def __pending_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the set of node IDs buffered under the key'''
+        return self.pending_idx.get((idx_type, idx_name), {}).get(idx_key,
+                                                                  set())
+
+    def get_latest_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the node with the highest node ID indexed under the key,
+        or None'''
+        rows = self._read("SELECT MAX(node_id) FROM idx "
+                          "WHERE idx_type = ? AND name = ? AND key = ?",
+                          (idx_type, idx_name, idx_key))
+        node_ids = self.__pending_indexed(idx_type, idx_name, idx_key)
+        if rows[0][0] is not None:
+            node_ids = node_ids | {rows[0][0]}
+        if not node_ids:
+            return None
+        return self.get_node(max(node_ids))
+
+    def get_indexed_range(self, idx_type, idx_name, start_key, end_key):
+        '''Returns the nodes indexed with keys between start_key and end_key
+        inclusive, in key order'''
+        rows = self._read("SELECT key, node_id FROM idx "
+                          "WHERE idx_type = ? AND name = ? "
+                          "AND key >= ? AND key <= ? ORDER BY key, node_id",
+                          (idx_type, idx_name, start_key, end_key))
+        index = self.pending_idx.get((idx_type, idx_name))
+        if index:
+            entries = set(rows)
+            for key, node_ids in index.items():
+                if start_key <= key <= end_key:
+                    entries.update((key, node_id) for node_id in node_ids)
+            rows = sorted(entries)
+        return [self.get_node(row[-1]) for row in rows]
+
+    def get_index_keys(self, idx_type, idx_name):
+        '''Yields the distinct keys in the index as rows are read, then
+        the keys only buffered so far'''
+        pending = set(self.pending_idx.get((idx_type, idx_name), {}))
+        for row in self.conn.execute("SELECT DISTINCT key FROM idx "
+                                     "WHERE idx_type = ? AND name = ?",
+                                     (idx_type, idx_name)):
+            pending.discard(row[0])
+            yield row[0]
+        for key in pending:
+            yield key
+
+    def get_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the nodes indexed under the key in node ID order'''
+        rows = self._read("SELECT node_id FROM idx "
+                          "WHERE idx_type = ? AND name = ? AND key = ? "
+                          "ORDER BY node_id", (idx_type, idx_name, idx_key))
+        node_ids = [row[0] for row in rows]
+        pending = self.__pending_indexed(idx_type, idx_name, idx_key)
+        if pending:
+            node_ids = sorted(pending.union(node_ids))
+        return [self.get_node(node_id) for node_id in node_ids]
+
+    def _load_ref(self, kind, ref_id):
+        '''Returns the node ('n') or relationship ('r') with the given
+        ID, raises KeyError if it does not exist'''
+        if kind == 'n':
+            if ref_id in self.pending_nodes:
+                return self.get_node(ref_id)
+            rows = self._read("SELECT id FROM nodes WHERE id = ?", (ref_id,))
+            if not rows:
+                raise KeyError(ref_id)
+            return self.get_node(ref_id)
+        if ref_id in self.deleted_rels:
+            raise KeyError(ref_id)
+        if ref_id in self.pending_rels:
+            return self.__get_rel(*self.pending_rels[ref_id])
+        rows = self._read("SELECT id, start_id, end_id, type FROM rels "
+                          "WHERE id = ?", (ref_id,))
+        if not rows:
+            raise KeyError(ref_id)
+        return self.__get_rel(*rows[0])
@@ -7,16 +7,21 @@ systems and the opus analysers.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import collections
+import cPickle as pickle
+import fnmatch
 import functools
 import logging
 import threading
 import time
 import os
 import psutil
+import sys
 import traceback
 
 from . import common_utils
-from .exception import InvalidCacheException, UniqueIDException
+from .exception import (InvalidCacheException, OPUSException,
+                        UniqueIDException)
 
 
 # Enum values for node types
@@ -42,7 +47,11 @@ RelType = common_utils.enum(GLOB_OBJ_PREV="GLOB_OBJ_PREV",
                             LIB_META="LIB_META",
                             ENV_META="ENV_META",
                             OTHER_META="OTHER_META",
-                            META_PREV="META_PREV")
+                            ENV_SNAPSHOT="ENV_SNAPSHOT",
+                            OTHER_SNAPSHOT="OTHER_SNAPSHOT",
+                            LIB_SNAPSHOT="LIB_SNAPSHOT",
+                            META_PREV="META_PREV",
+                            PACKED_EVENTS="PACKED_EVENTS")
 
 # Enum values for relationship link states
 LinkState = common_utils.enum(NONE=0,
@@ -62,11 +71,24 @@ CACHE_NAMES = common_utils.enum(VALID_LOCAL=0,
                                 LOCAL_GLOBAL=1,
                                 LAST_EVENT=2,
                                 NODE_BY_ID=3,
-                                IO_EVENT_CHAIN=4)
+                                IO_EVENT_CHAIN=4,
+                                LATEST_GLOBAL=5,
+                                GLOB_SUCCESSOR=6,
+                                META_SNAPSHOT=7)
 
 # Enum values for process status
 PROCESS_STATE = common_utils.enum(ALIVE=0, DEAD=1)
 
+# Version of the stored graph layout, version 2 stores event and local
+# times as integers and indexes events by time
+SCHEMA_VERSION = 2
+
+
+def time_index_key(time_val):
+    '''Returns the EVENT_INDEX key for a time, zero padded so the lexical
+    order of keys matches the numeric order of times.'''
+    return "%020d" % int(time_val)
+
 
 def format_stack():
     stack = traceback.extract_stack()
@@ -80,7 +102,7 @@ class FdChain(object):
     def __init__(self):
         super(FdChain, self).__init__()
         self.local = None
-        self.chain = common_utils.IndexList(lambda x: int(x['before_time']))
+        self.chain = common_utils.SortedChunkList()  # Events by before_time
 
     def __repr__(self):
         return str(str(self.local), str(self.chain))
@@ -88,17 +110,122 @@ class FdChain(object):
 
 class CacheManager(object):
     '''Manages a series of caches and allows for them to be
-    updated and invalidated.'''
-    def __init__(self, cache_list):
-        self.caches = {key: dict() for key in cache_list}
+    updated and invalidated. cache_sizes maps cache names to the maximum
+    number of entries, caches without a size are unbounded. loader is called
+    with ('n', id) or ('r', id) to rehydrate entries restored by load_cache.
+    Caches in unbounded ignore cache_sizes. Journalled caches are not
+    emptied by clear, instead rollback undoes the updates made since the
+    last commit.'''
+    MISSING = object()
+
+    def __init__(self, cache_list, cache_sizes=None, loader=None,
+                 journalled=(), unbounded=()):
+        if cache_sizes is None:
+            cache_sizes = {}
+        self.journalled = set(journalled)
+        self.journal = []
+        self.caches = {
+            key: common_utils.ClockCache(
+                None if key in unbounded else
+                cache_sizes.get(CACHE_NAMES.enum_str(key)))
+            for key in cache_list}
+
+        # Encoded entries restored by load_cache, decoded on first access
+        self.pending = {key: {} for key in cache_list}
+        self.loader = loader
+
+    def _encode(self, val):
+        '''Converts a cached value into a picklable form, node and
+        relationship proxies are replaced by their IDs.'''
+        if isinstance(val, FdChain):
+            return ('fd', self._encode(val.local),
+                    [(key, self._encode(event))
+                     for key, event in val.chain.items()])
+        elif isinstance(val, common_utils.SortedChunkList):
+            return ('idx', [(key, self._encode(v)) for key, v in val.items()])
+        elif isinstance(val, (tuple, list)):
+            return ('seq', isinstance(val, tuple),
+                    [self._encode(v) for v in val])
+        # Node proxies resolve unknown attributes as relationship types,
+        # so test for nodes before relationships.
+        elif hasattr(val, 'relationships'):
+            return ('n', val.id)
+        elif hasattr(val, 'start') and hasattr(val, 'end'):
+            return ('r', val.id)
+        return ('v', val)
+
+    def _decode(self, enc):
+        '''Rebuilds a cached value from its encoded form, raises KeyError if
+        a referenced node or relationship no longer exists.'''
+        tag = enc[0]
+        if tag == 'n' or tag == 'r':
+            return self.loader(tag, enc[1])
+        elif tag == 'v':
+            return enc[1]
+        elif tag == 'seq':
+            items = [self._decode(v) for v in enc[2]]
+            return tuple(items) if enc[1] else items
+        elif tag == 'fd':
+            fd_chain = FdChain()
+            fd_chain.local = self._decode(enc[1])
+            for key, event in enc[2]:
+                fd_chain.chain.add(key, self._decode(event))
+            return fd_chain
+        elif tag == 'idx':
+            idx_list = common_utils.SortedChunkList()
+            for key, val in enc[1]:
+                idx_list.add(key, self._decode(val))
+            return idx_list
 
     def dump_cache(self, file_name):
         '''Dumps contents of cache to file'''
-        pass
+        dump = {}
+        for name, cache in self.caches.items():
+            entries = dict(self.pending[name])
+            for key, val in cache.items():
+                entries[key] = self._encode(val)
+            dump[name] = entries
+
+        try:
+            with open(file_name, "wb") as fh:
+                pickle.dump(dump, fh, pickle.HIGHEST_PROTOCOL)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("OPUS file open error, %s", file_name)
 
     def load_cache(self, file_name):
-        '''Loads cache content from file'''
-        pass
+        '''Loads cache content from file, entries are rehydrated
+        when they are first accessed'''
+        if not os.path.isfile(file_name):
+            return
+
+        try:
+            with open(file_name, "rb") as fh:
+                dump = pickle.load(fh)
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("OPUS file open error, %s", file_name)
+
+        for name, entries in dump.items():
+            if name in self.pending:
+                self.pending[name].update(entries)
+
+        os.unlink(file_name)
+
+    def lookup(self, cache, key):
+        '''Returns the cached value for key or MISSING, decoding the entry
+        if it was restored by load_cache.'''
+        val = self.caches[cache].get(key, CacheManager.MISSING)
+        if val is CacheManager.MISSING and key in self.pending[cache]:
+            try:
+                val = self._decode(self.pending[cache].pop(key))
+            except KeyError:
+                if __debug__:
+                    logging.debug("Dropping stale cache entry %s in %s",
+                                  key, CACHE_NAMES.enum_str(cache))
+                return CacheManager.MISSING
+            self.caches[cache][key] = val
+        return val
 
     def invalidate(self, cache, key):
         '''Invalidates the entry 'key' in 'cache', a InvalidCacheExcetion
@@ -107,6 +234,11 @@ class CacheManager(object):
         if cache not in self.caches:
             raise InvalidCacheException(CACHE_NAMES.enum_str(cache))
 
+        if key in self.pending[cache]:
+            del self.pending[cache][key]
+            if key not in self.caches[cache]:
+                return
+
         if key not in self.caches[cache]:
             if __debug__:
                 logging.warn("Warning: Attempted to invalidate key {0} "
@@ -117,6 +249,8 @@ class CacheManager(object):
                              )
             return
 
+        if cache in self.journalled:
+            self.journal.append((cache, key, self.caches[cache][key]))
         del self.caches[cache][key]
 
     def get(self, cache, key):
@@ -124,16 +258,62 @@ class CacheManager(object):
         cache and key combination'''
         if cache not in self.caches:
             raise InvalidCacheException(CACHE_NAMES.enum_str(cache))
-        if key not in self.caches[cache]:
+        val = self.lookup(cache, key)
+        if val is CacheManager.MISSING:
             return None
-        return self.caches[cache][key]
+        return val
 
     def update(self, cache, key, val):
         '''Updates the relevant cache and key combination with
         the new value'''
         if cache not in self.caches:
             raise InvalidCacheException(CACHE_NAMES.enum_str(cache))
-        self.caches[cache][key] = val
+        self.pending[cache].pop(key, None)
+        self._store(cache, key, val)
+
+    def _store(self, cache, key, val):
+        '''Sets the entry, journalling its old value if cache is
+        journalled'''
+        entries = self.caches[cache]
+        if cache in self.journalled:
+            self.journal.append((cache, key, entries[key] if key in entries
+                                 else CacheManager.MISSING))
+        entries[key] = val
+
+    def commit(self):
+        '''Keeps the journalled updates made since the last commit'''
+        self.journal = []
+
+    def rollback(self):
+        '''Undoes the journalled updates made since the last commit'''
+        for cache, key, val in reversed(self.journal):
+            entries = self.caches[cache]
+            if val is not CacheManager.MISSING:
+                entries[key] = val
+            elif key in entries:
+                del entries[key]
+        self.journal = []
+
+    def clear(self, cache=None):
+        '''Empties 'cache' or all caches other than the journalled ones if it
+        is None, used when a transaction is rolled back and cached nodes may
+        no longer exist'''
+        if cache is not None:
+            if cache not in self.caches:
+                raise InvalidCacheException(CACHE_NAMES.enum_str(cache))
+            self.caches[cache].clear()
+            self.pending[cache].clear()
+            return
+
+        for cache, entries in self.caches.items():
+            if cache not in self.journalled:
+                entries.clear()
+                self.pending[cache].clear()
+
+    def stats(self):
+        '''Returns the size and access counters of every cache'''
+        return {CACHE_NAMES.enum_str(name): cache.stats()
+                for name, cache in self.caches.items()}
 
     @staticmethod
     def dec(cache, key_lambda):
@@ -151,12 +331,13 @@ class CacheManager(object):
 
                 key = key_lambda(*args, **kwargs)
 
-                if key in db_iface.cache_man.caches[cache]:
-                    return db_iface.cache_man.caches[cache][key]
+                val = db_iface.cache_man.lookup(cache, key)
+                if val is not CacheManager.MISSING:
+                    return val
 
                 val = fun(db_iface, *args, **kwargs)
 
-                db_iface.cache_man.caches[cache][key] = val
+                db_iface.cache_man._store(cache, key, val)
                 return val
             return wrapped_fun
         return wrapper
@@ -165,23 +346,290 @@ class CacheManager(object):
 class StorageIFace(object):
     '''A storage interface base class to access a provenance graph database
     using a series of operations. It encapsulates the type of
-    database and it's method of access.'''
+    database and it's method of access. Caching, index write buffering, the
+    name filter and packed events are shared by every backend, subclasses
+    provide the graph itself through node and relationship objects.'''
+
+    FILE_INDEX = "FILE_INDEX"
+    PROC_INDEX = "PROC_INDEX"
+    META_INDEX = "META_INDEX"
+    EVENT_INDEX = "EVENT_INDEX"
+
+    # Node property holding the hourly bucket of the time index entry made
+    # for a global or its lineage
+    TIME_BUCKET_PROPS = {FILE_INDEX: 'file_time_bucket',
+                         PROC_INDEX: 'proc_time_bucket'}
+
+    # Whether query and locked_query accept Cypher, the query modules walk
+    # the graph through the node API when they do not
+    supports_cypher = False
+
+    def __init__(self, cache_sizes=None, name_filter_capacity=10000000,
+                 name_filter_error_rate=0.001, packed_events=False,
+                 index_event_times=True, packed_flush_events=1000,
+                 packed_flush_span_ms=1000, name_filter_dump_interval_s=600,
+                 **kwargs):
+        super(StorageIFace, self).__init__()
+        # storage_args meant for another backend are ignored, so switching
+        # storage_type does not require editing them
+        if kwargs:
+            logging.info("%s ignoring storage_args: %s", type(self).__name__,
+                         ", ".join(sorted(kwargs)))
+        self.trans_lock = threading.Lock()
+        self.mono_time = None
+        self.sys_time = int(time.time())
+
+        # Bloom filter of every name in the FILE_INDEX, set up by
+        # load_name_filter so lookups of unseen names can be skipped
+        self.name_filter_capacity = name_filter_capacity  # Configurable
+        self.name_filter_error_rate = name_filter_error_rate  # Configurable
+        self.name_filter = None
+
+        # The filter is dumped to name_filter_file every
+        # name_filter_dump_interval_s seconds, names committed since are
+        # appended to a journal beside it so a crash loses none of them
+        self.name_filter_dump_interval = (
+            name_filter_dump_interval_s)  # Configurable
+        self.name_filter_file = None
+        self.name_journal = None
+        self.name_filter_dumped = time.time()
+
+        # IO events of a local are buffered and stored in blocks of
+        # property arrays when flushed instead of as one node per event
+        self.packed_events = packed_events  # Configurable
+        self.event_buffers = {}
+        self.event_journal = []
+
+        # A local's buffer is flushed as a block once it holds
+        # packed_flush_events events or its begin times would span more than
+        # packed_flush_span_ms, bounding memory, the events a crash loses and
+        # how far back a time window query must look for blocks
+        self.packed_flush_events = packed_flush_events  # Configurable
+        self.packed_flush_span = (packed_flush_span_ms *
+                                  1000000)  # Configurable
+
+        # Events are indexed by begin time for time window queries
+        self.index_event_times = index_event_times  # Configurable
+
+        # Index writes are buffered until the transaction commits so
+        # repeated writes of the same entry are only made once
+        self.index_buffer = collections.OrderedDict()
+        self.index_latest = {}
+
+        self.cache_man = CacheManager([CACHE_NAMES.LOCAL_GLOBAL,
+                                       CACHE_NAMES.LAST_EVENT,
+                                       CACHE_NAMES.VALID_LOCAL,
+                                       CACHE_NAMES.NODE_BY_ID,
+                                       CACHE_NAMES.IO_EVENT_CHAIN,
+                                       CACHE_NAMES.LATEST_GLOBAL,
+                                       CACHE_NAMES.GLOB_SUCCESSOR,
+                                       CACHE_NAMES.META_SNAPSHOT],
+                                      cache_sizes,
+                                      self._load_ref,
+                                      [CACHE_NAMES.LATEST_GLOBAL,
+                                       CACHE_NAMES.META_SNAPSHOT],
+                                      [CACHE_NAMES.LATEST_GLOBAL])
 
     def close(self):
-        '''Close the database connection.'''
-        pass
+        '''Writes any buffered events, subclasses then close the database
+        connection.'''
+        if self.event_buffers:
+            with self.start_transaction():
+                for loc_id in self.event_buffers.keys():
+                    self.flush_events(self.event_buffers[loc_id][0])
+        if self.name_journal is not None:
+            self.name_journal.close()
+            self.name_journal = None
 
     def start_transaction(self):
-        '''Begin a transaction'''
-        pass
+        '''Returns a transaction context, index writes are made as it
+        commits'''
+
+        class TransactionWrapper(object):
+
+            def __init__(self, lock, wraped, before_exit, on_exit):
+                self.lock = lock
+                self.wraped = wraped
+                self.before_exit = before_exit
+                self.on_exit = on_exit
+
+            def __enter__(self, *args, **kwargs):
+                self.lock.acquire()
+                return self.wraped.__enter__(*args, **kwargs)
+
+            def __exit__(self, *args, **kwargs):
+                failed = args[0] is not None
+                try:
+                    if not failed:
+                        try:
+                            self.before_exit()
+                        except Exception:
+                            failed = True
+                            self.wraped.__exit__(*sys.exc_info())
+                            raise
+                    ret = self.wraped.__exit__(*args, **kwargs)
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    self.on_exit(failed)
+                    self.lock.release()
+                return ret
+
+        return TransactionWrapper(self.trans_lock, self._transaction(),
+                                  self._flush_index_writes,
+                                  self._end_transaction)
+
+    def _transaction(self):
+        '''Returns the backend transaction context manager'''
+        raise NotImplementedError()
+
+    def _flush_index_writes(self):
+        '''Writes the index entries buffered by update_index, called just
+        before a transaction commits. New names are journalled first, a name
+        journalled by a transaction that then fails is only a false
+        positive.'''
+        names = []
+        for (idx_type, idx_name, idx_key, _), idx_val in \
+                self.index_buffer.items():
+            self._write_index(idx_type, idx_name, idx_key, idx_val)
+            if idx_type == StorageIFace.FILE_INDEX and idx_name == 'name':
+                names.append(idx_key)
+        if names and self.name_journal is not None:
+            pickle.dump(names, self.name_journal, pickle.HIGHEST_PROTOCOL)
+            self.name_journal.flush()
+        self.index_buffer.clear()
+        self.index_latest = {}
+
+    def _write_index(self, idx_type, idx_name, idx_key, idx_val):
+        '''Adds an entry to an index in the backend'''
+        raise NotImplementedError()
+
+    def _end_transaction(self, failed):
+        '''Called as each transaction completes.'''
+        # Index writes of a failed transaction are dropped
+        self.index_buffer.clear()
+        self.index_latest = {}
+
+        # The journalled caches, LATEST_GLOBAL and META_SNAPSHOT, are never
+        # cleared, the entries a failed transaction set are restored instead
+        if failed:
+            self.cache_man.rollback()
+        else:
+            self.cache_man.commit()
+
+        # Undo changes to the event buffers made by a failed transaction
+        if failed:
+            for entry in reversed(self.event_journal):
+                if entry[0] == 'append':
+                    buf = self.event_buffers[entry[1]]
+                    for arr in buf[1:5]:
+                        arr.pop()
+                    buf[5], buf[6] = entry[2]
+                    if len(buf[1]) == 0:
+                        del self.event_buffers[entry[1]]
+                else:
+                    self.event_buffers[entry[1]] = entry[2]
+        self.event_journal = []
+
+        if (not failed and self.name_journal is not None and
+                time.time() - self.name_filter_dumped >=
+                self.name_filter_dump_interval):
+            # The transaction has committed, the journal keeps growing
+            # until a later dump succeeds
+            try:
+                self.dump_name_filter()
+            except OPUSException as exc:
+                logging.error("Name filter dump failed: %s", exc)
+
+    def append_event(self, node, func_name, ret_val, begin_time, end_time):
+        '''Buffers an IO event for the local node, events are written to the
+        node by flush_events when the local is dropped or the buffer reaches
+        a flush threshold'''
+        buf = self.event_buffers.get(node.id)
+        if buf is not None and (
+                len(buf[1]) >= self.packed_flush_events or
+                max(buf[6], begin_time) - min(buf[5], begin_time) >
+                self.packed_flush_span):
+            self.flush_events(node)
+            buf = None
+        if buf is None:
+            # Node, event arrays and the earliest and latest begin times
+            buf = [node, [], [], [], [], begin_time, begin_time]
+            self.event_buffers[node.id] = buf
+        self.event_journal.append(('append', node.id, (buf[5], buf[6])))
+        buf[1].append(func_name)
+        buf[2].append(ret_val)
+        buf[3].append(begin_time)
+        buf[4].append(end_time)
+        buf[5] = min(buf[5], begin_time)
+        buf[6] = max(buf[6], begin_time)
+
+    def flush_events(self, node):
+        '''Writes the events buffered for node as a new block, an EVENT node
+        linked from node by a PACKED_EVENTS relationship, so a flush costs
+        only the size of the block. Function names are stored once per
+        block in ev_fns and referred to by index from ev_fn, the arrays are
+        in begin time order. The block is added to the EVENT_INDEX under
+        packed_time with its earliest begin time.'''
+        buf = self.event_buffers.pop(node.id, None)
+        if buf is None:
+            return
+        self.event_journal.append(('flush', node.id, buf))
+
+        fns = []
+        fn_ids = {}
+        order = sorted(range(len(buf[3])), key=lambda i: buf[3][i])
+        for func_name in buf[1]:
+            if func_name not in fn_ids:
+                fn_ids[func_name] = len(fns)
+                fns.append(func_name)
+
+        block_node = self.create_node(NodeType.EVENT)
+        block_node['ev_fns'] = fns
+        block_node['ev_fn'] = [fn_ids[buf[1][i]] for i in order]
+        block_node['ev_ret'] = [buf[2][i] for i in order]
+        block_node['ev_begin'] = [buf[3][i] for i in order]
+        block_node['ev_end'] = [buf[4][i] for i in order]
+        self.create_relationship(node, block_node, RelType.PACKED_EVENTS)
+        self.update_index(StorageIFace.EVENT_INDEX, 'packed_time',
+                          buf[5], block_node)
+
+    def set_sys_time_for_msg(self, sys_time):
+        '''Stores the system time passed in the header
+        for each message being processed'''
+        self.sys_time = sys_time
+        self.mono_time = None
+
+    def set_mono_time_for_msg(self, mono_time):
+        self.mono_time = mono_time
 
     def create_node(self, node_type):
-        '''Create a node'''
-        pass
+        '''Creates a node and sets the node ID, type and timestamp'''
+        node = self._new_node()
+        node['type'] = node_type
+        node['sys_time'] = self.sys_time
+        if node_type == NodeType.LOCAL:
+            # Neo4j cannot store None, so the property is left unset
+            if self.mono_time is None:
+                logging.error("Error: Attempted to use monotime in a function"
+                              " that does not supply it.")
+            else:
+                node['mono_time'] = self.mono_time
+        return node
 
     def create_relationship(self, from_node, to_node, rel_type, state=None):
-        '''Create a relationship between two nodes'''
-        pass
+        '''Creates a relationship of given type'''
+        rel = from_node.relationships.create(rel_type, to_node)
+        if state is not None:
+            rel['state'] = state
+        else:
+            rel['state'] = LinkState.NONE
+        return rel
+
+    def _new_node(self):
+        '''Creates a node in the backend and sets its node ID'''
+        raise NotImplementedError()
 
     def set_property(self, node, name, value):
         '''Set a property on a node'''
@@ -191,37 +639,254 @@ class StorageIFace(object):
         '''Returns the value of a property for a node'''
         pass
 
+    def update_time_index(self, idx_type, sys_time_val, glob_node,
+                          prev_node=None):
+        '''Updates the file or process time index entry for the hourly
+        bucket depending on the index type passed. A global lineage holds a
+        single entry per bucket, so no entry is made if glob_node or
+        prev_node, the version it replaces, already holds one for the
+        bucket. Returns True if an entry was made.'''
+        hourly_bucket = sys_time_val - (sys_time_val % 3600)
+        prop = StorageIFace.TIME_BUCKET_PROPS[idx_type]
+        if glob_node.has_key(prop) and glob_node[prop] == hourly_bucket:
+            return False
+        glob_node[prop] = hourly_bucket
+        if (prev_node is not None and prev_node.has_key(prop) and
+                prev_node[prop] == hourly_bucket):
+            return False
+        self.update_index(idx_type, 'time', hourly_bucket, glob_node)
+        return True
+
+    def update_index(self, idx_type, idx_name, idx_key, idx_val):
+        '''Adds value to a given index type with the name and key. The write
+        is buffered until the transaction commits.'''
+        if idx_type == StorageIFace.EVENT_INDEX and not self.index_event_times:
+            return
+        self.index_buffer[(idx_type, idx_name, idx_key, idx_val.id)] = idx_val
+        self.index_latest[(idx_type, idx_name, idx_key)] = idx_val
+
+        if idx_type == StorageIFace.FILE_INDEX:
+            # A name is only ever indexed against a newly created global,
+            # so the last node indexed is the latest version for the name.
+            if idx_name == 'name':
+                self.cache_man.update(CACHE_NAMES.LATEST_GLOBAL,
+                                      idx_key, idx_val)
+                if self.name_filter is not None:
+                    self.name_filter.add(idx_key)
+        elif idx_type == StorageIFace.META_INDEX:
+            if idx_name == 'hash':
+                self.cache_man.update(CACHE_NAMES.META_SNAPSHOT,
+                                      idx_key, idx_val)
+
+    def get_buffered_index(self, idx_type, idx_name, idx_key):
+        '''Returns the last node written to the index entry in the current
+        transaction, or None. Buffered writes are not yet visible to
+        queries.'''
+        return self.index_latest.get((idx_type, idx_name, idx_key))
+
+    def may_have_name(self, name):
+        '''Returns False if name has definitely never been added to the
+        FILE_INDEX, True if it may have been'''
+        if self.name_filter is None:
+            return True
+        return name in self.name_filter
+
+    def load_name_filter(self, file_name):
+        '''Loads the FILE_INDEX name filter from its last dump in file_name
+        and adds the names journalled since. The filter is rebuilt from the
+        index and dumped if there is no dump.'''
+        self.name_filter_file = file_name
+        if os.path.isfile(file_name):
+            try:
+                with open(file_name, "rb") as fh:
+                    self.name_filter = pickle.load(fh)
+            except IOError as exc:
+                logging.error("Error: %d, Message: %s",
+                              exc.errno, exc.strerror)
+                raise OPUSException("OPUS file open error, %s", file_name)
+            self.__replay_name_journal()
+        else:
+            self.__rebuild_name_filter()
+        self.dump_name_filter()
+
+    def __replay_name_journal(self):
+        '''Adds the names in the journal to the filter. A record cut short
+        by a crash was written by a transaction that never committed.'''
+        journal_file = self.name_filter_file + ".log"
+        if not os.path.isfile(journal_file):
+            return
+        with open(journal_file, "rb") as fh:
+            while True:
+                try:
+                    names = pickle.load(fh)
+                except EOFError:
+                    break
+                except Exception as exc:
+                    logging.error("Ignoring the end of name journal %s: %s",
+                                  journal_file, exc)
+                    break
+                for name in names:
+                    self.name_filter.add(name)
+
+    def __rebuild_name_filter(self):
+        '''Builds the name filter by streaming the names in the FILE_INDEX
+        into it. Names already in the filter are not added again, so its
+        count is the number of distinct names barring false positives. The
+        index is streamed again into a larger filter if that count exceeds
+        name_filter_capacity.'''
+        capacity = self.name_filter_capacity
+        while True:
+            self.name_filter = common_utils.BloomFilter(
+                capacity, self.name_filter_error_rate)
+            for name in self.get_index_keys(StorageIFace.FILE_INDEX, 'name'):
+                if name not in self.name_filter:
+                    self.name_filter.add(name)
+            if len(self.name_filter) <= capacity:
+                break
+            capacity = 2 * len(self.name_filter)
+        if __debug__:
+            logging.debug("Rebuilt name filter with %d names",
+                          len(self.name_filter))
+
+    def dump_name_filter(self):
+        '''Writes the FILE_INDEX name filter to the file it was loaded from
+        and starts a new journal. The file is replaced atomically.'''
+        if self.name_filter is None or self.name_filter_file is None:
+            return
+        tmp_file = self.name_filter_file + ".tmp"
+        try:
+            with open(tmp_file, "wb") as fh:
+                pickle.dump(self.name_filter, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, self.name_filter_file)
+            if self.name_journal is not None:
+                self.name_journal.close()
+            self.name_journal = open(self.name_filter_file + ".log", "wb")
+        except IOError as exc:
+            logging.error("Error: %d, Message: %s", exc.errno, exc.strerror)
+            raise OPUSException("OPUS file open error, %s",
+                                self.name_filter_file)
+        self.name_filter_dumped = time.time()
+
+    def get_latest_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the node with the highest node ID indexed under the key,
+        or None'''
+        raise NotImplementedError()
+
+    def get_indexed_range(self, idx_type, idx_name, start_key, end_key):
+        '''Returns the nodes indexed with keys between start_key and end_key
+        inclusive, in key order'''
+        raise NotImplementedError()
+
+    def get_index_keys(self, idx_type, idx_name):
+        '''Returns an iterable of the keys in the index, keys may be
+        repeated and are streamed where the backend allows'''
+        raise NotImplementedError()
+
+    def get_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the nodes indexed under the key in node ID order'''
+        raise NotImplementedError()
+
+    def find_indexed(self, idx_type, idx_name, pattern):
+        '''Returns the nodes indexed under keys matching the shell style
+        pattern in node ID order, a pattern without wildcards is looked up
+        directly'''
+        if not any(c in pattern for c in '*?['):
+            return self.get_indexed(idx_type, idx_name, pattern)
+        nodes = {}
+        for key in fnmatch.filter(self.get_index_keys(idx_type, idx_name),
+                                  pattern):
+            for node in self.get_indexed(idx_type, idx_name, key):
+                nodes[node.id] = node
+        return [nodes[node_id] for node_id in sorted(nodes)]
+
+    def load_node(self, node_id):
+        '''Returns the node with the given ID bypassing the caches, which
+        are only safe to use from the analyser thread'''
+        return self._load_ref('n', node_id)
+
+    def query(self, qry, **kwargs):
+        '''Executes a Cypher query and returns the result'''
+        raise OPUSException("%s does not support Cypher queries" %
+                            type(self).__name__)
+
+    def locked_query(self, qry, **kwargs):
+        '''Executes a Cypher query within a locking transaction'''
+        raise OPUSException("%s does not support Cypher queries" %
+                            type(self).__name__)
+
+    def find_and_del_rel(self, from_node, to_node):
+        '''Finds a relation of type rel_type between two nodes
+        and deletes it'''
+        for rel in from_node.relationships.outgoing:
+            if rel.end.id == to_node.id:
+                rel.delete()
+
+    def delete_relationship(self, rel):
+        '''Deletes relatioship given a relationship object'''
+        rel.delete()
+
+    def set_link_state(self, rel_list, status):
+        '''Sets the link state to status'''
+        for rel in rel_list:
+            rel['state'] = status
+
+    @CacheManager.dec(CACHE_NAMES.NODE_BY_ID,
+                      lambda node_id: node_id)
+    def get_node_by_id(self, node_id):
+        '''Returns a node object given the ID'''
+        return self._load_ref('n', node_id)
+
+    def _load_ref(self, kind, ref_id):
+        '''Returns the node ('n') or relationship ('r') with the given
+        internal ID, used to rehydrate cache entries'''
+        raise NotImplementedError()
+
 
 class DBInterface(StorageIFace):
     '''Neo4J implementation of storage interface'''
 
-    FILE_INDEX = "FILE_INDEX"
-    PROC_INDEX = "PROC_INDEX"
     UNIQ_ID_IDX = "UNIQ_ID_IDX"
     TIME_INDEX = "TIME_INDEX"
 
-    def __init__(self, filename, neo4j_cfg):
-        super(DBInterface, self).__init__()
+    supports_cypher = True
+
+    def __init__(self, filename, neo4j_cfg, id_block_size=10000,
+                 cache_sizes=None, name_filter_capacity=10000000,
+                 name_filter_error_rate=0.001, packed_events=False,
+                 index_event_times=True, packed_flush_events=1000,
+                 packed_flush_span_ms=1000, name_filter_dump_interval_s=600,
+                 migration_batch_size=500, **kwargs):
+        super(DBInterface, self).__init__(cache_sizes, name_filter_capacity,
+                                          name_filter_error_rate,
+                                          packed_events, index_event_times,
+                                          packed_flush_events,
+                                          packed_flush_span_ms,
+                                          name_filter_dump_interval_s,
+                                          **kwargs)
 
         config_params = self._configure_neo4j(neo4j_cfg)
 
         from neo4j import GraphDatabase
 
-        self.trans_lock = threading.Lock()
-        self.mono_time = None
+        # Node IDs are handed out from a block reserved on the UNIQ_ID node
+        self.id_block_size = id_block_size  # Configurable
+        self.next_id = None
+        self.id_limit = None
+        self.id_block_uncommitted = False
+
+        # Databases written with an older schema are migrated by a
+        # background thread, migration_batch_size nodes per transaction
+        self.migration_batch_size = migration_batch_size  # Configurable
+        self.migration_thread = None
+        self.migration_stop = threading.Event()
         try:
             self.db = GraphDatabase(filename, **config_params)
             self.file_index = None
             self.proc_index = None
+            self.meta_index = None
+            self.event_index = None
             self.node_id_idx = None
             self.id_node = None
-            self.sys_time = int(time.time())
-
-            self.cache_man = CacheManager([CACHE_NAMES.LOCAL_GLOBAL,
-                                           CACHE_NAMES.LAST_EVENT,
-                                           CACHE_NAMES.VALID_LOCAL,
-                                           CACHE_NAMES.NODE_BY_ID,
-                                           CACHE_NAMES.IO_EVENT_CHAIN])
 
             with self.start_transaction():
                 # Unique ID index
@@ -238,6 +903,7 @@ class DBInterface(StorageIFace):
                         DBInterface.UNIQ_ID_IDX)
                     self.id_node = self.db.node()
                     self.id_node['serial_id'] = 0
+                    self.id_node['schema_version'] = SCHEMA_VERSION
                     uniq_id_idx['node']['UNIQ_ID'] = self.id_node
 
                 # File index
@@ -256,11 +922,41 @@ class DBInterface(StorageIFace):
                     self.proc_index = self.db.node.indexes.create(
                         DBInterface.PROC_INDEX)
 
+                # Meta snapshot index
+                if self.db.node.indexes.exists(DBInterface.META_INDEX):
+                    self.meta_index = self.db.node.indexes.get(
+                        DBInterface.META_INDEX)
+                else:
+                    self.meta_index = self.db.node.indexes.create(
+                        DBInterface.META_INDEX)
+
+                # Event time index
+                if self.db.node.indexes.exists(DBInterface.EVENT_INDEX):
+                    self.event_index = self.db.node.indexes.get(
+                        DBInterface.EVENT_INDEX)
+                else:
+                    self.event_index = self.db.node.indexes.create(
+                        DBInterface.EVENT_INDEX)
+
+                self.indexes = {DBInterface.FILE_INDEX: self.file_index,
+                                DBInterface.PROC_INDEX: self.proc_index,
+                                DBInterface.META_INDEX: self.meta_index,
+                                DBInterface.EVENT_INDEX: self.event_index}
+
+                schema_version = 1
+                if self.id_node.has_key('schema_version'):
+                    schema_version = self.id_node['schema_version']
+
             # Fix for the class load error when using multiple threads
             rows = self.db.query("START n=node(1) RETURN n")
             for row in rows:
                 row['n']
 
+            if schema_version < SCHEMA_VERSION:
+                self.migration_thread = threading.Thread(
+                    name='schema_migration', target=self.__migrate_schema)
+                self.migration_thread.start()
+
         except Exception as exc:
             logging.error("Error: %s %s", str(err), format_stack())
             raise exc
@@ -371,110 +1067,203 @@ class DBInterface(StorageIFace):
 
     def close(self):
         '''Shutdown the database'''
+        if self.migration_thread is not None:
+            self.migration_stop.set()
+            self.migration_thread.join()
+        super(DBInterface, self).close()
         self.db.shutdown()
 
-    def start_transaction(self):
+    def _transaction(self):
         '''Returns a Neo4J transaction'''
+        return self.db.transaction
+
+    def _end_transaction(self, failed):
+        '''An ID block reserved in a transaction that was rolled back was
+        never persisted, so it must not be used.'''
+        if self.id_block_uncommitted and failed:
+            self.next_id = None
+            self.id_limit = None
+        self.id_block_uncommitted = False
+        super(DBInterface, self)._end_transaction(failed)
+
+    def _new_node(self):
+        '''Creates a node with the next unique node ID'''
+        node = self.db.node()
+        node['node_id'] = self.__get_next_id()
+        return node
 
-        class TransactionWrapper(object):
-
-            def __init__(self, lock, wraped):
-                self.lock = lock
-                self.wraped = wraped
-
-            def __enter__(self, *args, **kwargs):
-                self.lock.acquire()
-                return self.wraped.__enter__(*args, **kwargs)
-
-            def __exit__(self, *args, **kwargs):
-                ret = self.wraped.__exit__(*args, **kwargs)
-                self.lock.release()
-                return ret
-
-        return TransactionWrapper(self.trans_lock, self.db.transaction)
+    def _write_index(self, idx_type, idx_name, idx_key, idx_val):
+        '''Adds an entry to a Lucene index, event times are padded so range
+        queries order them numerically'''
+        if idx_type == DBInterface.EVENT_INDEX:
+            idx_key = time_index_key(idx_key)
+        self.indexes[idx_type][idx_name][idx_key] = idx_val
+
+    def get_latest_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the node with the highest node ID indexed under the key,
+        or None'''
+        node = None
+        result = self.db.query("START n=node:" + idx_type + "('" + idx_name +
+                               ":\"" + idx_key + "\"') "
+                               "RETURN n ORDER BY n.node_id DESC LIMIT 1")
+        for row in result:
+            node = row['n']
+        return node
 
-    def set_sys_time_for_msg(self, sys_time):
-        '''Stores the system time passed in the header
-        for each message being processed'''
-        self.sys_time = sys_time
-        self.mono_time = None
+    def get_indexed_range(self, idx_type, idx_name, start_key, end_key):
+        '''Returns the nodes indexed with keys between start_key and end_key
+        inclusive, in key order'''
+        if idx_type == DBInterface.EVENT_INDEX:
+            start_key = time_index_key(start_key)
+            end_key = time_index_key(end_key)
+        else:
+            start_key = str(start_key)
+            end_key = str(end_key)
+        result = self.db.query("START n=node:" + idx_type + "('" + idx_name +
+                               ":[" + start_key + " TO " + end_key + "]') "
+                               "RETURN n ORDER BY n." + idx_name)
+        return [row['n'] for row in result]
+
+    def get_index_keys(self, idx_type, idx_name):
+        '''Yields the keys in the index as the query result is read, the
+        versions of a global share their name list so it is only returned
+        once'''
+        rows = self.db.query("START n=node:" + idx_type + "('" + idx_name +
+                             ":*') RETURN DISTINCT n." + idx_name +
+                             " AS keys")
+        for row in rows:
+            for key in row['keys']:
+                yield key
+
+    def get_indexed(self, idx_type, idx_name, idx_key):
+        '''Returns the nodes indexed under the key in node ID order'''
+        if idx_type == DBInterface.EVENT_INDEX:
+            idx_key = time_index_key(idx_key)
+        return self.__query_index(idx_type, idx_name + ":\"" + str(idx_key) +
+                                  "\"")
+
+    def find_indexed(self, idx_type, idx_name, pattern):
+        '''Returns the nodes indexed under keys matching the pattern in node
+        ID order, the pattern is passed to Lucene'''
+        return self.__query_index(idx_type, idx_name + ":" + pattern)
+
+    def __query_index(self, idx_type, idx_qry):
+        '''Returns the nodes found by a Lucene index query'''
+        result = self.db.query("START n=node:" + idx_type + "('" + idx_qry +
+                               "') RETURN n ORDER BY n.node_id")
+        return [row['n'] for row in result]
+
+    def __migrate_schema(self):
+        '''Brings a database written with an older schema up to
+        SCHEMA_VERSION while the analyser runs. Nodes are visited in ID order
+        a batch per transaction, string event and local times are converted
+        to integers and events are added to the EVENT_INDEX. The next node
+        to migrate is stored on the UNIQ_ID node with each batch, so a
+        restart resumes where the last run stopped.'''
+        try:
+            import jpype
+            if not jpype.isThreadAttachedToJVM():
+                jpype.attachThreadToJVM()
 
-    def set_mono_time_for_msg(self, mono_time):
-        self.mono_time = mono_time
+            rows = self.locked_query("START n=node(*) "
+                                     "RETURN max(id(n)) AS top")
+            top = 0
+            for row in rows:
+                top = row['top']
 
-    def create_node(self, node_type):
-        '''Creates a node and sets the node ID, type and timestamp'''
-        node = self.db.node()
-        node_id = self.__get_next_id()
-        node['node_id'] = node_id
-        node['type'] = node_type
-        node['sys_time'] = self.sys_time
-        if node_type == NodeType.LOCAL:
-            if self.mono_time is None:
-                logging.error("Error: Attempted to use monotime in a function"
-                              " that does not supply it.")
-            node['mono_time'] = str(self.mono_time)
-        return node
+            next_id = 0
+            if self.id_node.has_key('migration_next_id'):
+                next_id = self.id_node['migration_next_id']
+            if __debug__:
+                logging.debug("Migrating schema for nodes %d to %d",
+                              next_id, top)
+
+            while next_id <= top:
+                if self.migration_stop.is_set():
+                    logging.info("Schema migration stopped at node %d",
+                                 next_id)
+                    return
+                batch_end = min(next_id + self.migration_batch_size,
+                                top + 1)
+                with self.start_transaction():
+                    for node_id in range(next_id, batch_end):
+                        try:
+                            node = self.db.node[node_id]
+                        except KeyError:
+                            continue
+                        try:
+                            self.__migrate_node(node)
+                        except Exception as exc:
+                            logging.error("Failed to migrate node %d: %s",
+                                          node_id, exc)
+                    self.id_node['migration_next_id'] = batch_end
+                next_id = batch_end
 
-    def create_relationship(self, from_node, to_node, rel_type, state=None):
-        '''Creates a relationship of given type'''
-        rel = from_node.relationships.create(rel_type, to_node)
-        if state is not None:
-            rel['state'] = state
-        else:
-            rel['state'] = LinkState.NONE
-        return rel
+            with self.start_transaction():
+                self.id_node['schema_version'] = SCHEMA_VERSION
+                if self.id_node.has_key('migration_next_id'):
+                    del self.id_node['migration_next_id']
+            logging.info("Schema migrated to version %d", SCHEMA_VERSION)
+        except Exception as exc:
+            logging.error("Schema migration failed, it resumes on the next "
+                          "start: %s", exc)
 
-    def update_time_index(self, idx_type, sys_time_val, glob_node):
-        '''Updates the file or process time index entry for the hourly
-        bucket depending on the index type passed'''
-        idx = None
-        if idx_type == DBInterface.FILE_INDEX:
-            idx = self.file_index
-        elif idx_type == DBInterface.PROC_INDEX:
-            idx = self.proc_index
-        hourly_bucket = sys_time_val - (sys_time_val % 3600)
-        idx['time'][hourly_bucket] = glob_node
+    def __migrate_time(self, node, key):
+        '''Converts a string time property to an integer, a property
+        holding no time is removed. Returns the new value or None.'''
+        if not node.has_key(key):
+            return None
+        val = node[key]
+        if not isinstance(val, basestring):
+            return val
+        if val in ('', 'None'):
+            del node[key]
+            return None
+        node[key] = int(val)
+        return node[key]
 
-    def update_index(self, idx_type, idx_name, idx_key, idx_val):
-        '''Adds value to a given index type with the name and key'''
-        if idx_type == DBInterface.FILE_INDEX:
-            self.file_index[idx_name][idx_key] = idx_val
-        elif idx_type == DBInterface.PROC_INDEX:
-            self.proc_index[idx_name][idx_key] = idx_val
+    def __migrate_node(self, node):
+        '''Converts the time properties of a single node to integers'''
+        if not node.has_key('type'):
+            return
+        if node['type'] == NodeType.EVENT and node.has_key('before_time'):
+            was_str = isinstance(node['before_time'], basestring)
+            before_time = self.__migrate_time(node, 'before_time')
+            self.__migrate_time(node, 'after_time')
+            if was_str and before_time is not None:
+                self.update_index(DBInterface.EVENT_INDEX, 'before_time',
+                                  before_time, node)
+        elif node['type'] == NodeType.LOCAL:
+            self.__migrate_time(node, 'mono_time')
 
     def __get_next_id(self):
         '''Returns a unique node ID'''
         node_id = None
         if self.id_node is not None:
-            node_id = self.id_node['serial_id']
-            self.id_node['serial_id'] = node_id + 1
+            if self.next_id is None or self.next_id >= self.id_limit:
+                self.__reserve_id_block()
+            node_id = self.next_id
+            self.next_id += 1
             return node_id
         else:
             raise UniqueIDException()
 
-    def find_and_del_rel(self, from_node, to_node):
-        '''Finds a relation of type rel_type between two nodes
-        and deletes it'''
-        for rel in from_node.relationships.outgoing:
-            if rel.end.id == to_node.id:
-                rel.delete()
-
-    def delete_relationship(self, rel):
-        '''Deletes relatioship given a relationship object'''
-        rel.delete()
-
-    @CacheManager.dec(CACHE_NAMES.NODE_BY_ID,
-                      lambda node_id: node_id)
-    def get_node_by_id(self, node_id):
-        '''Returns a node object given the ID'''
-        _node = self.db.node[node_id]
-        return _node
-
-    def set_link_state(self, rel_list, status):
-        '''Sets the link state to status'''
-        for rel in rel_list:
-            rel['state'] = status
+    def __reserve_id_block(self):
+        '''Reserves the next block of node IDs by advancing the persistent
+        serial ID past it. IDs left unused by a shutdown or crash are
+        skipped, so IDs stay unique across restarts.'''
+        block_start = self.id_node['serial_id']
+        self.id_node['serial_id'] = block_start + self.id_block_size
+        self.next_id = block_start
+        self.id_limit = block_start + self.id_block_size
+        self.id_block_uncommitted = True
+
+    def _load_ref(self, kind, ref_id):
+        '''Returns the node ('n') or relationship ('r') with the given
+        internal ID, used to rehydrate cache entries'''
+        if kind == 'n':
+            return self.db.node[ref_id]
+        return self.db.relationship[ref_id]
 
     def query(self, qry, **kwargs):
         '''Executes query and returns result'''
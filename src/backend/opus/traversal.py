@@ -5,18 +5,27 @@ The traversal module contains procedures for traversing the graph.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import heapq
 import logging
 from . import storage
 
+@storage.CacheManager.dec(storage.CACHE_NAMES.LATEST_GLOBAL,
+                          lambda name: name)
 def get_latest_glob_version(db_iface, name):
-    '''Gets the latest global version for the given name'''
+    '''Gets the latest global version for the given name, the LATEST_GLOBAL
+    cache is kept current by StorageIFace.update_index so the index is only
+    queried for names that have not been seen yet'''
     node = None
+    if not db_iface.may_have_name(name):
+        return node
 
-    result = db_iface.query("START n=node:FILE_INDEX('name:\"" + name + "\"') "
-                            "RETURN n ORDER BY n.node_id DESC LIMIT 1")
-    for row in result:
-        node = row['n']
-    return node
+    node = db_iface.get_buffered_index(storage.StorageIFace.FILE_INDEX,
+                                       'name', name)
+    if node is not None:
+        return node
+
+    return db_iface.get_latest_indexed(storage.StorageIFace.FILE_INDEX,
+                                       'name', name)
 
 
 def is_glob_deleted(glob_node):
@@ -50,6 +59,14 @@ def get_locals_from_global(db_iface, glob_node):
     return loc_node_link_list
 
 
+def get_mono_time(loc_node):
+    '''Returns the monotonic creation time of a local, locals created by a
+    message without one have none and sort first'''
+    if loc_node.has_key('mono_time'):
+        return int(loc_node['mono_time'])
+    return 0
+
+
 def get_process_from_local(db_iface, loc_node):
     '''Gets the process node and relationship link
     from the local obj'''
@@ -67,15 +84,9 @@ def get_locals_from_process(db_iface, proc_node):
     given process object node'''
     loc_node_link_list = []
 
-    rows = db_iface.query("START proc_node=node({id}) "
-                          "MATCH proc_node<-[rel:PROC_OBJ]-loc_node "
-                          "WHERE rel.state <> {state} "
-                          "RETURN loc_node, rel",
-                          id=proc_node.id, state=storage.LinkState.INACTIVE)
-    for row in rows:
-        loc_node = row['loc_node']
-        rel = row['rel']
-        loc_node_link_list.append((loc_node, rel))
+    for rel in proc_node.PROC_OBJ.incoming:
+        if rel['state'] != storage.LinkState.INACTIVE:
+            loc_node_link_list.append((rel.start, rel))
     return loc_node_link_list
 
 
@@ -96,49 +107,46 @@ def get_valid_local(db_iface, proc_node, loc_name):
     loc_node = None
     loc_proc_rel = None
 
-    rows = db_iface.query("START proc_node=node({id}) "
-                          "MATCH proc_node<-[lp_rel:PROC_OBJ]-loc_node "
-                          "WHERE lp_rel.state <> {state1} "
-                          "AND lp_rel.state <> {state2} "
-                          "AND loc_node.name = {name} "
-                          "RETURN loc_node, lp_rel ",
-                          id=proc_node.id, state1=storage.LinkState.CLOSED,
-                          state2=storage.LinkState.INACTIVE, name=loc_name)
-    for row in rows:
-        loc_node = row['loc_node']
-        loc_proc_rel = row['lp_rel']
+    for lp_rel in proc_node.PROC_OBJ.incoming:
+        if lp_rel['state'] in (storage.LinkState.CLOSED,
+                               storage.LinkState.INACTIVE):
+            continue
+        if lp_rel.start['name'] == loc_name:
+            loc_node = lp_rel.start
+            loc_proc_rel = lp_rel
     return loc_node, loc_proc_rel
 
 
-def get_glob_latest_version(db_iface, glob_node):
-    '''Returns the latest valid version of a global node'''
+def _walk_glob_versions(db_iface, glob_node):
+    '''Follows the non deleted versions of glob_node. Returns the IDs of
+    the globals passed through, the last global reached and the latest
+    version, which is None if the chain ends in a deleted version'''
 
     # If there are no new versions of the global node the
     # local is pointing to, then return the current global
     if len(glob_node.relationships.incoming) == 0:
-        return glob_node
+        return [], glob_node, glob_node
 
     # The global has versioned, traverse the graph until you find
     # the last global node that is not in deleted status. Avoid
     # taversing down deleted paths.
     found = False
-    node_id = glob_node.id
+    last_glob = glob_node
+    passed = []
 
     while 1:
-        result = db_iface.query(
-            "START src_node=node({id}) "
-            "MATCH src_node<-[rel:GLOB_OBJ_PREV]-dest_node "
-            "WHERE rel.state <> {state} "
-            "RETURN dest_node "
-            "ORDER BY dest_node.node_id",
-            id=node_id, state=storage.LinkState.DELETED)
-        for row in result:
-            dest_glob_node = row['dest_node']
-            node_id = dest_glob_node.id
-            ret_glob = dest_glob_node
-            found = True
+        # Take the newest of the non deleted next versions
+        for rel in last_glob.GLOB_OBJ_PREV.incoming:
+            if rel['state'] == storage.LinkState.DELETED:
+                continue
+            dest_glob_node = rel.start
+            if not found or dest_glob_node['node_id'] > ret_glob['node_id']:
+                ret_glob = dest_glob_node
+                found = True
 
         if found:  # Check if node has any incoming relationships
+            passed.append(last_glob.id)
+            last_glob = ret_glob
             if len(ret_glob.relationships.incoming) == 0:
                 break
             else:
@@ -148,23 +156,94 @@ def get_glob_latest_version(db_iface, glob_node):
             ret_glob = None
             break
 
+    return passed, last_glob, ret_glob
+
+
+def get_glob_latest_version(db_iface, glob_node):
+    '''Returns the latest valid version of a global node. Known successors
+    are followed through the GLOB_SUCCESSOR cache and the path taken is
+    compressed so that every global on it points at the last global
+    reached.'''
+    path = []
+    node = glob_node
+    while 1:
+        succ = db_iface.cache_man.get(storage.CACHE_NAMES.GLOB_SUCCESSOR,
+                                      node.id)
+        if succ is None:
+            break
+        path.append(node.id)
+        node = succ
+
+    passed, last_glob, ret_glob = _walk_glob_versions(db_iface, node)
+
+    for node_id in path + passed:
+        db_iface.cache_man.update(storage.CACHE_NAMES.GLOB_SUCCESSOR,
+                                  node_id, last_glob)
     return ret_glob
 
 
+@storage.CacheManager.dec(storage.CACHE_NAMES.META_SNAPSHOT,
+                          lambda snap_hash: snap_hash)
+def get_meta_snapshot(db_iface, snap_hash):
+    '''Returns the meta snapshot node with the given content hash'''
+    node = db_iface.get_buffered_index(storage.StorageIFace.META_INDEX,
+                                       'hash', snap_hash)
+    if node is not None:
+        return node
+
+    return db_iface.get_latest_indexed(storage.StorageIFace.META_INDEX,
+                                       'hash', snap_hash)
+
+
+def get_events_in_window(db_iface, start_time, end_time):
+    '''Returns the events that began between start_time and end_time
+    inclusive as dicts in begin time order. Each dict holds the node the
+    event is stored on, the event node or for packed events their local.'''
+    events = []
+    for event_node in db_iface.get_indexed_range(
+            storage.StorageIFace.EVENT_INDEX, 'before_time', start_time,
+            end_time):
+        events.append({'fn': event_node['fn'],
+                       'ret': event_node['ret'],
+                       'before_time': event_node['before_time'],
+                       'after_time': event_node['after_time'],
+                       'node': event_node})
+
+    # A packed block is indexed by its earliest begin time and spans at
+    # most packed_flush_span, so earlier blocks may hold events in the window
+    for block_node in db_iface.get_indexed_range(
+            storage.StorageIFace.EVENT_INDEX, 'packed_time',
+            max(start_time - db_iface.packed_flush_span, 0), end_time):
+        loc_node = None
+        for rel in block_node.PACKED_EVENTS.incoming:
+            loc_node = rel.start
+        for event in get_block_events(block_node):
+            if start_time <= event['before_time'] <= end_time:
+                event['node'] = loc_node
+                events.append(event)
+
+    events.sort(key=lambda event: event['before_time'])
+    return events
+
+
+def get_proc_snapshot(db_iface, proc_node, rel_type):
+    '''Returns the name to value dict of the meta snapshots linked to the
+    process node proc_node by rel_type'''
+    meta_dict = {}
+
+    for rel in getattr(proc_node, rel_type).outgoing:
+        snap_node = rel.end
+        meta_dict.update(zip(snap_node['keys'], snap_node['values']))
+    return meta_dict
+
+
 def get_proc_meta(db_iface, proc_node, rel_type):
     '''Returns all meta objects of a given type and their
     relationship link to the process node proc_node'''
     meta_rel_list = []
 
-    rows = db_iface.query("START proc_node=node({id}) "
-                          "MATCH proc_node-[meta_rel:" + rel_type +
-                          "]->meta_node "
-                          "RETURN meta_node, meta_rel",
-                          id=proc_node.id)
-    for row in rows:
-        meta_node = row['meta_node']
-        meta_rel = row['meta_rel']
-        meta_rel_list.append((meta_node, meta_rel))
+    for meta_rel in getattr(proc_node, rel_type).outgoing:
+        meta_rel_list.append((meta_rel.end, meta_rel))
     return meta_rel_list
 
 
@@ -188,16 +267,36 @@ def get_last_event(db_iface, start_node, rel_type):
     return last_event_node, event_rel
 
 
+def get_block_events(block_node):
+    '''Returns the events stored in a packed event block as a list of
+    dicts in begin time order'''
+    fns = block_node['ev_fns']
+    return [{'fn': fns[fn_id],
+             'ret': ret_val,
+             'before_time': begin_time,
+             'after_time': end_time}
+            for fn_id, ret_val, begin_time, end_time in zip(
+                block_node['ev_fn'], block_node['ev_ret'],
+                block_node['ev_begin'], block_node['ev_end'])]
+
+
+def get_packed_events(db_iface, loc_node):
+    '''Returns the events stored in the packed event blocks of a local
+    node as a list of dicts in begin time order'''
+    # Each block is in order, merge them on (begin time, block, position)
+    blocks = [[(event['before_time'], block_num, pos, event)
+               for pos, event in enumerate(get_block_events(rel.end))]
+              for block_num, rel in enumerate(
+                  loc_node.PACKED_EVENTS.outgoing)]
+    return [entry[3] for entry in heapq.merge(*blocks)]
+
+
 def get_rel(db_iface, src_node, rel_type):
     '''Returns a list of relationship links of rel_type
     from the source node src_node'''
     rel_list = []
 
-    rows = db_iface.query("START src_node=node({id}) "
-                          "MATCH src_node-[rel:" + rel_type + "]->dest_node "
-                          "RETURN rel", id=src_node.id)
-    for row in rows:
-        rel = row['rel']
+    for rel in getattr(src_node, rel_type).outgoing:
         rel_list.append(rel)
     return rel_list
 
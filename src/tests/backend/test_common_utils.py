@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the containers in common_utils. Run from src/backend so the opus
+package can be imported.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import random
+import unittest
+
+from opus.common_utils import ClockCache, SortedChunkList, UndoJournal
+
+
+class ClockCacheTest(unittest.TestCase):
+
+    def test_unbounded(self):
+        cache = ClockCache()
+        for i in range(1000):
+            cache[i] = str(i)
+        self.assertEqual(len(cache), 1000)
+        self.assertEqual(cache[999], '999')
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+    def test_zero_capacity_caches_nothing(self):
+        cache = ClockCache(0)
+        cache['a'] = 1
+        self.assertNotIn('a', cache)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_unreferenced_first(self):
+        cache = ClockCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(sorted(cache.items()), [('a', 1), ('c', 3)])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        # The hand cleared the bit of 'a' as it passed, so it goes next
+        cache['d'] = 4
+        self.assertEqual(sorted(cache.items()), [('c', 3), ('d', 4)])
+
+    def test_update_keeps_size(self):
+        cache = ClockCache(2)
+        cache['a'] = 1
+        cache['a'] = 2
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache['a'], 2)
+
+    def test_delete_frees_slot(self):
+        cache = ClockCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        del cache['a']
+        cache['c'] = 3
+        self.assertEqual(sorted(cache.items()), [('b', 2), ('c', 3)])
+        self.assertEqual(cache.stats()['evictions'], 0)
+        self.assertRaises(KeyError, cache.__getitem__, 'a')
+
+    def test_counters(self):
+        cache = ClockCache(1)
+        cache['a'] = 1
+        cache.get('a')
+        cache.get('b')
+        cache.clear()
+        self.assertEqual(cache.stats(), {'size': 0, 'capacity': 1,
+                                         'hits': 1, 'misses': 1,
+                                         'evictions': 0})
+
+
+class SortedChunkListTest(unittest.TestCase):
+
+    def test_empty(self):
+        chunks = SortedChunkList()
+        self.assertEqual(len(chunks), 0)
+        self.assertEqual(list(chunks), [])
+        self.assertIsNone(chunks.floor(10))
+        self.assertEqual(chunks.neighbours(10), (None, None))
+
+    def test_ordered_across_chunks(self):
+        keys = list(range(100))
+        random.Random(0).shuffle(keys)
+        chunks = SortedChunkList(chunk_size=4)
+        for key in keys:
+            chunks.add(key, str(key))
+        self.assertEqual(len(chunks), 100)
+        self.assertGreater(len(chunks.keys), 1)
+        self.assertTrue(all(len(keys) <= 4 for keys in chunks.keys))
+        self.assertEqual(list(chunks), [str(key) for key in range(100)])
+        self.assertEqual([key for key, _ in chunks.items()], list(range(100)))
+
+    def test_equal_keys_keep_insertion_order(self):
+        chunks = SortedChunkList(chunk_size=2)
+        for val in ['a', 'b', 'c', 'd']:
+            chunks.add(5, val)
+        chunks.add(1, 'first')
+        self.assertEqual(list(chunks), ['first', 'a', 'b', 'c', 'd'])
+        self.assertEqual(chunks.floor(5), 'd')
+
+    def test_floor_and_neighbours(self):
+        chunks = SortedChunkList(chunk_size=2)
+        for key in [10, 20, 30, 40, 50]:
+            chunks.add(key, key)
+        self.assertIsNone(chunks.floor(5))
+        self.assertEqual(chunks.floor(10), 10)
+        self.assertEqual(chunks.floor(35), 30)
+        self.assertEqual(chunks.floor(99), 50)
+        self.assertEqual(chunks.neighbours(5), (None, 10))
+        self.assertEqual(chunks.neighbours(25), (20, 30))
+        self.assertEqual(chunks.neighbours(40), (40, 50))
+        self.assertEqual(chunks.neighbours(50), (50, None))
+
+
+class UndoJournalTest(unittest.TestCase):
+
+    def test_not_recording(self):
+        journal = UndoJournal()
+        table = {'a': 1}
+        journal.record(table, 'a')
+        table['a'] = 2
+        journal.rollback()
+        self.assertEqual(table, {'a': 2})
+
+    def test_rollback(self):
+        journal = UndoJournal()
+        outer = {'a': {'x': 1}}
+        journal.start()
+        journal.record(outer['a'], 'x')
+        outer['a']['x'] = 2
+        journal.record(outer, 'b')
+        outer['b'] = {}
+        journal.record(outer['b'], 'y')
+        outer['b']['y'] = 3
+        journal.record(outer, 'a')
+        del outer['a']
+        journal.rollback()
+        self.assertEqual(outer, {'a': {'x': 1}})
+
+    def test_commit(self):
+        journal = UndoJournal()
+        table = {}
+        journal.start()
+        journal.record(table, 'a')
+        table['a'] = 1
+        journal.commit()
+        journal.rollback()
+        self.assertEqual(table, {'a': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
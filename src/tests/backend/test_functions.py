@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the posix function argument extraction. Run from src/backend so the
+opus package can be imported.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import collections
+import unittest
+
+from opus.pvm.posix import functions
+
+
+KVPair = collections.namedtuple('KVPair', ['key', 'value'])
+
+
+class FakeMsg(object):
+
+    def __init__(self, args, ret_val=0):
+        self.args = args
+        self.ret_val = ret_val
+
+
+class CompileArgMapTest(unittest.TestCase):
+
+    def test_mapped_arguments(self):
+        extract = functions.compile_arg_map({
+            'filename': ("msg_arg", "path"),
+            'fd': ("ret_val",),
+            'mode': ("const", 3)})
+        args = extract(FakeMsg([KVPair('flags', '0'),
+                                KVPair('path', '/src/a.c')], ret_val=4))
+        self.assertEqual(args, {'filename': '/src/a.c', 'fd': '4',
+                                'mode': '3'})
+
+    def test_duplicate_keys_keep_last(self):
+        extract = functions.compile_arg_map({'filename': ("msg_arg", "path"),
+                                             'name': ("msg_arg", "path")})
+        args = extract(FakeMsg([KVPair('path', '/src/a.c'),
+                                KVPair('path', '/src/b.c')]))
+        self.assertEqual(args, {'filename': '/src/b.c', 'name': '/src/b.c'})
+
+    def test_missing_argument(self):
+        extract = functions.compile_arg_map({'filename': ("msg_arg", "path")})
+        self.assertRaises(KeyError, extract, FakeMsg([KVPair('fd', '3')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the shared memory ring buffer behind ShmProducerFetcherQueue. Run
+from src/backend so the opus package can be imported.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import threading
+import unittest
+
+from opus import messaging, pf_queue
+
+
+def make_frame(pay):
+    return (messaging.HeaderRecord(0, 1, 0, len(pay), 1, 0), pay)
+
+
+class SharedRingBufferTest(unittest.TestCase):
+    CAPACITY = 1024
+
+    def setUp(self):
+        self.ring = pf_queue.SharedRingBuffer(self.CAPACITY)
+        # A put that can never find space fails the test instead of hanging
+        self.abort_event = threading.Event()
+        self.timer = threading.Timer(5, self.abort_event.set)
+        self.timer.start()
+
+    def tearDown(self):
+        self.timer.cancel()
+
+    def test_round_trip(self):
+        frames = [make_frame(b'a' * 10), make_frame(b'b' * 20)]
+        self.assertEqual(self.ring.put(frames, self.abort_event), 2)
+        self.assertEqual([pay for _, pay in self.ring.get_all()],
+                         [b'a' * 10, b'b' * 20])
+        self.assertEqual(self.ring.used(), 0)
+        self.assertEqual(self.ring.get_all(), [])
+
+    def test_wraps(self):
+        for i in range(20):
+            pay = str(i).encode() * 100
+            self.assertEqual(self.ring.put([make_frame(pay)],
+                                           self.abort_event), 1)
+            self.assertEqual([got for _, got in self.ring.get_all()], [pay])
+
+    def test_large_frame_after_small(self):
+        self.assertEqual(self.ring.put([make_frame(b'a' * 10)],
+                                       self.abort_event), 1)
+        self.ring.get_all()
+
+        large = b'b' * int(self.CAPACITY * 0.6)
+        self.assertFalse(self.ring.fits(large))
+        self.assertEqual(self.ring.put([make_frame(large),
+                                        make_frame(b'c' * 10)],
+                                       self.abort_event), 1)
+        self.assertFalse(self.abort_event.is_set())
+        self.assertEqual([pay for _, pay in self.ring.get_all()],
+                         [b'c' * 10])
+
+    def test_queue_depth_counts_written(self):
+        queue = pf_queue.ShmProducerFetcherQueue(capacity=self.CAPACITY)
+        queue.enqueue([make_frame(b'a' * 10),
+                       make_frame(b'b' * self.CAPACITY),
+                       make_frame(b'c' * 10)])
+        self.assertEqual(queue.depth_msgs.value, 2)
+        self.assertEqual(queue.depth_bytes.value,
+                         2 * (messaging.HeaderRecord.length + 10))
+        self.assertEqual(queue.ring.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the storage backends that need no JVM and of the queries run
+against them. Run from src/backend so the opus package can be imported.
+'''
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from opus import (memory_storage, query_interface, sqlite_storage, storage,
+                  traversal)
+from opus.query import client_query, env_diff, last_query
+
+# The package exports the gen_workflow query method under the module's name
+gen_workflow = importlib.import_module('opus.query.gen_workflow')
+
+
+LinkState = storage.LinkState
+NodeType = storage.NodeType
+StorageIFace = storage.StorageIFace
+
+
+class BackendTestMixin(object):
+    '''Builds a small graph, /usr/bin/cc executed by a process that reads
+    /src/a.c and writes /src/a.o, and queries it'''
+
+    def open_db(self, **kwargs):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_iface = self.open_db()
+        with self.db_iface.start_transaction():
+            self.build_graph(self.db_iface)
+
+    def tearDown(self):
+        self.db_iface.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_global(self, db_iface, idx_type, name):
+        glob_node = db_iface.create_node(NodeType.GLOBAL)
+        glob_node['name'] = [name]
+        db_iface.update_index(idx_type, 'name', name, glob_node)
+        db_iface.update_time_index(idx_type, db_iface.sys_time, glob_node)
+        return glob_node
+
+    def add_local(self, db_iface, glob_node, proc_node, state):
+        loc_node = db_iface.create_node(NodeType.LOCAL)
+        db_iface.create_relationship(glob_node, loc_node,
+                                     storage.RelType.LOC_OBJ, state)
+        db_iface.create_relationship(loc_node, proc_node,
+                                     storage.RelType.PROC_OBJ)
+        return loc_node
+
+    def add_meta(self, db_iface, proc_node, name, value):
+        meta_node = db_iface.create_node(NodeType.META)
+        meta_node['name'] = name
+        meta_node['value'] = value
+        db_iface.create_relationship(proc_node, meta_node,
+                                     storage.RelType.OTHER_META)
+
+    def build_graph(self, db_iface):
+        db_iface.set_sys_time_for_msg(7200)
+        db_iface.set_mono_time_for_msg(1)
+        self.proc_node = db_iface.create_node(NodeType.PROCESS)
+        self.proc_node['pid'] = 42
+        self.add_meta(db_iface, self.proc_node, 'cwd', '/src')
+        self.add_meta(db_iface, self.proc_node, 'cmd_args', 'cc -c a.c')
+
+        self.bin_node = self.add_global(db_iface, StorageIFace.PROC_INDEX,
+                                        '/usr/bin/cc')
+        self.add_local(db_iface, self.bin_node, self.proc_node,
+                       LinkState.BIN)
+        self.src_node = self.add_global(db_iface, StorageIFace.FILE_INDEX,
+                                        '/src/a.c')
+        self.add_local(db_iface, self.src_node, self.proc_node,
+                       LinkState.READ)
+        self.obj_node = self.add_global(db_iface, StorageIFace.FILE_INDEX,
+                                        '/src/a.o')
+        self.add_local(db_iface, self.obj_node, self.proc_node,
+                       LinkState.WRITE)
+
+    def test_index_lookups(self):
+        names = sorted(self.db_iface.get_index_keys(StorageIFace.FILE_INDEX,
+                                                    'name'))
+        self.assertEqual(names, ['/src/a.c', '/src/a.o'])
+        self.assertEqual([node.id for node in self.db_iface.get_indexed(
+            StorageIFace.FILE_INDEX, 'name', '/src/a.o')],
+            [self.obj_node.id])
+        self.assertEqual([node.id for node in self.db_iface.find_indexed(
+            StorageIFace.FILE_INDEX, 'name', '/src/*')],
+            [self.src_node.id, self.obj_node.id])
+        self.assertEqual(self.db_iface.load_node(self.proc_node.id)['pid'],
+                         42)
+
+    def test_cypher_rejected(self):
+        self.assertFalse(self.db_iface.supports_cypher)
+        self.assertRaises(Exception, self.db_iface.query, "START n=node(0)")
+
+    def test_other_backend_args_ignored(self):
+        db_iface = self.open_db(id_block_size=10000,
+                                migration_batch_size=500)
+        db_iface.close()
+
+    def test_get_programs(self):
+        tree = query_interface.get_programs(self.db_iface, '/src/a.c',
+                                            None, None, None)
+        self.assertEqual(tree.get_tree_map().keys(), ['/'])
+        tree = query_interface.get_programs(self.db_iface, '/src/a.c',
+                                            7200, 7300, None)
+        self.assertIn('usr', tree.get_tree_map()['/']['subdirs'])
+        tree = query_interface.get_programs(self.db_iface, '/src/a.c',
+                                            3600, 3700, None)
+        self.assertEqual(tree.get_tree_map(), {})
+
+    def test_get_files(self):
+        tree = query_interface.get_files(self.db_iface, '/usr/bin/cc',
+                                         None, None, None)
+        src_dir = tree.get_tree_map()['/']['subdirs']['src']
+        self.assertEqual(sorted(src_dir['subdirs']), ['a.c', 'a.o'])
+
+    def test_get_file_proc_history(self):
+        history = query_interface.get_file_proc_history(
+            self.db_iface, '/src/a.o', '/usr/bin/cc', None, 7200, 7300)
+        self.assertEqual(history, [(['/usr/bin/cc'], 42, ['/src/a.o'],
+                                    LinkState.WRITE, 7200,
+                                    self.obj_node['node_id'])])
+        history = query_interface.get_file_proc_history(
+            self.db_iface, None, '/usr/bin/cc', None, None, None)
+        self.assertEqual([row[2] for row in history],
+                         [['/src/a.o'], ['/src/a.c']])
+
+    def test_last_query(self):
+        rsp = client_query.ClientQueryControl.exec_method(
+            self.db_iface, {'qry_method': 'query_file',
+                            'qry_args': {'name': '/src/*.o'}})
+        self.assertTrue(rsp['success'])
+        self.assertEqual([row['cmd'] for row in rsp['data']], ['cc -c a.c'])
+        rsp = last_query.query_folder(self.db_iface, {'name': '/src'})
+        self.assertEqual([row['cmd'] for row in rsp['data']], ['cc -c a.c'])
+        rsp = last_query.query_folder(self.db_iface, {'name': '/tmp'})
+        self.assertFalse(rsp['success'])
+
+    def test_env_diff(self):
+        procs = env_diff.get_proc_from_binary(self.db_iface, '/usr/bin/cc',
+                                              None, None)
+        self.assertEqual([node.id for node in procs], [self.proc_node.id])
+        meta = env_diff.convert_to_dict(env_diff.get_meta_data(
+            self.db_iface, self.proc_node, storage.RelType.OTHER_META))
+        self.assertEqual(meta, {'cwd': '/src', 'cmd_args': 'cc -c a.c'})
+
+    def test_write_history(self):
+        procs = gen_workflow.walk_write_history(self.db_iface, '/src/a.o')
+        self.assertEqual([node.id for node in procs], [self.proc_node.id])
+        rows = gen_workflow.walk_globals_of_process(self.proc_node)
+        self.assertEqual([glob_node.id for glob_node, _ in rows],
+                         [self.obj_node.id, self.src_node.id,
+                          self.bin_node.id])
+
+    def test_packed_events_flushed_and_indexed(self):
+        db_iface = self.open_db(packed_events=True, packed_flush_events=2,
+                                packed_flush_span_ms=1)
+        try:
+            with db_iface.start_transaction():
+                db_iface.set_mono_time_for_msg(1)
+                loc_node = db_iface.create_node(NodeType.LOCAL)
+                for begin_time in [10, 20, 30, 3000000]:
+                    db_iface.append_event(loc_node, 'read', 1, begin_time,
+                                          begin_time + 5)
+            # The first block is flushed by count and the second by span,
+            # the last event is still buffered
+            self.assertEqual(len(traversal.get_rel(
+                db_iface, loc_node, storage.RelType.PACKED_EVENTS)), 2)
+            self.assertEqual([event['before_time'] for event in
+                              traversal.get_packed_events(db_iface,
+                                                          loc_node)],
+                             [10, 20, 30])
+            events = traversal.get_events_in_window(db_iface, 15, 1000000)
+            self.assertEqual([event['before_time'] for event in events],
+                             [20, 30])
+            self.assertEqual(events[0]['node'].id, loc_node.id)
+        finally:
+            db_iface.close()
+        self.assertEqual(len(db_iface.event_buffers), 0)
+
+    def test_name_filter_survives_crash(self):
+        filter_file = os.path.join(self.tmp_dir, 'name_filter.dat')
+        self.db_iface.load_name_filter(filter_file)
+        self.assertTrue(os.path.isfile(filter_file))
+        self.assertTrue(self.db_iface.may_have_name('/src/a.c'))
+        self.assertFalse(self.db_iface.may_have_name('/src/b.c'))
+        with self.db_iface.start_transaction():
+            self.add_global(self.db_iface, StorageIFace.FILE_INDEX,
+                            '/src/b.c')
+
+        # Loading again without a dump, as after a crash, replays the
+        # journal
+        db_iface = self.open_db()
+        try:
+            db_iface.load_name_filter(filter_file)
+            self.assertTrue(db_iface.may_have_name('/src/b.c'))
+        finally:
+            db_iface.close()
+
+    def test_latest_global_restored_on_rollback(self):
+        self.assertEqual(traversal.get_latest_glob_version(
+            self.db_iface, '/src/a.o').id, self.obj_node.id)
+        try:
+            with self.db_iface.start_transaction():
+                self.add_global(self.db_iface, StorageIFace.FILE_INDEX,
+                                '/src/a.o')
+                self.add_global(self.db_iface, StorageIFace.FILE_INDEX,
+                                '/src/b.o')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.db_iface.cache_man.clear()
+        cache = self.db_iface.cache_man.caches[
+            storage.CACHE_NAMES.LATEST_GLOBAL]
+        self.assertEqual(cache['/src/a.o'].id, self.obj_node.id)
+        self.assertNotIn('/src/b.o', cache)
+        self.assertIsNone(cache.capacity)
+
+    def test_meta_snapshot_restored_on_rollback(self):
+        try:
+            with self.db_iface.start_transaction():
+                snap_node = self.db_iface.create_node(NodeType.META)
+                self.db_iface.update_index(StorageIFace.META_INDEX, 'hash',
+                                           'abc', snap_node)
+                self.assertEqual(traversal.get_meta_snapshot(
+                    self.db_iface, 'abc').id, snap_node.id)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertIsNone(traversal.get_meta_snapshot(self.db_iface, 'abc'))
+
+    def test_lineage_bounded_to_bucket(self):
+        with self.db_iface.start_transaction():
+            prev_node = self.obj_node
+            for sys_time in [7300, 11000]:
+                self.db_iface.set_sys_time_for_msg(sys_time)
+                glob_node = self.db_iface.create_node(NodeType.GLOBAL)
+                glob_node['name'] = ['/src/a.o']
+                self.db_iface.update_index(StorageIFace.FILE_INDEX, 'name',
+                                           '/src/a.o', glob_node)
+                self.db_iface.update_time_index(StorageIFace.FILE_INDEX,
+                                                sys_time, glob_node,
+                                                prev_node)
+                self.db_iface.create_relationship(
+                    glob_node, prev_node, storage.RelType.GLOB_OBJ_PREV)
+                prev_node = glob_node
+        nodes = query_interface.find_globals(
+            self.db_iface, StorageIFace.FILE_INDEX, '/src/a.o', 7200, 7300,
+            lineage=True)
+        self.assertEqual([node['sys_time'] for node in nodes], [7200, 7300])
+
+
+class SQLiteInterfaceTest(BackendTestMixin, unittest.TestCase):
+
+    def open_db(self, **kwargs):
+        return sqlite_storage.SQLiteInterface(self.tmp_dir, **kwargs)
+
+    def test_directory_filename(self):
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.tmp_dir, sqlite_storage.SQLiteInterface.DB_FILE)))
+
+    def test_reads_keep_writes_buffered(self):
+        db_iface = self.db_iface
+        with db_iface.start_transaction():
+            meta_node = db_iface.create_node(NodeType.META)
+            meta_node['name'] = 'env'
+            db_iface.create_relationship(self.proc_node, meta_node,
+                                         storage.RelType.OTHER_META)
+            self.proc_node['pid'] = 43
+            db_iface._write_index(StorageIFace.FILE_INDEX, 'name',
+                                  '/src/a.o', meta_node)
+            rels = self.proc_node.OTHER_META.outgoing
+            self.assertEqual(rels[-1].end_id, meta_node.id)
+            self.assertEqual(db_iface.load_props('node_props',
+                                                 meta_node.id)['name'],
+                             'env')
+            self.assertEqual(db_iface.load_props('node_props',
+                                                 self.proc_node.id)['pid'],
+                             43)
+            self.assertEqual([node.id for node in db_iface.get_indexed(
+                StorageIFace.FILE_INDEX, 'name', '/src/a.o')],
+                [self.obj_node.id, meta_node.id])
+            self.assertEqual(db_iface.get_latest_indexed(
+                StorageIFace.FILE_INDEX, 'name', '/src/a.o'), meta_node)
+            rels[-1].delete()
+            self.assertEqual(len(self.proc_node.OTHER_META.outgoing),
+                             len(rels) - 1)
+            self.assertTrue(db_iface.writes)
+        self.assertEqual(db_iface.writes, [])
+        self.assertEqual(len(self.proc_node.OTHER_META.outgoing),
+                         len(rels) - 1)
+        self.assertEqual(db_iface.load_props('node_props',
+                                             self.proc_node.id)['pid'], 43)
+
+
+class InMemoryGraphInterfaceTest(BackendTestMixin, unittest.TestCase):
+
+    def open_db(self, **kwargs):
+        return memory_storage.InMemoryGraphInterface(self.tmp_dir, **kwargs)
+
+    def test_index_writes_deduplicated(self):
+        key = (StorageIFace.FILE_INDEX, 'name')
+        with self.db_iface.start_transaction():
+            self.db_iface._write_index(StorageIFace.FILE_INDEX, 'name',
+                                       '/src/a.c', self.src_node)
+        self.assertEqual(self.db_iface.indexes[key]['/src/a.c'],
+                         [self.src_node.id])
+        try:
+            with self.db_iface.start_transaction():
+                self.add_global(self.db_iface, StorageIFace.FILE_INDEX,
+                                '/src/b.c')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertNotIn('/src/b.c', self.db_iface.indexes[key])
+        self.assertNotIn('/src/b.c', self.db_iface.index_members[key])
+
+    def test_background_snapshot(self):
+        db_iface = self.open_db(snapshot_interval_s=0)
+        try:
+            with db_iface.start_transaction():
+                node = db_iface.create_node(NodeType.PROCESS)
+            self.assertIsNotNone(db_iface.snapshot_pid)
+            db_iface._InMemoryGraphInterface__wait_snapshot(True)
+            restored = self.open_db()
+            self.assertEqual(restored.load_node(node.id)['type'],
+                             NodeType.PROCESS)
+            restored.filename = None
+            restored.close()
+        finally:
+            db_iface.close()
+
+    def test_snapshot_restore(self):
+        self.db_iface.snapshot()
+        db_iface = self.open_db()
+        try:
+            self.assertEqual([node.id for node in db_iface.get_indexed(
+                StorageIFace.FILE_INDEX, 'name', '/src/a.c')],
+                [self.src_node.id])
+        finally:
+            db_iface.close()
+
+
+if __name__ == '__main__':
+    unittest.main()